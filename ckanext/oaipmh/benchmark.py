@@ -0,0 +1,355 @@
+# coding: utf-8
+# vi:et:ts=8:
+'''Offline benchmarks for the metadata readers and writers.
+
+The readers in importcore and importformats, and the KataMetadataReader
+used by the harvester, are run over synthetic records generated here, so
+no OAI-PMH source needs to be reachable.  For each reader the number of
+records per second, the peak memory use and (optionally) the functions
+where the time went are reported.  Records per second are given both
+for reading every key of the metadata and for reading only the keys
+the harvester's converter uses, which is what the lazy maps of
+importformats save on.  With --writers, the server's
+rdf_writer is compared with rdf_serializer instead.
+
+Run from the command line, e.g.
+
+    python -m ckanext.oaipmh.benchmark -n 500 -s 5 -d 3 --profile 15
+    python -m ckanext.oaipmh.benchmark --writers -n 2000
+'''
+
+import cProfile
+import cStringIO
+import multiprocessing
+import optparse
+import pstats
+import resource
+import sys
+import time
+from xml.sax.saxutils import escape
+
+import lxml.etree
+from oaipmh import common
+from oaipmh.server import NS_XSI, NSMAP, nsoai
+
+import importformats
+import rdftools
+
+OAI = 'http://www.openarchives.org/OAI/2.0/'
+
+dc_elements = ['title', 'creator', 'subject', 'description', 'publisher',
+        'contributor', 'date', 'type', 'format', 'identifier', 'source',
+        'language', 'relation', 'coverage', 'rights']
+
+def synthetic_oai_dc(index, size=3, depth=1):
+        '''generate an oai_dc metadata element
+
+        :param index: running number of the record
+        :type index: integer
+        :param size: how many times each Dublin Core element is repeated
+        :type size: integer
+        :param depth: ignored, oai_dc is flat
+        :type depth: integer
+        :returns: XML text of an OAI-PMH metadata element
+        :rtype: string
+        '''
+        parts = ['<metadata xmlns="%s"><oai_dc:dc '
+                'xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+                'xmlns:dc="http://purl.org/dc/elements/1.1/">' % OAI]
+        for name in dc_elements:
+                for i in range(size):
+                        parts.append('<dc:%s xml:lang="en">%s %d of record '
+                                '%d</dc:%s>' % (name, name, i, index, name))
+        parts.append('</oai_dc:dc></metadata>')
+        return ''.join(parts)
+
+def synthetic_nrd(index, size=3, depth=1):
+        '''generate an NRD (RDF/XML) metadata element
+
+        :param index: running number of the record
+        :type index: integer
+        :param size: number of creators, manifestations and subjects
+        :type size: integer
+        :param depth: length of the chain of collections the dataset is
+                part of
+        :type depth: integer
+        :returns: XML text of an OAI-PMH metadata element
+        :rtype: string
+        '''
+        base = 'http://example.org/%d' % index
+        parts = ['<metadata xmlns="%s"><rdf:RDF '
+                'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+                'xmlns:nrd="http://purl.org/net/nrd#" '
+                'xmlns:dct="http://purl.org/dc/terms/" '
+                'xmlns:foaf="http://xmlns.com/foaf/0.1/" '
+                'xmlns:dcat="http://www.w3.org/ns/dcat#">' % OAI,
+                '<nrd:Dataset rdf:about="%s">' % base,
+                '<dct:title xml:lang="en">Dataset %d</dct:title>' % index,
+                '<nrd:continuityIdentifier>%s/c</nrd:continuityIdentifier>'
+                        % base,
+                '<nrd:rights>%s</nrd:rights>' % escape(
+                        '<RightsDeclaration RIGHTSCATEGORY="LICENSED">'
+                        'CC-BY-4.0</RightsDeclaration>'),
+                '<dct:description>Description of %d</dct:description>'
+                        % index]
+        for i in range(size):
+                parts.append('<nrd:creator><foaf:Person rdf:about="%s/p%d">'
+                        '<foaf:name>Person %d</foaf:name>'
+                        '<foaf:mbox rdf:resource="mailto:p%d@example.org"/>'
+                        '</foaf:Person></nrd:creator>' % (base, i, i, i))
+                parts.append('<nrd:manifestation><nrd:Manifestation '
+                        'rdf:about="%s/f%d"><dcat:mediaType>text/csv'
+                        '</dcat:mediaType><dcat:byteSize>%d</dcat:byteSize>'
+                        '</nrd:Manifestation></nrd:manifestation>'
+                        % (base, i, 1024 * i))
+                parts.append('<nrd:subject>subject %d</nrd:subject>' % i)
+        for level in range(depth):
+                parts.append('<dct:isPartOf><rdf:Description '
+                        'rdf:about="%s/col%d"><dct:title>Collection %d'
+                        '</dct:title>' % (base, level, level))
+        parts.append('</rdf:Description></dct:isPartOf>' * depth)
+        parts.append('</nrd:Dataset></rdf:RDF></metadata>')
+        return ''.join(parts)
+
+def synthetic_xml(index, size=3, depth=1):
+        '''generate a metadata element of generic nested XML
+
+        :param index: running number of the record
+        :type index: integer
+        :param size: number of children of every inner element
+        :type size: integer
+        :param depth: levels of nesting below the document element
+        :type depth: integer
+        :returns: XML text of an OAI-PMH metadata element
+        :rtype: string
+        '''
+        def node(level):
+                if level == depth:
+                        return 'value %d' % index
+                return ''.join('<x:item n="%d">%s</x:item>' % (i, node(level + 1))
+                                for i in range(size))
+        return ('<metadata xmlns="%s"><x:doc xmlns:x="http://example.org/x#">'
+                '%s</x:doc></metadata>' % (OAI, node(0)))
+
+# The keys dataconverter.oai_dc2ckan reads from the harvester's reader,
+# and the format-independent keys of the importformats readers that
+# hold the same information.
+converter_keys = {
+        'kata_oai_dc': ['titleNode', 'subject', 'type', 'creator',
+                'contributorNode', 'publisherNode', 'rightsNode',
+                'identifier', 'language', 'description'],
+}
+default_converter_keys = ['%s.count' % name for name in ('title', 'subject',
+        'creator', 'contributor', 'distributor', 'license',
+        'versionidentifier', 'language', 'description')]
+
+generators = {
+        'oai_dc': synthetic_oai_dc,
+        'nrd': synthetic_nrd,
+        'rdf': synthetic_nrd,
+        'xml': synthetic_xml,
+}
+
+def benchmark_readers():
+        '''return the readers to benchmark
+
+        These are all the readers of importformats.create_metadata_registry,
+        with the metadataPrefix as name, and the harvester's
+        KataMetadataReader if CKAN is importable.
+
+        :returns: list of (name, metadataPrefix of input, reader) triples
+        :rtype: list of (string, string, function)
+        '''
+        registry = importformats.create_metadata_registry()
+        readers = [(prefix, prefix, registry._readers[prefix])
+                        for prefix in sorted(generators)
+                        if registry.hasReader(prefix)]
+        try:
+                from ckanext.oaipmh.harvester import kata_oai_dc_reader
+        except ImportError:
+                pass # harvester needs CKAN; run without it
+        else:
+                readers.append(('kata_oai_dc', 'oai_dc', kata_oai_dc_reader))
+        return readers
+
+def synthetic_records(prefix, count, size, depth):
+        '''return parsed synthetic metadata elements for a format
+
+        :returns: list of metadata elements
+        :rtype: list of lxml.etree.Element instances
+        '''
+        generator = generators[prefix]
+        return [lxml.etree.XML(generator(i, size, depth))
+                        for i in range(count)]
+
+def _read_converter_keys(map, keys):
+        '''look up only some keys of a metadata map'''
+        for key in keys:
+                map.get(key)
+
+def _run_reader(args):
+        '''benchmark one reader; runs in a fresh process
+
+        Memory is measured as the growth of the maximum resident set
+        size while the records are generated and read.
+        '''
+        name, prefix, count, size, depth, profile = args
+        reader = dict((n, r) for n, _, r in benchmark_readers())[name]
+        keys = converter_keys.get(name, default_converter_keys)
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        records = synthetic_records(prefix, count, size, depth)
+        start = time.time()
+        for record in records:
+                reader(record).getMap().items()
+        elapsed = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+        start = time.time()
+        for record in records:
+                _read_converter_keys(reader(record).getMap(), keys)
+        converter_elapsed = time.time() - start
+        stats = None
+        if profile:
+                profiler = cProfile.Profile()
+                profiler.enable()
+                for record in records:
+                        reader(record).getMap().items()
+                profiler.disable()
+                out = cStringIO.StringIO()
+                s = pstats.Stats(profiler, stream=out)
+                s.strip_dirs().sort_stats('cumulative').print_stats(profile)
+                stats = out.getvalue()
+        return (name, count / elapsed if elapsed else float('inf'),
+                        count / converter_elapsed if converter_elapsed
+                        else float('inf'), peak, stats)
+
+def run(count=200, size=3, depth=1, names=None, profile=0, out=sys.stdout):
+        '''benchmark the readers and write a report
+
+        Every reader is run in its own process so that the peak memory
+        figures do not include the other readers.
+
+        :param count: number of records per reader
+        :type count: integer
+        :param size: size parameter of the generated records
+        :type size: integer
+        :param depth: depth parameter of the generated records
+        :type depth: integer
+        :param names: names of readers to run, None for all
+        :type names: list of strings
+        :param profile: number of functions to show in profiles, 0 for
+                no profiling
+        :type profile: integer
+        :param out: stream to write the report to
+        :type out: file
+        :returns: list of (name, records per second reading all keys,
+                records per second reading the converter's keys, peak
+                KiB) tuples
+        :rtype: list of (string, float, float, integer)
+        '''
+        jobs = [(name, prefix, count, size, depth, profile)
+                        for name, prefix, _ in benchmark_readers()
+                        if names is None or name in names]
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+                results = pool.map(_run_reader, jobs, chunksize=1)
+        finally:
+                pool.close()
+                pool.join()
+        out.write('%-12s %12s %12s %12s\n' % ('reader', 'records/s',
+                        'converter/s', 'peak KiB'))
+        for name, rate, converter_rate, peak, _ in results:
+                out.write('%-12s %12.1f %12.1f %12d\n'
+                                % (name, rate, converter_rate, peak))
+        for name, _, _, _, stats in results:
+                if stats:
+                        out.write('\n--- %s ---\n%s' % (name, stats))
+        return [result[:4] for result in results]
+
+def synthetic_metadata(index, size=3):
+        '''generate metadata of a record as the server has it
+
+        :returns: metadata with size values of every Dublin Core element
+        :rtype: oaipmh.common.Metadata
+        '''
+        map = dict((name, [u'%s %d of record %d \xe4 & <' % (name, i, index)
+                        for i in range(size)]) for name in dc_elements)
+        map['identifier'][0] = u'http://example.org/dataset/%d' % index
+        return common.Metadata(map)
+
+def _envelope():
+        '''return an OAI-PMH element with the namespaces of a response'''
+        root = lxml.etree.Element(nsoai('OAI-PMH'), nsmap=NSMAP)
+        root.set('{%s}schemaLocation' % NS_XSI, '')
+        return root
+
+def _write_tree(metadata):
+        '''serialize metadata with rdf_writer, as in a response'''
+        e_metadata = lxml.etree.SubElement(_envelope(), nsoai('metadata'))
+        rdftools.rdf_writer(e_metadata, metadata)
+        return lxml.etree.tostring(e_metadata, encoding=unicode)
+
+def run_writers(count=200, size=3, out=sys.stdout):
+        '''benchmark rdf_writer against rdf_serializer and write a report
+
+        Both are timed producing the serialized <metadata> element of
+        every record, and their outputs are compared.
+
+        :returns: list of (name, records per second) pairs
+        :rtype: list of (string, float)
+        :raises AssertionError: if the outputs differ
+        '''
+        records = [synthetic_metadata(i, size) for i in range(count)]
+        start_tag = lxml.etree.tostring(lxml.etree.SubElement(_envelope(),
+                        nsoai('metadata')), encoding=unicode)[:-2] + u'>'
+        writers = [('rdf_writer', _write_tree),
+                        ('rdf_serializer', lambda metadata: start_tag +
+                                rdftools.rdf_serializer(metadata) +
+                                u'</metadata>')]
+        outputs = {}
+        results = []
+        for name, write in writers:
+                start = time.time()
+                outputs[name] = [write(record) for record in records]
+                elapsed = time.time() - start
+                results.append((name,
+                                count / elapsed if elapsed else float('inf')))
+        assert outputs['rdf_writer'] == outputs['rdf_serializer'], \
+                        'rdf_serializer output differs from rdf_writer'
+        out.write('%-16s %12s\n' % ('writer', 'records/s'))
+        for name, rate in results:
+                out.write('%-16s %12.1f\n' % (name, rate))
+        return results
+
+def main(argv=None):
+        parser = optparse.OptionParser(usage='%prog [options] [reader ...]')
+        parser.add_option('-n', '--records', type='int', default=200,
+                        help='records per reader [%default]')
+        parser.add_option('-s', '--size', type='int', default=3,
+                        help='repeated elements per record [%default]')
+        parser.add_option('-d', '--depth', type='int', default=1,
+                        help='nesting depth of records [%default]')
+        parser.add_option('-p', '--profile', type='int', default=0,
+                        metavar='N', help='show N hottest functions')
+        parser.add_option('--min-rate', action='append', default=[],
+                        metavar='READER=N', help='fail if READER reads '
+                        'fewer than N records/s (repeatable)')
+        parser.add_option('--writers', action='store_true',
+                        help='benchmark the rdf writers instead')
+        options, names = parser.parse_args(argv)
+        if options.writers:
+                run_writers(options.records, options.size)
+                return 0
+        results = run(options.records, options.size, options.depth,
+                        names or None, options.profile)
+        rates = dict((name, rate) for name, rate, _, _ in results)
+        failed = False
+        for limit in options.min_rate:
+                name, minimum = limit.split('=', 1)
+                if name in rates and rates[name] < float(minimum):
+                        sys.stderr.write('%s: %.1f records/s is below %s\n'
+                                        % (name, rates[name], minimum))
+                        failed = True
+        return 1 if failed else 0
+
+if __name__ == '__main__':
+        sys.exit(main())
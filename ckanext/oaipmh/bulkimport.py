@@ -0,0 +1,237 @@
+# coding: utf-8
+# vi:et:ts=8:
+'''Bulk import and export of OAI-PMH records.
+
+This streams ListRecords responses through a metadata reader and hands
+every record to a callback, e.g. one that writes newline-delimited JSON.
+Responses are parsed incrementally, so only the records being read are
+kept in memory, not whole pages.
+After each page the resumption token of the next page is reported and
+optionally saved to a state file, so an interrupted run can be resumed.
+An output file is flushed before the token is saved, and its length is
+saved with it; a resumed run cuts the output back to that length, so
+the records of a page that was not finished are not written twice.
+
+Export to newline-delimited JSON from the command line:
+
+    python -m ckanext.oaipmh.bulkimport -p nrd -o out.ndjson URL
+
+Loading into CKAN is done with the paster command "oaipmh import".
+'''
+
+import json
+import optparse
+import os
+import sys
+import time
+
+import lxml.etree
+import oaipmh.error
+
+import importpool
+import streaming
+
+def _record_texts(page):
+        try:
+                for record in page:
+                        yield lxml.etree.tostring(record)
+        except oaipmh.error.NoRecordsMatchError:
+                return # an empty list; page.token stays None
+
+def list_record_pages(url, prefix=None, token=None, **args):
+        '''iterate over the pages of a ListRecords request
+
+        A page is parsed while its records are read, so only one record
+        of it is in memory at a time.  The resumption token of the next
+        page is known once all records of the page have been read.
+
+        :param url: base URL of the OAI-PMH interface
+        :type url: string
+        :param prefix: metadataPrefix, unless resuming
+        :type prefix: string
+        :param token: resumption token to start from
+        :type token: string
+        :param args: other arguments (set, from, until)
+        :type args: hash from string to string
+        :returns: the XML texts of the records of each page, and the
+                page, whose token attribute holds the resumption token
+                for the next page (None on the last)
+        :rtype: iterator of (iterator of strings,
+                streaming.ResponseParser) pairs
+        '''
+        if token:
+                args = {'resumptionToken': token}
+        else:
+                args = dict((k, v) for k, v in args.items() if v)
+                args['metadataPrefix'] = prefix
+        args['verb'] = 'ListRecords'
+        pages = streaming.iter_pages(
+                        lambda args: streaming.open_request(url, args), args)
+        for page in pages:
+                yield _record_texts(page), page
+
+def _read_state_lines(path):
+        if path and os.path.exists(path):
+                with open(path) as f:
+                        return f.read().split('\n')
+        return []
+
+def read_state(path):
+        '''return the resumption token saved in a state file, if any'''
+        lines = _read_state_lines(path)
+        return (lines[0].strip() or None) if lines else None
+
+def read_position(path):
+        '''return the output length saved in a state file, if any'''
+        lines = _read_state_lines(path)
+        if len(lines) > 1 and lines[1].strip():
+                return int(lines[1])
+        return None
+
+def write_state(path, token, position=None):
+        '''save the resumption token of the next page to a state file
+
+        The file is removed once there are no more pages.
+
+        :param position: length of the output up to the next page, to
+                cut the output back to on resume
+        :type position: integer
+        '''
+        if token is None:
+                if os.path.exists(path): os.remove(path)
+                return
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+                f.write(token)
+                if position is not None:
+                        f.write('\n%d' % position)
+        os.rename(tmp, path)
+
+def open_output(path, state=None):
+        '''open an output file for appending records
+
+        When resuming from a state file, the records written after the
+        saved position, of a page that was not finished, are dropped.
+        '''
+        out = open(path, 'a')
+        position = read_position(state)
+        if read_state(state) and position is not None:
+                out.truncate(position)
+        return out
+
+def _file_checkpoint(out):
+        '''flush an output file and return its length'''
+        out.flush()
+        os.fsync(out.fileno())
+        return os.fstat(out.fileno()).st_size
+
+def import_records(url, prefix, handle, pool=None, token=None, state=None,
+                progress=None, checkpoint=None, **args):
+        '''stream all records of a ListRecords request to a callback
+
+        :param url: base URL of the OAI-PMH interface
+        :type url: string
+        :param prefix: metadataPrefix of the records
+        :type prefix: string
+        :param handle: called with the header and metadata dictionary of
+                each record; metadata is None for deleted records
+        :type handle: function of (oaipmh.common.Header, dict) -> None
+        :param pool: the pool that reads the records; by default they are
+                read in this process with importformats readers
+        :type pool: importpool.ParsePool instance
+        :param token: resumption token to start from
+        :type token: string
+        :param state: path of a file to keep the next resumption token in;
+                a token found there is resumed from
+        :type state: string
+        :param progress: called after each page with the number of
+                records so far, records per second and the next token
+        :type progress: function of (integer, float, string) -> None
+        :param checkpoint: called after each page, before the state is
+                saved, to make the handled records durable; returns a
+                position to save with the token, or None
+        :type checkpoint: function of () -> integer
+        :param args: other ListRecords arguments (set, from, until)
+        :returns: number of records handled
+        :rtype: integer
+        '''
+        if pool is None:
+                pool = importpool.ParsePool(prefix, processes=0)
+        token = token or read_state(state)
+        count = 0
+        start = time.time()
+        for records, page in list_record_pages(url, prefix, token, **args):
+                for header, metadata in pool.imap(records):
+                        handle(header, metadata)
+                        count += 1
+                token = page.token
+                position = checkpoint() if checkpoint else None
+                if state:
+                        write_state(state, token, position)
+                if progress:
+                        elapsed = time.time() - start
+                        progress(count, count / elapsed if elapsed else 0.0,
+                                        token)
+        return count
+
+def record_as_json(header, metadata):
+        '''return a record as one line of JSON'''
+        return json.dumps({
+                'identifier': header.identifier(),
+                'datestamp': header.datestamp().isoformat(),
+                'sets': header.setSpec(),
+                'deleted': bool(header.isDeleted()),
+                'metadata': metadata,
+        }, sort_keys=True)
+
+def report_progress(count, rate, token):
+        '''write throughput and the next resumption token to stderr'''
+        sys.stderr.write('%d records, %.1f records/s, next token: %s\n'
+                        % (count, rate, token))
+
+def main(argv=None):
+        parser = optparse.OptionParser(usage='%prog [options] URL')
+        parser.add_option('-p', '--prefix', default='oai_dc',
+                        help='metadataPrefix to harvest [%default]')
+        parser.add_option('-s', '--set', help='harvest only this set')
+        parser.add_option('-f', '--from', dest='from_', metavar='DATE',
+                        help='harvest records modified since DATE')
+        parser.add_option('-u', '--until', metavar='DATE',
+                        help='harvest records modified until DATE')
+        parser.add_option('-o', '--output', metavar='FILE',
+                        help='append records to FILE [stdout]')
+        parser.add_option('-t', '--token', help='resume from this token')
+        parser.add_option('--state', metavar='FILE',
+                        help='keep the next resumption token in FILE')
+        parser.add_option('-j', '--processes', type='int', default=0,
+                        help='read records in this many processes '
+                        '[%default]')
+        parser.add_option('-k', '--key', action='append', dest='keys',
+                        help='output only this metadata key (repeatable)')
+        options, args = parser.parse_args(argv)
+        if len(args) != 1:
+                parser.error('give the URL of an OAI-PMH interface')
+        if options.output:
+                # A token given on the command line is not resumed from
+                # the state file, so neither is its position.
+                out = open_output(options.output,
+                                None if options.token else options.state)
+                checkpoint = lambda: _file_checkpoint(out)
+        else:
+                out = sys.stdout
+                checkpoint = lambda: out.flush()
+        def write(header, metadata):
+                out.write(record_as_json(header, metadata) + '\n')
+        with importpool.ParsePool(options.prefix, options.processes,
+                        options.keys) as pool:
+                import_records(args[0], options.prefix, write, pool,
+                                token=options.token, state=options.state,
+                                progress=report_progress,
+                                checkpoint=checkpoint, set=options.set,
+                                until=options.until,
+                                **{'from': options.from_})
+        if out is not sys.stdout:
+                out.close()
+
+if __name__ == '__main__':
+        main()
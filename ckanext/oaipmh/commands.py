@@ -0,0 +1,266 @@
+'''Paster commands for bulk OAI-PMH operations.
+'''
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+from ckan.lib.cli import CkanCommand
+
+log = logging.getLogger(__name__)
+
+
+class OAIPMHCommand(CkanCommand):
+    '''OAI-PMH bulk operations
+
+    Usage:
+
+      oaipmh import URL [--group NAME] [--set SET] [--from DATE]
+                        [--until DATE] [--token TOKEN] [--state FILE]
+        - Stream all oai_dc records of an OAI-PMH interface into CKAN
+          packages, one ListRecords page at a time. Meant for initial
+          loads that are too big for the harvest queue. The resumption
+          token of the next page is reported after every page and, with
+          --state, kept in FILE so that the load can be resumed.
+
+      oaipmh benchmark-harvest URL|RECORDING [--source-config JSON]
+                        [--latency SECONDS] [--page-size N]
+                        [--error-rate RATE]
+        - Run the gather and import stages of the harvester over an
+          OAI-PMH interface in this process and report their throughput
+          and metrics. Given a recording directory of
+          ckanext.oaipmh.replay, it is served locally with the given
+          latency, page size and error rate. Creates a harvest source,
+          so use a scratch database.
+
+      oaipmh pipelined-harvest URL [--source-config JSON] [--in-flight N]
+                        [--from DATE] [--until DATE]
+        - Harvest a source with many requests in flight at a time, for
+          sources with long round trips. Takes the configuration of
+          OAI-PMH harvest sources and makes the same packages and set
+          groups as the harvester, outside of the harvest queue.
+
+      oaipmh generate COUNT [--tags N] [--extras N] [--groups N]
+                        [--prefix PREFIX]
+        - Add COUNT synthetic packages with tags, extras and group
+          memberships, for scale testing. Use a scratch database.
+
+    The commands should be run from the ckanext-oaipmh directory and
+    expect a development.ini file to be present. Most of the time you
+    will specify the config explicitly though::
+
+        paster oaipmh import URL --config=../ckan/development.ini
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def __init__(self, name):
+        super(OAIPMHCommand, self).__init__(name)
+        self.parser.add_option('-g', '--group', dest='group',
+                               help='add the packages to this group')
+        self.parser.add_option('-s', '--set', dest='set',
+                               help='import only this set')
+        self.parser.add_option('-f', '--from', dest='from_',
+                               help='import records modified since DATE')
+        self.parser.add_option('-u', '--until', dest='until',
+                               help='import records modified until DATE')
+        self.parser.add_option('-t', '--token', dest='token',
+                               help='resume from this resumption token')
+        self.parser.add_option('--state', dest='state',
+                               help='keep the next resumption token here')
+        self.parser.add_option('--source-config', dest='source_config',
+                               default='',
+                               help='configuration of the harvest source')
+        self.parser.add_option('--latency', dest='latency', type='float',
+                               default=0.0,
+                               help='seconds the recording waits per request')
+        self.parser.add_option('--page-size', dest='page_size', type='int',
+                               help='list page size of the recording')
+        self.parser.add_option('--error-rate', dest='error_rate',
+                               type='float', default=0.0,
+                               help='share of failing recording requests')
+        self.parser.add_option('--in-flight', dest='in_flight', type='int',
+                               default=16,
+                               help='requests made at a time [%default]')
+        self.parser.add_option('--tags', dest='tags', type='int', default=5,
+                               help='tags per generated package')
+        self.parser.add_option('--extras', dest='extras', type='int',
+                               default=5, help='extras per generated package')
+        self.parser.add_option('--groups', dest='groups', type='int',
+                               default=10, help='groups to generate')
+        self.parser.add_option('--prefix', dest='prefix',
+                               default='synthetic',
+                               help='name prefix of generated packages')
+
+    def command(self):
+        self._load_config()
+        cmd = self.args[0]
+        if cmd == 'import':
+            if len(self.args) < 2:
+                print self.usage
+                sys.exit(1)
+            self.import_(self.args[1])
+        elif cmd == 'benchmark-harvest':
+            if len(self.args) < 2:
+                print self.usage
+                sys.exit(1)
+            self.benchmark_harvest(self.args[1])
+        elif cmd == 'pipelined-harvest':
+            if len(self.args) < 2:
+                print self.usage
+                sys.exit(1)
+            self.pipelined_harvest(self.args[1])
+        elif cmd == 'generate':
+            if len(self.args) < 2:
+                print self.usage
+                sys.exit(1)
+            self.generate(int(self.args[1]))
+        else:
+            print 'Command %s not recognized' % cmd
+
+    def import_(self, url):
+        from ckan import model
+        from ckanext.oaipmh import bulkimport, importpool
+        from ckanext.oaipmh.dataconverter import oai_dc2ckan
+        from ckanext.oaipmh.harvester import OAIPMHHarvester
+        from ckanext.oaipmh.harvester import kata_oai_dc_reader
+        from oaipmh.metadata import MetadataRegistry
+
+        prefix = OAIPMHHarvester.metadata_prefix_value
+        harvester = OAIPMHHarvester()
+        registry = MetadataRegistry()
+        registry.registerReader(prefix, kata_oai_dc_reader)
+        group = None
+        if self.options.group:
+            group = harvester._get_group(self.options.group,
+                                         in_revision=False)
+
+        class KataPool(importpool.ParsePool):
+            # The Kata reader keeps lxml nodes in the metadata, which can
+            # not be sent between processes, so read in this process.
+            def imap(self, records):
+                for xml in records:
+                    yield importpool.parse_record(xml, prefix,
+                                                  registry=registry)
+
+        failed = []
+
+        def load(header, metadata):
+            ident = header.identifier()
+            if header.isDeleted() or metadata is None:
+                return
+            data = {
+                'identifier': ident,
+                'package_name': harvester._package_name_from_identifier(
+                    ident),
+                'package_url': '%s?verb=GetRecord&identifier=%s&%s=%s' % (
+                    url, ident, harvester.metadata_prefix_key, prefix),
+                'metadata': {prefix: metadata},
+                'package_xml_save': {},
+                'package_resource': {},
+            }
+            if not oai_dc2ckan(data, kata_oai_dc_reader._namespaces, group):
+                failed.append(ident)
+                model.Session.remove()
+
+        count = bulkimport.import_records(
+            url, prefix, load, KataPool(prefix, processes=0),
+            token=self.options.token, state=self.options.state,
+            progress=bulkimport.report_progress, set=self.options.set,
+            until=self.options.until, **{'from': self.options.from_})
+        print '%i records read, %i failed to load' % (count, len(failed))
+        for ident in failed:
+            log.warning('Could not load %s' % ident)
+
+    def benchmark_harvest(self, target):
+        from ckanext.harvest.model import HarvestJob, HarvestObject
+        from ckanext.harvest.model import HarvestSource
+        from ckanext.oaipmh import metrics, replay
+        from ckanext.oaipmh.harvester import OAIPMHHarvester, GatherFailure
+
+        server = None
+        url = target
+        if os.path.isdir(target):
+            server = replay.ReplayServer(
+                ('localhost', 0), replay.Recording(target),
+                latency=self.options.latency,
+                error_rate=self.options.error_rate,
+                page_size=self.options.page_size, ignore_dates=True,
+                seed=0)
+            server.start()
+            url = server.url
+        source = HarvestSource(url=url, type='OAI-PMH',
+                               config=self.options.source_config)
+        source.save()
+        job = HarvestJob(source=source)
+        job.gather_started = datetime.now()
+        job.save()
+        harvester = OAIPMHHarvester()
+        start = time.time()
+        try:
+            object_ids = harvester.gather_stage(job)
+        except GatherFailure:
+            object_ids = []
+        gather_seconds = time.time() - start
+        job.gather_finished = datetime.now()
+        job.save()
+        start = time.time()
+        imported = 0
+        for object_id in object_ids:
+            harvest_object = HarvestObject.get(object_id)
+            if harvester.fetch_stage(harvest_object) and \
+                    harvester.import_stage(harvest_object):
+                imported += 1
+        import_seconds = time.time() - start
+        if server is not None:
+            server.shutdown()
+        print 'gather: %i objects in %.1f s' % (len(object_ids),
+                                                 gather_seconds)
+        print 'import: %i of %i objects in %.1f s, %.1f objects/s' % (
+            imported, len(object_ids), import_seconds,
+            len(object_ids) / import_seconds if import_seconds else 0.0)
+        stages = metrics.harvest_registry.job(job.id) or {}
+        fields = ('runs', 'seconds', 'requests', 'request_seconds', 'bytes',
+                  'records', 'queries', 'db_seconds', 'retries', 'errors')
+        print '%-20s' % 'stage' + ''.join('%11s' % field[:10]
+                                          for field in fields)
+        for stage in metrics.HARVEST_STAGES:
+            if stage in stages:
+                print '%-20s' % stage + ''.join(
+                    '%11.2f' % stages[stage][field]
+                    if isinstance(stages[stage][field], float)
+                    else '%11i' % stages[stage][field] for field in fields)
+
+    def generate(self, count):
+        from ckanext.oaipmh.generate import generate_repository
+
+        start = time.time()
+
+        def progress(done):
+            print '%i packages, %.1f packages/s' % (
+                done, done / (time.time() - start))
+        total = generate_repository(
+            count, tags=self.options.tags, extras=self.options.extras,
+            groups=self.options.groups,
+            prefix=self.options.prefix.decode('utf-8'), progress=progress)
+        print '%i packages with prefix %s' % (total, self.options.prefix)
+
+    def pipelined_harvest(self, url):
+        import dateutil.parser
+        from ckanext.oaipmh.pipeline import harvest
+
+        def progress(count, rate):
+            print '%i records, %.1f records/s' % (count, rate)
+        imported, failed = harvest(
+            url, self.options.source_config, self.options.in_flight,
+            from_=self.options.from_ and
+            dateutil.parser.parse(self.options.from_),
+            until=self.options.until and
+            dateutil.parser.parse(self.options.until),
+            progress=progress)
+        print '%i records imported, %i failed' % (imported, len(failed))
+        for ident in failed:
+            log.warning('Could not import %s' % ident)
@@ -0,0 +1,151 @@
+'''HTTP compression of OAI-PMH responses.
+
+Responses are compressed incrementally, so that streamed responses stay
+streamed. Parts of a response that come with a precompressed form, like
+records from the record cache, are copied into the compressed response
+as they are instead of being compressed again.
+'''
+import struct
+import zlib
+
+ENCODINGS = ['gzip', 'deflate']
+
+_GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+_ZLIB_HEADER = '\x78\x9c'
+
+
+def negotiate(accept_encoding):
+    '''Return the encoding to use for an Accept-Encoding header, if any.
+
+    gzip is preferred over deflate when both are equally acceptable.
+    '''
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        params = item.strip().split(';')
+        name = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    best = None
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+def deflate(data, level=6):
+    '''Compress data into raw deflate blocks that can be spliced.
+
+    The blocks end with a sync flush and are not final, so they can be
+    followed by any other deflate blocks.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class PrecompressedText(str):
+    '''A part of a response with its raw deflate form from deflate().
+    '''
+    def __new__(cls, text, deflated):
+        self = str.__new__(cls, text)
+        self.deflated = deflated
+        return self
+
+
+class PartedText(str):
+    '''A response that also keeps the parts it was joined from.
+    '''
+    def __new__(cls, parts):
+        self = str.__new__(cls, ''.join(parts))
+        self.parts = parts
+        return self
+
+
+def response_parts(response):
+    '''Return the parts of a response: a string or an iterable of them.
+    '''
+    parts = getattr(response, 'parts', None)
+    if parts is not None:
+        return parts
+    if isinstance(response, basestring):
+        return [response]
+    return response
+
+
+class ResponseCompressor(object):
+    '''Incremental gzip or deflate encoder of a response.
+
+    :param encoding: 'gzip' or 'deflate'
+    :type encoding: string
+    '''
+    def __init__(self, encoding, level=6):
+        self.encoding = encoding
+        self.level = level
+        self._compressor = None
+        self._size = 0
+        if encoding == 'gzip':
+            self._checksum = zlib.crc32('')
+        else:
+            self._checksum = zlib.adler32('')
+
+    def _update(self, data):
+        self._size += len(data)
+        if self.encoding == 'gzip':
+            self._checksum = zlib.crc32(data, self._checksum)
+        else:
+            self._checksum = zlib.adler32(data, self._checksum)
+
+    def header(self):
+        '''Return the bytes that start the compressed response.'''
+        return _GZIP_HEADER if self.encoding == 'gzip' else _ZLIB_HEADER
+
+    def compress(self, data):
+        '''Return compressed bytes for the next part of the response.
+
+        Output is flushed after every part, so a part can be sent to the
+        client right away.
+        '''
+        self._update(data)
+        deflated = getattr(data, 'deflated', None)
+        if deflated is not None:
+            # A new compressor after the spliced blocks, since back
+            # references must not reach over them.
+            out = self._flush()
+            self._compressor = None
+            return out + deflated
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                                -zlib.MAX_WBITS)
+        return self._compressor.compress(data) + self._flush()
+
+    def _flush(self):
+        if self._compressor is None:
+            return ''
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        '''Return the bytes that end the compressed response.'''
+        compressor = self._compressor or zlib.compressobj(
+            self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        out = compressor.flush(zlib.Z_FINISH)
+        if self.encoding == 'gzip':
+            return out + struct.pack('<II', self._checksum & 0xffffffff,
+                                     self._size & 0xffffffff)
+        return out + struct.pack('>I', self._checksum & 0xffffffff)
+
+    def iterate(self, parts):
+        '''Compress an iterable of response parts.'''
+        yield self.header()
+        for part in parts:
+            if part:
+                yield self.compress(part)
+        yield self.finish()
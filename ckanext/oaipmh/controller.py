@@ -1,20 +1,107 @@
 '''Serving controller interface for OAI-PMH
 '''
+import calendar
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import hashlib
 import logging
 
-from ckan.lib.base import BaseController, render
+from ckan.lib.base import BaseController, abort, render
 
-from pylons import request, response
+from pylons import config, request, response
+from paste.deploy.converters import asbool
 
-from oaipmh.server import BatchingServer, oai_dc_writer
+from oaipmh.server import decodeResumptionToken, oai_dc_writer
+from oaipmh import error
 from oaipmh import metadata
 from oaipmh.metadata import oai_dc_reader
 
-from oaipmh_server import CKANServer
-from rdftools import rdf_reader, rdf_writer
+from oaipmh_server import CKANServer, KeysetServer
+from compression import ResponseCompressor, negotiate, response_parts
+import metrics
+from rdftools import rdf_reader, rdf_serializer, rdf_writer
 
 log = logging.getLogger(__name__)
 
+_server = None
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+def get_server():
+    '''Return the OAI-PMH server of this process.
+
+    The server and its metadata registry hold no per-request state, so
+    they are built on first use, with all supported metadata formats,
+    and shared by all requests.
+    '''
+    # What the shared objects keep between requests, and why threads
+    # may share it:
+    # - the metadata registry, serializers and namespace map are only
+    #   read after they are built here;
+    # - resumption state travels in the tokens, and KeysetResumption
+    #   keeps nothing but the batch size;
+    # - CKANServer's set list is a tuple that is replaced whole, never
+    #   changed, and is checked against the groups on every use;
+    # - database access goes through the scoped session of the thread
+    #   serving the request.
+    global _server
+    if _server is None:
+        metadata_registry = metadata.MetadataRegistry()
+        metadata_registry.registerReader('oai_dc', oai_dc_reader)
+        metadata_registry.registerWriter('oai_dc', oai_dc_writer)
+        metadata_registry.registerReader('rdf', rdf_reader)
+        metadata_registry.registerWriter('rdf', rdf_writer)
+        client = CKANServer(record_cache=asbool(
+            config.get('ckanext.oaipmh.record_cache', True)))
+        chunk_size = config.get('ckanext.oaipmh.stream_chunk_size')
+        _server = KeysetServer(client,
+                               metadata_registry=metadata_registry,
+                               stream_chunk_size=int(chunk_size)
+                                   if chunk_size else None,
+                               serializers={'rdf': rdf_serializer})
+    return _server
+
+
+def _not_modified(parms):
+    '''Set the validators of the response and check the request's.
+
+    The ETag is weak, since responses differ in responseDate and may be
+    compressed differently. It is made from the full version of the
+    response, while Last-Modified only has whole seconds.
+
+    :returns: whether the client's copy of the response is current
+    :rtype: boolean
+    '''
+    validators = get_server().validators(parms)
+    if validators is None:
+        return False
+    modified, version = validators
+    seconds = calendar.timegm(modified.timetuple())
+    etag = 'W/"%s"' % hashlib.sha1(
+        repr((sorted(parms.items()), version))).hexdigest()
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = formatdate(seconds, usegmt=True)
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return if_none_match.strip() == '*' or etag in \
+            [tag.strip() for tag in if_none_match.split(',')]
+    since = parsedate_tz(request.headers.get('If-Modified-Since') or '')
+    return since is not None and seconds <= mktime_tz(since)
+
+
+def _start_metrics(verb, parms):
+    '''Start measuring a request, labeled with its verb, metadataPrefix
+    and set, which come from the resumption token if there is one.
+    '''
+    args = parms
+    if 'resumptionToken' in parms:
+        try:
+            args, _ = decodeResumptionToken(parms['resumptionToken'])
+        except (error.BadResumptionTokenError, ValueError):
+            args = {}
+    return metrics.start_request(verb, args.get('metadataPrefix'),
+                                 args.get('set'))
+
 
 class OAIPMHController(BaseController):
     '''Controller for OAI-PMH server implementation. Returns only the index
@@ -22,30 +109,38 @@ class OAIPMHController(BaseController):
     '''
     def index(self):
         '''Return the result of the handled request of a batching OAI-PMH
-        server implementation.
+        server implementation. List responses are streamed if
+        ckanext.oaipmh.stream_chunk_size is set, and responses are
+        compressed with gzip or deflate if the client accepts it.
+        Identify, ListSets, ListMetadataFormats and GetRecord responses
+        have an ETag and Last-Modified, and conditional requests for
+        them get 304 Not Modified if nothing has changed.
         '''
         if 'verb' in request.params:
             verb = request.params['verb'] if request.params['verb'] else None
             if verb:
-                client = CKANServer()
-                metadata_registry = metadata.MetadataRegistry()
-                if 'metadataPrefix' in request.params:
-                    if request.params['metadataPrefix'] == 'oai_dc':
-                        metadata_registry.registerReader('oai_dc',
-                                                         oai_dc_reader)
-                        metadata_registry.registerWriter('oai_dc',
-                                                         oai_dc_writer)
-                    else:
-                        metadata_registry.registerReader('rdf', rdf_reader)
-                        metadata_registry.registerWriter('rdf', rdf_writer)
-                else:
-                    metadata_registry.registerReader('oai_dc', oai_dc_reader)
-                    metadata_registry.registerWriter('oai_dc', oai_dc_writer)
-                serv = BatchingServer(client,
-                                      metadata_registry=metadata_registry)
                 parms = request.params.mixed()
-                res = serv.handleRequest(parms)
+                measured = _start_metrics(verb, parms)
+                response.headers['Vary'] = 'Accept-Encoding'
+                if _not_modified(parms):
+                    response.status_int = 304
+                    return metrics.measure(measured, '')
+                res = get_server().handleRequest(parms)
                 response.headers['content-type'] = 'text/xml; charset=utf-8'
-                return res
+                encoding = negotiate(request.headers.get('Accept-Encoding'))
+                if encoding:
+                    response.headers['Content-Encoding'] = encoding
+                    res = ResponseCompressor(encoding).iterate(
+                        response_parts(res))
+                return metrics.measure(measured, res)
         else:
             return render('ckanext/oaipmh/oaipmh.xhtml')
+
+    def metrics(self):
+        '''Return the metrics of this process in the Prometheus text
+        format. Only served to local clients.
+        '''
+        if request.environ.get('REMOTE_ADDR') not in LOCAL_ADDRESSES:
+            abort(404)
+        response.headers['content-type'] = 'text/plain; version=0.0.4'
+        return metrics.registry.render()
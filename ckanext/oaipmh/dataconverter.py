@@ -16,6 +16,7 @@ from ckan.model.authz import setup_default_user_roles
 from ckan.model.license import LicenseRegister, LicenseOtherPublicDomain
 from ckan.model.license import LicenseOtherClosed, LicenseNotSpecified
 from ckan.controllers.storage import BUCKET, get_ofs
+from ckanext.harvest.model import HarvestObject
 #from ckanext.kata.utils import label_list_yso
 # used in label_list_yso()
 import urllib2
@@ -236,6 +237,11 @@ def _oai_dc2ckan(data, namespaces, group, harvest_object):
         setup_default_user_roles(pkg)
     else:
         log.debug('Updating: %s' % name)
+        if pkg.state != 'active':
+            # Retired when the record was gone from the source, and now
+            # it is back.
+            log.debug('Reactivating: %s' % name)
+            pkg.state = 'active'
         # There are old resources which are replaced by new ones if they are
         # relevant anymore so "delete" all existing resources now.
         for r in pkg.resources:
@@ -329,6 +335,11 @@ def _oai_dc2ckan(data, namespaces, group, harvest_object):
         pkg.add_resource(**(resource))
     
     if harvest_object:
+        # Only the latest harvest object of a package is current.
+        model.Session.query(HarvestObject).filter(
+            HarvestObject.package_id == pkg.id).filter(
+            HarvestObject.current == True).update(
+            {'current': False}, synchronize_session=False)
         harvest_object.package_id = pkg.id
         harvest_object.content = None
         harvest_object.current = True
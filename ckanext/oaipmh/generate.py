@@ -0,0 +1,90 @@
+'''Synthetic repositories for scale testing.
+
+Packages with tags, extras and group memberships are added to the
+database in batches, with a revision and a commit per batch, so that
+repositories of 10^5 to 10^6 datasets can be loaded in reasonable time.
+Packages are named after a prefix and a running number, and numbering
+continues from the packages already there, so a repository can be grown
+step by step.
+'''
+import logging
+import random
+
+from ckan import model
+from ckan.model import Session, Package, Group, Tag, PackageTag, Member
+from ckan.model.types import make_uuid
+
+from ckanext.oaipmh import model as oaipmh_model
+
+log = logging.getLogger(__name__)
+
+LICENSES = [u'cc-by', u'cc-zero', u'odc-odbl', u'other-closed']
+
+
+def _get_or_create(cls, name, **kw):
+    instance = cls.by_name(name)
+    if instance is None:
+        instance = cls(name=name, **kw)
+        Session.add(instance)
+    return instance
+
+
+def generate_repository(count, tags=5, extras=5, groups=10, batch_size=1000,
+                        prefix=u'synthetic', seed=0, progress=None):
+    '''Add synthetic packages to the database.
+
+    :param count: number of packages to add
+    :param tags: tags per package, drawn from 10 times as many tags
+    :param extras: extras per package
+    :param groups: number of groups; every package is in one of them
+    :param batch_size: packages per revision and commit
+    :param prefix: prefix of the names of packages, tags and groups
+    :param seed: seed of the random choice of tags
+    :param progress: function called with the number of packages added
+        after every batch
+    :returns: number of packages in the repository with the prefix
+    :rtype: integer
+    '''
+    rand = random.Random(seed)
+    first = Session.query(Package).filter(
+        Package.name.like(prefix + u'-%')).count()
+    model.repo.new_revision()
+    group_list = [_get_or_create(Group, u'%s-group-%d' % (prefix, i),
+                                 title=u'Group %d' % i,
+                                 description=u'Synthetic group %d' % i)
+                  for i in range(groups)]
+    tag_list = [_get_or_create(Tag, u'%s-tag-%d' % (prefix, i))
+                for i in range(tags * 10)]
+    group_names = [group.name for group in group_list]
+    tag_names = [tag.name for tag in tag_list]
+    model.repo.commit()
+    for start in range(first, first + count, batch_size):
+        model.repo.new_revision()
+        for index in range(start, min(start + batch_size, first + count)):
+            package = Package(
+                id=make_uuid(), name=u'%s-%d' % (prefix, index),
+                title=u'Synthetic dataset %d' % index,
+                notes=(u'Description of synthetic dataset %d. ' % index) * 5,
+                url=u'http://example.org/dataset/%d' % index,
+                version=u'1.%d' % (index % 10),
+                license_id=LICENSES[index % len(LICENSES)])
+            Session.add(package)
+            for tag in rand.sample(tag_list, tags):
+                Session.add(PackageTag(package=package, tag=tag))
+            for i in range(extras):
+                package.extras[u'extra_%d' % i] = \
+                    u'value %d of dataset %d' % (i, index)
+            if group_list:
+                Session.add(Member(group=group_list[index % len(group_list)],
+                                   table_id=package.id, table_name='package',
+                                   capacity='public'))
+        model.repo.commit_and_remove()
+        # Objects of the session are gone, so reload them.
+        group_list = [Group.by_name(name) for name in group_names]
+        tag_list = [Tag.by_name(name) for name in tag_names]
+        if progress:
+            progress(min(start + batch_size, first + count) - first)
+    # Datestamps of packages written while the plugin was not loaded.
+    oaipmh_model.setup()
+    log.info('Added %i synthetic packages' % count)
+    return first + count
@@ -8,6 +8,8 @@ import urllib2
 import urllib
 import datetime
 import sys
+import tempfile
+import time
 from lxml import etree
 import httplib
 import dateutil.parser
@@ -26,6 +28,14 @@ from oaipmh import common
 from oaipmh.error import DatestampError
 from ckanext.harvest.harvesters.retry import HarvesterRetry
 from dataconverter import oai_dc2ckan
+from streaming import StreamingClient, page_opener
+import windows
+from reconcile import missing, sorted_unique
+import metrics
+import profiling
+from itertools import islice
+from collections import deque
+from multiprocessing.pool import ThreadPool
 log = logging.getLogger(__name__)
 import socket
 socket.setdefaulttimeout(30)
@@ -116,6 +126,9 @@ class OAIPMHHarvester(HarvesterBase):
     config = None
     metadata_prefix_key = 'metadataPrefix'
     metadata_prefix_value = 'oai_dc'
+    retire_batch_size = 500
+    # Sets listed at a time, unless "set_threads" is configured.
+    set_threads = 8
     def _set_config(self, config_str):
         '''Set the configuration string.
         '''
@@ -133,9 +146,28 @@ class OAIPMHHarvester(HarvesterBase):
     def _str_from_datetime(self, dt):
         return dt.strftime('%Y-%m-%dT%H:%M:%S')
     def _add_retry(self, harvest_object):
+        metrics.count_harvest('retries')
         HarvesterRetry.mark_for_retry(harvest_object)
+    def _save_gather_error(self, *args, **kw):
+        metrics.count_harvest('errors')
+        return HarvesterBase._save_gather_error(self, *args, **kw)
+    def _save_object_error(self, *args, **kw):
+        metrics.count_harvest('errors')
+        return HarvesterBase._save_object_error(self, *args, **kw)
+    def _write_metrics(self, force=False):
+        '''Write the harvest metrics of this process to the directory in
+        ckanext.oaipmh.harvest_metrics_dir, if set.
+        '''
+        directory = pylons.configuration.config.get(
+            'ckanext.oaipmh.harvest_metrics_dir')
+        if directory:
+            try:
+                metrics.harvest_registry.write(directory, force)
+            except (IOError, OSError) as e:
+                log.warning('Could not write harvest metrics: %s' % e)
     def _scan_retries(self, harvest_job):
         self._retry = HarvesterRetry()
+        self._retry_windows = []
         ident2obj = {}
         ident2set = {}
         for harvest_object in self._retry.find_all_retries(harvest_job):
@@ -145,12 +177,60 @@ class OAIPMHHarvester(HarvesterBase):
                     ident2obj[data['record']] = harvest_object
                 elif data['fetch_type'] == 'set':
                     ident2set[data['set_name']] = harvest_object
+                elif data['fetch_type'] == 'window':
+                    self._retry_windows.append((harvest_object, data))
             else:
                 # This should not happen...
                 log.debug('Unknown retry fetch type: %s' % data['fetch_type'])
         return ident2obj, ident2set
     def _clear_retries(self):
         self._retry.clear_retry_marks()
+        # Date windows that failed in this gather are resumed in the next.
+        for harvest_object in getattr(self, '_window_checkpoints', []):
+            self._add_retry(harvest_object)
+        self._window_checkpoints = []
+    def _profile_dir(self):
+        return pylons.configuration.config.get(
+            'ckanext.oaipmh.profile_dir', tempfile.gettempdir())
+    def _profiled(self, job_id, stage, function, *args):
+        '''Run a stage, under cProfile if the source configuration has
+        "profile": true.
+        '''
+        if not self.config.get('profile'):
+            return function(*args)
+        # Gather runs once per job, so its profile is written at once.
+        interval = 0 if stage == 'gather' else profiling.DUMP_INTERVAL
+        with profiling.profiled(self._profile_dir(), job_id, stage,
+                                interval):
+            return function(*args)
+    def _report_profile(self, harvest_job):
+        '''Log the hot spots of the gather stage, which are written next
+        to its profile. Those of the import stage are logged and written
+        by the processes that run it, as their profiles are written.
+        '''
+        profile = profiling.get_profile(harvest_job.id, 'gather')
+        if profile is None:
+            return
+        directory = self._profile_dir()
+        log.info('Profile of the gather stage of job %s written to %s, '
+                 'import stage profiles and their hot spots to %s.\n%s' % (
+                     harvest_job.id,
+                     profiling.profile_path(directory, harvest_job.id,
+                                            'gather'),
+                     profiling.summary_path(profiling.profile_path(
+                         directory, harvest_job.id, 'import', '*')),
+                     profiling.hot_spots(profile)))
+    def _create_client(self, url, registry):
+        '''Return an OAI-PMH client for a source.
+
+        With "stream_pages": true in the source configuration, list
+        responses are parsed incrementally instead of a page at a time.
+        '''
+        if self.config.get('stream_pages'):
+            client = StreamingClient(url, registry)
+        else:
+            client = oaipmh.client.Client(url, registry)
+        return metrics.instrument_client(client)
     def _get_client_identifier(self, url, harvest_job=None):
         registry = MetadataRegistry()
 
@@ -161,7 +241,7 @@ class OAIPMHHarvester(HarvesterBase):
                 registry.registerReader(self.metadata_prefix_value, kata_oai_dc_reader)
         else: registry.registerReader(self.metadata_prefix_value, kata_oai_dc_reader)
         
-        client = oaipmh.client.Client(url, registry)
+        client = self._create_client(url, registry)
         try:
             identifier = client.identify()
             client.updateGranularity() #quickfix: to set corrent datetime granularity, updateGranularity has to be called 
@@ -264,7 +344,6 @@ class OAIPMHHarvester(HarvesterBase):
         domain = identifier.repositoryName()
         # Get things to retry.
         ident2rec, ident2set = self._scan_retries(harvest_job)
-        rec_idents = []
         
         # todo: handle invalid sets in config (sets not in client.ListSets)
         
@@ -272,14 +351,47 @@ class OAIPMHHarvester(HarvesterBase):
         args = {self.metadata_prefix_key: self.metadata_prefix_value}
         from_until = self._get_time_limits(harvest_job)
         args.update(from_until)
+        # Several sets are listed in parallel, except in date windows,
+        # which are listed in parallel already.
+        threads = min(len(self.config.get('set', [])),
+                      int(self.config.get('set_threads', self.set_threads)))
+        if threads < 2 or self.config.get('date_windows'):
+            return self._gather_headers(harvest_job, client, identifier,
+                                        domain, ident2rec, ident2set, args,
+                                        from_until)
+        pool = ThreadPool(threads)
+        try:
+            return self._gather_headers(harvest_job, client, identifier,
+                                        domain, ident2rec, ident2set, args,
+                                        from_until, pool, threads)
+        finally:
+            pool.terminate()
+    def _gather_headers(self, harvest_job, client, identifier, domain,
+                        ident2rec, ident2set, args, from_until, pool=None,
+                        threads=1):
+        rec_idents = []
+        listed = set()
+        deleted_idents = set()
+        if pool:
+            # The set list is fetched while identifiers are listed.
+            list_sets = pool.apply_async(metrics.in_current_stages(
+                lambda: list(client.listSets()))).get
+        else:
+            list_sets = client.listSets
         if('set' in self.config):
-            for set_ in self.config['set']:
-                args['set']=set_
+            for set_, headers, exc_info in self._list_sets(
+                    client, args, harvest_job, identifier, pool, threads):
                 try:
-                    for ident in client.listIdentifiers(**args):
-                        if ident.identifier() in ident2rec and ident.identifier() not in rec_idents: # cause records can belong to more than just one set
-                            continue # On our retry list already, do not fetch twice.
+                    for ident in headers:
+                        if ident.isDeleted():
+                            deleted_idents.add(ident.identifier())
+                            continue
+                        if ident.identifier() in ident2rec or ident.identifier() in listed: # cause records can belong to more than just one set
+                            continue # On our retry list or listed already, do not fetch twice.
+                        listed.add(ident.identifier())
                         rec_idents.append(ident.identifier())
+                    if exc_info:
+                        raise exc_info[0], exc_info[1], exc_info[2]
                 except NoRecordsMatchError:
                     log.debug('No records matched: %s for set: %s' % (domain, set_))
                     pass # Ok. Just nothing to get.
@@ -290,9 +402,13 @@ class OAIPMHHarvester(HarvesterBase):
                     self._raise_gather_failure('Could not fetch an identifier list.')
         else:
             try:
-                for ident in client.listIdentifiers(**args):
-                    if ident.identifier() in ident2rec and ident.identifier() not in rec_idents: # cause records can belong to more than just one set
-                        continue # On our retry list already, do not fetch twice.
+                for ident in self._list_headers(client, args, harvest_job, identifier):
+                    if ident.isDeleted():
+                        deleted_idents.add(ident.identifier())
+                        continue
+                    if ident.identifier() in ident2rec or ident.identifier() in listed: # cause records can belong to more than just one set
+                        continue # On our retry list or listed already, do not fetch twice.
+                    listed.add(ident.identifier())
                     rec_idents.append(ident.identifier())
             except NoRecordsMatchError:
                 log.debug('No records matched: %s' % domain)
@@ -309,7 +425,7 @@ class OAIPMHHarvester(HarvesterBase):
         harvest_objs, set_objs, insertion_retries = self._make_retry_lists(
             harvest_job, ident2rec, ident2set, from_until)
         try:
-            for set_ in client.listSets():
+            for set_ in list_sets():
                 identifier, name, _ = set_
                 # Is set due for retry and it is not missing member insertion?
                 # Set either failed in retry of misses packages but not both.
@@ -356,8 +472,186 @@ class OAIPMHHarvester(HarvesterBase):
             harvest_obj.save()
             harvest_objs.append(harvest_obj.id)
         self._clear_retries()
+        metrics.count_harvest('records', len(harvest_objs))
         log.info('Gathered %i records/sets from %s.' % (len(harvest_objs), domain))
+        # Retired by gather_stage once the revision of the gather is in.
+        self._to_reconcile = (client, identifier, deleted_idents)
         return harvest_objs
+    def _list_sets(self, client, args, harvest_job, identifier, pool=None,
+                   threads=1):
+        '''Iterate over the headers of the sets in the configuration.
+
+        With a pool, the sets are listed in it, threads at a time, and
+        their headers come out in the order of the configuration. Sets
+        are listed at most threads ahead of the one whose headers are
+        being consumed. Without a pool, sets are listed one after
+        another.
+
+        :returns: the set, its headers, and the exc_info of the error
+            that ended its listing or None
+        :rtype: iterator of (string, iterable, triple) triples
+        '''
+        if pool is None:
+            for set_ in self.config['set']:
+                yield set_, self._list_headers(
+                    client, dict(args, set=set_), harvest_job,
+                    identifier), None
+            return
+        @metrics.in_current_stages
+        def list_set(set_):
+            headers = []
+            try:
+                for header in client.listIdentifiers(**dict(args, set=set_)):
+                    headers.append(header)
+            except Exception:
+                return set_, headers, sys.exc_info()
+            return set_, headers, None
+        pending = deque()
+        for set_ in self.config['set']:
+            pending.append(pool.apply_async(list_set, (set_,)))
+            if len(pending) > threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    def _list_headers(self, client, args, harvest_job, identifier):
+        '''Iterate over the headers of ListIdentifiers with args.
+
+        With "date_windows": N in the source configuration, the
+        interval from args (or from the earliest datestamp of the source
+        until now) is listed in date windows of at most N records, in
+        parallel, see windows.py. "date_window_threads" sets how many
+        windows are listed at a time. Windows that fail are saved as
+        retries and resumed from their resumption token in the next
+        gather.
+        '''
+        max_size = self.config.get('date_windows')
+        if not max_size:
+            return client.listIdentifiers(**args)
+        return self._list_windowed_headers(client, args, harvest_job,
+                                           identifier, int(max_size))
+    def _list_windowed_headers(self, client, args, harvest_job, identifier,
+                               max_size):
+        set_ = args.get('set')
+        to_list = [windows.Window(
+            args.get('from_') or identifier.earliestDatestamp(),
+            args.get('until') or datetime.datetime.utcnow())]
+        for harvest_object, data in self._retry_windows:
+            if data.get('set') == set_:
+                to_list.append(windows.Window(
+                    dateutil.parser.parse(data['from_']),
+                    dateutil.parser.parse(data['until']), data.get('token')))
+                harvest_object.content = None
+                harvest_object.save()
+        list_args = {'verb': 'ListIdentifiers',
+                     self.metadata_prefix_key: args[self.metadata_prefix_key]}
+        if set_:
+            list_args['set'] = set_
+        # Pages are counted in the stages of this thread, although the
+        # windows are listed in others.
+        open_page = metrics.in_current_stages(page_opener(client))
+        for window, headers in windows.list_windows(
+                open_page, list_args, to_list, max_size,
+                int(self.config.get('date_window_threads', windows.THREADS)),
+                client._day_granularity):
+            for header in headers:
+                yield header
+            if window.error is not None:
+                log.debug('Window %r failed: %s' % (window, window.error))
+                self._save_gather_error(
+                    'Could not list identifiers from %s to %s: %s' % (
+                        window.from_, window.until, window.error),
+                    harvest_job)
+                harvest_obj = HarvestObject(job=harvest_job)
+                harvest_obj.content = json.dumps({
+                    'fetch_type': 'window',
+                    'from_': self._str_from_datetime(window.from_),
+                    'until': self._str_from_datetime(window.until),
+                    'token': window.token,
+                    'set': set_,
+                })
+                harvest_obj.save()
+                self._window_checkpoints.append(harvest_obj)
+    def _package_id_from_identifier(self, identifier):
+        # Same as in oai_dc2ckan.
+        return identifier.replace('/', '-')
+    def _list_remote_package_ids(self, client):
+        '''Iterate over the package ids of all records at the source, or
+        in the configured sets.
+        '''
+        args = {self.metadata_prefix_key: self.metadata_prefix_value}
+        for set_ in self.config.get('set', [None]):
+            if set_:
+                args['set'] = set_
+            try:
+                for header in client.listIdentifiers(**args):
+                    if not header.isDeleted():
+                        yield self._package_id_from_identifier(
+                            header.identifier())
+            except NoRecordsMatchError:
+                pass
+    def _harvested_package_ids(self, source):
+        '''Iterate over the ids of active packages harvested from source.'''
+        query = Session.query(HarvestObject.package_id).\
+            join(HarvestJob, HarvestObject.job).\
+            join(Package, Package.id == HarvestObject.package_id).\
+            filter(HarvestJob.source == source).\
+            filter(HarvestObject.current == True).\
+            filter(Package.state == 'active')
+        for package_id, in query.yield_per(1000):
+            yield package_id
+    def _retire_packages(self, package_ids):
+        '''Mark packages deleted, a revision per batch of packages.
+
+        :returns: number of packages retired
+        '''
+        count = 0
+        package_ids = iter(package_ids)
+        while True:
+            batch = list(islice(package_ids, self.retire_batch_size))
+            if not batch:
+                return count
+            rev = model.repo.new_revision()
+            rev.message = u'Retire packages deleted at the OAI-PMH source'
+            for pkg in Session.query(Package).filter(
+                    Package.id.in_(batch)).filter(Package.state == 'active'):
+                pkg.delete()
+                count += 1
+            Session.query(HarvestObject).filter(
+                HarvestObject.package_id.in_(batch)).update(
+                {'current': False}, synchronize_session=False)
+            model.repo.commit()
+    def _reconcile(self, harvest_job, client, identifier, deleted_idents):
+        '''Retire packages whose records are gone from the source.
+
+        Records listed as deleted are always retired. With "reconcile":
+        true in the source configuration, a source that does not keep
+        deleted records persistently is also listed in full, and the
+        packages harvested from it that are not listed any more are
+        retired.
+        '''
+        retired = self._retire_packages(sorted(
+            self._package_id_from_identifier(ident)
+            for ident in deleted_idents))
+        if self.config.get('reconcile') and \
+                identifier.deletedRecord() != 'persistent':
+            try:
+                gone = missing(
+                    sorted_unique(self._harvested_package_ids(
+                        harvest_job.source)),
+                    sorted_unique(self._list_remote_package_ids(client)))
+                # Consumed before any package is retired, so that a
+                # failed listing retires nothing.
+                gone = list(gone)
+            except Exception as e:
+                log.debug(traceback.format_exc(e))
+                self._save_gather_error(
+                    'Could not list identifiers to find deleted records.',
+                    harvest_job)
+                gone = []
+            retired += self._retire_packages(gone)
+        if retired:
+            log.info('Retired %i packages deleted at %s.' %
+                     (retired, harvest_job.source.url))
     def gather_stage(self, harvest_job):
         '''
         The gather stage will recieve a HarvestJob object and will be
@@ -373,23 +667,40 @@ class OAIPMHHarvester(HarvesterBase):
         :returns: A list of HarvestObject ids
         '''
         self._set_config(harvest_job.source.config)
-        model.repo.new_revision()
         result = None
         retry_ids = []
-        try:
-            result = self._gather_stage(harvest_job)
-        except GatherFailure as e:
-            log.error('Gather %s failed: %s' % (harvest_job.id, e.message))
-            if e.harvest_obj_ids:
-                # We should be able to retry previous failures.
-                from_until = self._get_time_limits(harvest_job)
-                ident2rec, ident2set = self._scan_retries(harvest_job)
-                retry_ids, set_objs, _ = self._make_retry_lists(harvest_job, ident2rec, ident2set, from_until)
-                retry_ids.extend(set_objs)
-                self._clear_retries()
-        except Exception as e:
-            log.error(traceback.format_exc(e))
-        model.repo.commit()
+        self._window_checkpoints = []
+        with metrics.harvest_stage('gather', harvest_job.source.url,
+                                   harvest_job.id) as stage:
+            model.repo.new_revision()
+            try:
+                result = self._profiled(harvest_job.id, 'gather',
+                                        self._gather_stage, harvest_job)
+            except GatherFailure as e:
+                log.error('Gather %s failed: %s' % (harvest_job.id, e.message))
+                if e.harvest_obj_ids:
+                    # We should be able to retry previous failures.
+                    from_until = self._get_time_limits(harvest_job)
+                    ident2rec, ident2set = self._scan_retries(harvest_job)
+                    retry_ids, set_objs, _ = self._make_retry_lists(harvest_job, ident2rec, ident2set, from_until)
+                    retry_ids.extend(set_objs)
+                    self._clear_retries()
+            except Exception as e:
+                log.error(traceback.format_exc(e))
+                stage.errors += 1
+            model.repo.commit()
+            if result is not None:
+                # Retiring packages makes revisions of its own.
+                try:
+                    self._reconcile(harvest_job, *self._to_reconcile)
+                except Exception as e:
+                    log.error(traceback.format_exc(e))
+                    stage.errors += 1
+        log.info('Gather metrics of job %s: %s' % (
+            harvest_job.id, json.dumps(stage.summary())))
+        self._write_metrics(force=True)
+        if self.config.get('profile'):
+            self._report_profile(harvest_job)
         if result is None:
             raise GatherFailure(ids=retry_ids)
         return result
@@ -428,6 +739,13 @@ class OAIPMHHarvester(HarvesterBase):
         # Do common tasks and then call different methods depending on what
         # kind of info the harvest object contains.
         self._set_config(harvest_object.job.source.config)
+        with metrics.harvest_stage('import', harvest_object.job.source.url,
+                                   harvest_object.job.id):
+            result = self._profiled(harvest_object.job.id, 'import',
+                                    self._import_stage, harvest_object)
+        self._write_metrics()
+        return result
+    def _import_stage(self, harvest_object):
         ident = json.loads(harvest_object.content)
         
         registry = MetadataRegistry()
@@ -438,7 +756,7 @@ class OAIPMHHarvester(HarvesterBase):
                 registry.registerReader(self.metadata_prefix_value, kata_oai_dc_reader) 
         else: registry.registerReader(self.metadata_prefix_value, kata_oai_dc_reader)
 
-        client = oaipmh.client.Client(harvest_object.job.source.url, registry)
+        client = self._create_client(harvest_object.job.source.url, registry)
         client.updateGranularity() #quickfix for granularity
         domain = ident['domain']
         group = Group.get(domain)  # Checked in gather_stage so exists.
@@ -459,23 +777,54 @@ class OAIPMHHarvester(HarvesterBase):
         #quickfix for '/' char in identifier
         esc_identifier = identifier.replace('/','-')
         return urllib.quote_plus(esc_identifier)
-    def _fetch_import_record(self, harvest_object, master_data, client, group):
-        # The fetch part.
-        metadataPrefixes = []
-        if('metadata_formats' in self.config):
-            metadataPrefixes = self.config['metadata_formats']
+    def _metadata_prefixes(self):
+        '''Return the metadata formats to fetch, the default one last.'''
+        metadataPrefixes = list(self.config.get('metadata_formats', []))
         if self.metadata_prefix_value not in metadataPrefixes:
             metadataPrefixes.append(self.metadata_prefix_value)
+        return metadataPrefixes
+    def _record_data(self, source_url, identifier):
+        '''Return the data dictionary of a record for oai_dc2ckan, with
+        no metadata formats yet.
+        '''
         data = {'metadata': {}, 'package_xml_save' : {}, 'package_resource' : {}}
-        data['identifier'] = master_data['record']
+        data['identifier'] = identifier
         data['package_name'] = self._package_name_from_identifier(data['identifier'])
         data['package_url'] = '%s?verb=GetRecord&identifier=%s&%s=%s' % (
-                    harvest_object.job.source.url,
+                    source_url,
                     data['identifier'],
                     self.metadata_prefix_key,
                     self.metadata_prefix_value
         )
-         
+        return data
+    def _original_record_url(self, source_url, identifier, mdp):
+        return '%s?verb=GetRecord&identifier=%s&%s=%s' % (
+            source_url, identifier, self.metadata_prefix_key, mdp)
+    def _add_original_record(self, data, mdp, xml):
+        '''Add the original XML of a record in a format to its data
+        dictionary, to be saved as a resource.
+        '''
+        nowstr = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')
+        #fix for identifiers containing '/' char
+        esc_identifier = data['identifier'].replace('/','-');
+        label = '%s/%s-%s.xml' % (nowstr, esc_identifier,mdp)
+        fileurl = pylons.configuration.config['ckan.site_url'] + pylons.configuration.config['ckan.api_url'] + h.url_for('storage_file', label=label) #quick fix for ckan in non-root url 
+        data['package_xml_save'][mdp] = {
+            'label': label,
+            'xml': xml
+        }
+        data['package_resource'][mdp] = {
+            'url': fileurl,
+            'description': 'Original ' + mdp + ' metadata record',
+            'format': 'xml',
+            'size': len(xml)
+        }
+    @metrics.measured_stage('fetch_import_record')
+    def _fetch_import_record(self, harvest_object, master_data, client, group):
+        # The fetch part.
+        metadataPrefixes = self._metadata_prefixes()
+        data = self._record_data(harvest_object.job.source.url,
+                                 master_data['record'])
         for mdp in metadataPrefixes:
             try:
                 header, metadata, _ = client.getRecord(metadataPrefix=mdp,
@@ -525,30 +874,13 @@ class OAIPMHHarvester(HarvesterBase):
             data['metadata'][mdp] = metadata.getMap()
             
             try:
-                nowstr = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')
-                #fix for identifiers containing '/' char
-                esc_identifier = data['identifier'].replace('/','-');
-                label = '%s/%s-%s.xml' % (nowstr, esc_identifier,mdp)
-                resource_url = '%s?verb=GetRecord&identifier=%s&%s=%s' % (
-                    harvest_object.job.source.url,
-                    data['identifier'],
-                    self.metadata_prefix_key,
-                    mdp
-                )
-
+                resource_url = self._original_record_url(
+                    harvest_object.job.source.url, data['identifier'], mdp)
+                start = time.time()
                 f = urllib2.urlopen(resource_url)
                 x = f.read()
-                fileurl = pylons.configuration.config['ckan.site_url'] + pylons.configuration.config['ckan.api_url'] + h.url_for('storage_file', label=label) #quick fix for ckan in non-root url 
-                data['package_xml_save'][mdp] = {
-                    'label': label,
-                    'xml': x
-                }
-                data['package_resource'][mdp] = {
-                    'url': fileurl,
-                    'description': 'Original ' + mdp + ' metadata record',
-                    'format': 'xml',
-                    'size': len(x)
-                }
+                metrics.count_harvest_request(time.time() - start, len(x))
+                self._add_original_record(data, mdp, x)
             except (urllib2.HTTPError, urllib2.URLError):
                 self._add_retry(harvest_object)
                 self._save_object_error('Could not get original metadata record!',
@@ -566,7 +898,42 @@ class OAIPMHHarvester(HarvesterBase):
                     return False
                 else: continue
             
-        return oai_dc2ckan(data, kata_oai_dc_reader._namespaces, group, harvest_object)
+        with metrics.harvest_stage('oai_dc2ckan'):
+            result = oai_dc2ckan(data, kata_oai_dc_reader._namespaces, group, harvest_object)
+        if result:
+            metrics.count_harvest('records')
+        return result
+    def _add_set_members(self, group, set_name, idents, verbose=False):
+        '''Add the packages of records to the group of a set, in the
+        current revision.
+
+        :returns: the identifiers of records that have no package
+        '''
+        subg_name = '%s - %s' % (group.name, set_name)
+        subgroup = Group.by_name(subg_name)
+        if not subgroup:
+            subgroup = Group(name=subg_name, description=subg_name)
+            setup_default_user_roles(subgroup)
+            subgroup.save()
+        missed = []
+        for ident in idents:
+            pkg_name = self._package_name_from_identifier(ident)
+            # Package may have been omitted due to missing metadata.
+            pkg = Package.get(pkg_name)
+            if pkg:
+                subgroup.add_package_by_name(pkg_name)
+                subgroup.save()
+                if verbose:
+                    log.debug('Inserted %s into %s' % (pkg_name, subg_name))
+            else:
+                # Either omitted due to missing metadata or fetch error.
+                # In the latter case, we want to add record later once the
+                # fetch succeeds after retry.
+                missed.append(ident)
+                if verbose:
+                    log.debug('Omitted %s from %s' % (pkg_name, subg_name))
+        return missed
+    @metrics.measured_stage('fetch_import_set')
     def _fetch_import_set(self, harvest_object, master_data, client, group):
         # Could be genuine fetch or retry of set insertions.
         if 'set' in master_data:
@@ -579,7 +946,8 @@ class OAIPMHHarvester(HarvesterBase):
             ids = []
             try:
                 for identity in client.listIdentifiers(**args):
-                    ids.append(identity.identifier())
+                    if not identity.isDeleted():
+                        ids.append(identity.identifier())
             except NoRecordsMatchError:
                 pass  # Ok, empty set. Nothing to do.
             except socket.error:
@@ -598,29 +966,10 @@ class OAIPMHHarvester(HarvesterBase):
         # Do not save to DB because we can't.
         # Import stage.
         model.repo.new_revision()
-        subg_name = '%s - %s' % (group.name, master_data['set_name'])
-        subgroup = Group.by_name(subg_name)
-        if not subgroup:
-            subgroup = Group(name=subg_name, description=subg_name)
-            setup_default_user_roles(subgroup)
-            subgroup.save()
-        missed = []
-        for ident in master_data['record_ids']:
-            pkg_name = self._package_name_from_identifier(ident)
-            # Package may have been omitted due to missing metadata.
-            pkg = Package.get(pkg_name)
-            if pkg:
-                subgroup.add_package_by_name(pkg_name)
-                subgroup.save()
-                if 'set' not in master_data:
-                    log.debug('Inserted %s into %s' % (pkg_name, subg_name))
-            else:
-                # Either omitted due to missing metadata or fetch error.
-                # In the latter case, we want to add record later once the
-                # fetch succeeds after retry.
-                missed.append(ident)
-                if 'set' not in master_data:
-                    log.debug('Omitted %s from %s' % (pkg_name, subg_name))
+        missed = self._add_set_members(group, master_data['set_name'],
+                                       master_data['record_ids'],
+                                       'set' not in master_data)
+        inserted = len(master_data['record_ids']) - len(missed)
         if len(missed):
             # Store missing names for retry.
             master_data['record_ids'] = missed
@@ -632,4 +981,5 @@ class OAIPMHHarvester(HarvesterBase):
         else:
             harvest_object.content = None  # Clear data.
         model.repo.commit()
+        metrics.count_harvest('records', inserted)
         return True
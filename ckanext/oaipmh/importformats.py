@@ -1,6 +1,9 @@
 # coding: utf-8
 # vi:et:ts=8:
 
+import UserDict
+import functools
+
 import oaipmh.common
 import oaipmh.metadata
 import lxml.etree
@@ -44,19 +47,116 @@ def copy_element(source, dest, md, callback = None):
                 dest_n = '%s.%d' % (dest, i)
                 copy_element(source_n, dest_n, md, callback)
 
+def key_root(key):
+        '''return the top-level element name of a metadata key
+
+        :param key: a metadata key, e.g. "creator.0/name.0"
+        :type key: string
+        :returns: the name before the first index or slash, e.g. "creator"
+        :rtype: string
+        '''
+        return key.split('/', 1)[0].split('.', 1)[0]
+
+class LazyMetadataMap(UserDict.DictMixin, object):
+        '''metadata dictionary that copies mapped elements on first access
+
+        The readers in this module pick central elements of a flat
+        metadata dictionary into format-independent keys.  Instead of
+        copying all of them up front, this dictionary keeps the copy
+        operations keyed by the top-level name of their destination
+        and runs them only when a key under that name is first looked
+        up.  Copied values are stored in the dictionary, so every copy
+        operation runs at most once per record.  Listing the keys of
+        the dictionary materializes everything that is still pending.
+        '''
+        def __init__(self, md):
+                self._map = dict(md)
+                self._pending = {}
+                self._done = set()
+
+        def defer(self, dests, func):
+                '''register a copy operation for some destination keys
+
+                :param dests: keys (or their top-level names) that func
+                        fills in
+                :type dests: list of strings
+                :param func: operation to call on first access
+                :type func: function of () -> None
+                '''
+                for dest in dests:
+                        self._pending.setdefault(key_root(dest), []).append(func)
+
+        def _run(self, func):
+                if func in self._done: return
+                self._done.add(func)
+                func()
+
+        def _resolve(self, key):
+                for func in self._pending.pop(key_root(key), ()):
+                        self._run(func)
+
+        def _resolve_all(self):
+                while self._pending:
+                        _, funcs = self._pending.popitem()
+                        for func in funcs: self._run(func)
+
+        def __getitem__(self, key):
+                self._resolve(key)
+                return self._map[key]
+
+        def __setitem__(self, key, value):
+                self._map[key] = value
+
+        def __delitem__(self, key):
+                self._resolve(key)
+                del self._map[key]
+
+        def __contains__(self, key):
+                self._resolve(key)
+                return key in self._map
+
+        has_key = __contains__
+
+        def __iter__(self):
+                self._resolve_all()
+                return iter(self._map)
+
+        def __len__(self):
+                self._resolve_all()
+                return len(self._map)
+
+        def keys(self):
+                self._resolve_all()
+                return self._map.keys()
+
+        def iteritems(self):
+                self._resolve_all()
+                return self._map.iteritems()
+
+        def copy(self):
+                '''return a plain dictionary with all keys materialized'''
+                self._resolve_all()
+                return dict(self._map)
+
+        def __reduce__(self):
+                return (dict, (self.copy(),))
+
+        def __repr__(self):
+                return repr(self.copy())
+
 def nrd_metadata_reader(xml):
         '''read metadata in NRD schema
 
         This function takes NRD metadata as an lxml.etree.Element object,
         and returns the same metadata as a dictionary, with central TTA
-        elements picked to format-independent keys.
+        elements picked to format-independent keys on first access.
 
         :param xml: RDF metadata as XML-encoded NRD
         :type xml: lxml.etree.Element instance
         :returns: a metadata dictionary
-        :rtype: a hash from string to any value
+        :rtype: LazyMetadataMap instance
         '''
-        result = rdf_reader(xml).getMap()
+        result = LazyMetadataMap(rdf_reader(xml).getMap())
 
         def person_attrs(source, dest):
                 '''callback for copying person attributes'''
@@ -123,16 +223,21 @@ def nrd_metadata_reader(xml):
                 (u'dataset/dct:description', u'description', None),
         ]
         for source, dest, callback in mapping:
-                copy_element(source, dest, result, callback)
-        try:
-                rights = lxml.etree.XML(result[u'rights'])
-                rightsclass = rights.attrib['RIGHTSCATEGORY'].lower()
-                result[u'rightsclass'] = rightsclass
-                if rightsclass == 'licensed':
-                        result[u'license'] = rights[0].text
-                if rightsclass == 'contractual':
-                        result[u'accessURL'] = rights[0].text
-        except: pass
+                result.defer([dest], functools.partial(copy_element,
+                                source, dest, result, callback))
+
+        def rights_attrs():
+                '''derive license information from rights declaration'''
+                try:
+                        rights = lxml.etree.XML(result[u'rights'])
+                        rightsclass = rights.attrib['RIGHTSCATEGORY'].lower()
+                        result[u'rightsclass'] = rightsclass
+                        if rightsclass == 'licensed':
+                                result[u'license'] = rights[0].text
+                        if rightsclass == 'contractual':
+                                result[u'accessURL'] = rights[0].text
+                except: pass
+        result.defer([u'rightsclass', u'license', u'accessURL'], rights_attrs)
         return oaipmh.common.Metadata(result)
 
 def dc_metadata_reader(xml):
@@ -140,14 +245,26 @@ def dc_metadata_reader(xml):
 
         This function takes oai_dc metadata as an lxml.etree.Element
         object, and returns the same metadata as a dictionary, with
-        central TTA elements picked to format-independent keys.
+        central TTA elements picked to format-independent keys on first
+        access.
 
         :param xml: oai_dc metadata
         :type xml: lxml.etree.Element instance
         :returns: a metadata dictionary
-        :rtype: a hash from string to any value
+        :rtype: LazyMetadataMap instance
         '''
-        result = xml_reader(xml).getMap()
+        result = LazyMetadataMap(xml_reader(xml).getMap())
+
+        def copy_dc(source, dest):
+                '''copy all occurrences of a Dublin Core element'''
+                count = result.get('metadata/oai_dc:dc.0/%s.count' % source, 0)
+                result[dest[:dest.index('.%d')] + '.count'] = count
+                for i in range(count):
+                        source_n = 'metadata/oai_dc:dc.0/%s.%d' % (source, i)
+                        copy_element(source_n, dest % i, result)
+                        if dest.endswith('.0'):
+                                result[dest[:-2] % i + '.count'] = 1
+
         mapping = [(u'dc:title', u'title.%d'),
                 (u'dc:identifier', u'versionidentifier.%d'),
                 (u'dc:creator', u'creator.%d/name.0'),
@@ -161,13 +278,7 @@ def dc_metadata_reader(xml):
                 (u'dc:source', u'continuityidentifier.%d'),
         ]
         for source, dest in mapping:
-                count = result.get('metadata/oai_dc:dc.0/%s.count' % source, 0)
-                result[dest[:dest.index('.%d')] + '.count'] = count
-                for i in range(count):
-                        source_n = 'metadata/oai_dc:dc.0/%s.%d' % (source, i)
-                        copy_element(source_n, dest % i, result)
-                        if dest.endswith('.0'):
-                                result[dest[:-2] % i + '.count'] = 1
+                result.defer([dest], functools.partial(copy_dc, source, dest))
         return oaipmh.common.Metadata(result)
 
 def create_metadata_registry():
@@ -0,0 +1,149 @@
+# coding: utf-8
+# vi:et:ts=8:
+'''Parsing of OAI-PMH records in a pool of worker processes.
+
+Reading a record with the importformats readers is pure CPU work,
+especially for RDF which goes through rdflib.  A ParsePool takes the raw
+XML of <record> elements, runs the metadata reader for the requested
+metadataPrefix in worker processes and hands back the record headers and
+plain metadata dictionaries, so the process that writes to the database
+only has to deal with the results.
+
+The export of bulkimport uses the pool.  The readers of the CKAN load
+paths, the harvester and "paster oaipmh import", keep lxml elements in
+the metadata, which can not be pickled, so they read in their own
+process with processes=0.
+'''
+
+import collections
+import itertools
+import multiprocessing
+
+import lxml.etree
+import oaipmh.client
+
+import importformats
+
+namespaces = {'oai': 'http://www.openarchives.org/OAI/2.0/'}
+
+_registry = None
+
+def _init_worker():
+        '''build the metadata registry once per worker process'''
+        global _registry
+        _registry = importformats.create_metadata_registry()
+
+def parse_record(xml, prefix, keys=None, registry=None):
+        '''read a raw OAI-PMH record into a header and a metadata map
+
+        :param xml: the XML text of a <record> element
+        :type xml: string
+        :param prefix: metadataPrefix of the record
+        :type prefix: string
+        :param keys: if given, only these metadata keys are returned;
+                with the lazy importformats readers nothing else is
+                even computed
+        :type keys: list of strings
+        :param registry: metadata registry with a reader for prefix
+        :type registry: oaipmh.metadata.MetadataRegistry instance
+        :returns: the record header and its metadata, or None for
+                records without metadata (e.g. deleted ones)
+        :rtype: (oaipmh.common.Header, dict) pair
+        '''
+        if registry is None:
+                if _registry is None: _init_worker()
+                registry = _registry
+        if isinstance(xml, unicode): xml = xml.encode('utf-8')
+        record = lxml.etree.XML(xml)
+        header = oaipmh.client.buildHeader(
+                        record.xpath('oai:header', namespaces=namespaces)[0],
+                        namespaces)
+        metadata = record.xpath('oai:metadata', namespaces=namespaces)
+        if not metadata:
+                return header, None
+        md = registry.readMetadata(prefix, metadata[0]).getMap()
+        if keys is None:
+                return header, dict(md.items())
+        return header, dict((key, md[key]) for key in keys if key in md)
+
+def _parse_chunk(args):
+        xmls, prefix, keys = args
+        return [parse_record(xml, prefix, keys) for xml in xmls]
+
+class ParsePool(object):
+        '''a pool of processes reading OAI-PMH records
+
+        Records are sent to the workers in chunks and the results are
+        returned in input order.  At most a few chunks per worker are in
+        flight at a time, so a long stream of records is never read
+        ahead further than that.  With processes=0 the records are read
+        in the calling process, which keeps the interface the same when
+        the pool is turned off.
+
+        :param prefix: metadataPrefix of the records
+        :type prefix: string
+        :param processes: number of worker processes, None for one per
+                CPU, 0 for no pool at all
+        :type processes: integer
+        :param keys: metadata keys to return, None for all
+        :type keys: list of strings
+        :param chunksize: records sent to a worker at a time
+        :type chunksize: integer
+        '''
+        def __init__(self, prefix, processes=None, keys=None, chunksize=16):
+                self.prefix = prefix
+                self.keys = keys
+                self.chunksize = chunksize
+                if processes is None:
+                        processes = multiprocessing.cpu_count()
+                self.processes = processes
+                self._pool = None
+                if processes:
+                        self._pool = multiprocessing.Pool(processes,
+                                        initializer=_init_worker)
+
+        def imap(self, records):
+                '''read records, yielding (header, metadata) pairs
+
+                :param records: XML texts of <record> elements
+                :type records: iterable of strings
+                :returns: headers and metadata dictionaries in input order
+                :rtype: iterator of (oaipmh.common.Header, dict) pairs
+                '''
+                records = iter(records)
+                def chunks():
+                        while True:
+                                chunk = list(itertools.islice(records,
+                                                self.chunksize))
+                                if not chunk: return
+                                yield (chunk, self.prefix, self.keys)
+                if self._pool is None:
+                        for chunk in chunks():
+                                for result in _parse_chunk(chunk):
+                                        yield result
+                        return
+                pending = collections.deque()
+                for chunk in chunks():
+                        pending.append(self._pool.apply_async(_parse_chunk,
+                                        (chunk,)))
+                        if len(pending) >= 2 * self.processes:
+                                for result in pending.popleft().get():
+                                        yield result
+                while pending:
+                        for result in pending.popleft().get():
+                                yield result
+
+        def close(self):
+                '''stop the worker processes'''
+                if self._pool is not None:
+                        self._pool.close()
+                        self._pool.join()
+                        self._pool = None
+
+        def __enter__(self):
+                return self
+
+        def __exit__(self, *exc_info):
+                if exc_info[0] is not None and self._pool is not None:
+                        self._pool.terminate()
+                self.close()
@@ -0,0 +1,604 @@
+'''Latency and volume metrics of the OAI-PMH interface.
+
+Every request is timed from the start of the controller action to the
+last byte of the response, so streamed responses are measured whole.
+The number of items (records, headers or sets) in the response, the
+bytes sent and the database queries made are counted along the way,
+and all are kept per verb, metadataPrefix and set in histograms and
+counters. They are rendered in the Prometheus text format, and are per
+process.
+
+The stages of harvest jobs are measured likewise: wall time, HTTP
+requests with their latency and bytes downloaded, records handled,
+database queries with their time, retries and errors, per source and
+stage, and per job for the latest jobs. Harvest stages run in the
+harvester's consumer processes, so their metrics are logged and can be
+written to a file for the Prometheus textfile collector.
+'''
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import logging
+
+log = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+ITEMS_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+VERBS = ('GetRecord', 'Identify', 'ListIdentifiers', 'ListMetadataFormats',
+         'ListRecords', 'ListSets')
+# Label values come from requests, so there may be any number of them.
+# Prefixes and sets beyond these many get the label value 'other'.
+MAX_PREFIXES = 20
+MAX_SETS = 100
+HARVEST_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0,
+                           300.0, 900.0, 3600.0, 14400.0)
+HARVEST_STAGES = ('gather', 'import', 'fetch_import_record',
+                  'fetch_import_set', 'oai_dc2ckan')
+# Sources beyond these many get the label value 'other'; jobs beyond
+# these many are forgotten, oldest first.
+MAX_SOURCES = 100
+MAX_JOBS = 20
+# Least number of seconds between two writes of the metrics file.
+WRITE_INTERVAL = 10
+
+_current = threading.local()
+# Stages are counted in by the threads that work for them, too.
+_count_lock = threading.Lock()
+
+
+class Histogram(object):
+    '''Counts of observations by upper bound, with their sum.'''
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound,
+                                                     total))
+        lines.append('%s_sum{%s} %s' % (name, labels.rstrip(','),
+                                         repr(self.sum)))
+        lines.append('%s_count{%s} %d' % (name, labels.rstrip(','), total))
+        return lines
+
+
+class RequestMetrics(object):
+    '''What is measured of one request.'''
+    def __init__(self, verb, metadata_prefix=None, set=None):
+        self.verb = verb
+        self.metadata_prefix = metadata_prefix
+        self.set = set
+        self.start = time.time()
+        self.items = 0
+        self.bytes = 0
+        self.queries = 0
+
+
+class Registry(object):
+    '''The metrics of all requests, by (verb, metadataPrefix, set).'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._prefixes = set()
+        self._sets = set()
+
+    def _label(self, value, seen, limit):
+        if not value or value in seen:
+            return value or ''
+        if len(seen) < limit:
+            seen.add(value)
+            return value
+        return 'other'
+
+    def observe(self, request):
+        with self._lock:
+            key = (request.verb if request.verb in VERBS else 'other',
+                   self._label(request.metadata_prefix, self._prefixes,
+                               MAX_PREFIXES),
+                   self._label(request.set, self._sets, MAX_SETS))
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    'seconds': Histogram(SECONDS_BUCKETS),
+                    'items': Histogram(ITEMS_BUCKETS),
+                    'queries': Histogram(QUERIES_BUCKETS),
+                    'bytes': 0,
+                }
+            series['seconds'].observe(time.time() - request.start)
+            series['items'].observe(request.items)
+            series['queries'].observe(request.queries)
+            series['bytes'] += request.bytes
+
+    def snapshot(self):
+        '''Return the metrics as a dict by (verb, metadataPrefix, set).
+
+        :returns: request count, total seconds, items, queries and bytes
+            of every series
+        :rtype: dict of dicts
+        '''
+        with self._lock:
+            return dict((key, {'requests': sum(series['seconds'].counts),
+                               'seconds': series['seconds'].sum,
+                               'items': series['items'].sum,
+                               'queries': series['queries'].sum,
+                               'bytes': series['bytes']})
+                        for key, series in self._series.items())
+
+    def render(self):
+        '''Return the metrics in the Prometheus text format.'''
+        names = [('seconds', 'oaipmh_request_seconds',
+                  'Time from request to the last byte of the response.'),
+                 ('items', 'oaipmh_response_items',
+                  'Records, headers or sets in a response.'),
+                 ('queries', 'oaipmh_request_db_queries',
+                  'Database queries made for a request.')]
+        lines = []
+        with self._lock:
+            series = sorted(self._series.items())
+            for field, name, help in names:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s histogram' % name)
+                for key, values in series:
+                    lines.extend(values[field].render(name, _labels(key)))
+            lines.append('# HELP oaipmh_response_bytes_total Bytes sent '
+                         'in response bodies.')
+            lines.append('# TYPE oaipmh_response_bytes_total counter')
+            for key, values in series:
+                lines.append('oaipmh_response_bytes_total{%s} %d' % (
+                    _labels(key).rstrip(','), values['bytes']))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(key):
+    verb, metadata_prefix, set = key
+    return 'verb="%s",prefix="%s",set="%s",' % tuple(
+        _escape(value) for value in (verb, metadata_prefix, set))
+
+
+registry = Registry()
+
+
+def start_request(verb, metadata_prefix=None, set=None):
+    '''Start measuring a request in this thread.
+
+    :returns: the metrics of the request
+    :rtype: RequestMetrics
+    '''
+    request = RequestMetrics(verb, metadata_prefix, set)
+    _current.request = request
+    return request
+
+
+def finish_request(request):
+    '''Stop measuring a request and add it to the registry.'''
+    if getattr(_current, 'request', None) is request:
+        _current.request = None
+    registry.observe(request)
+
+
+def count_items(count):
+    '''Add items to the response of the request of this thread.'''
+    request = getattr(_current, 'request', None)
+    if request is not None:
+        request.items += count
+
+
+def measure(request, body):
+    '''Finish a request when its response body has been sent.
+
+    A string is counted at once. An iterable is wrapped so that the
+    request is finished after its last part, or when it is closed.
+
+    :returns: the body to return to the client
+    '''
+    if isinstance(body, basestring):
+        request.bytes += len(body)
+        finish_request(request)
+        return body
+    return _measured(request, body)
+
+
+def _measured(request, body):
+    _current.request = request
+    try:
+        for part in body:
+            request.bytes += len(part)
+            yield part
+    finally:
+        finish_request(request)
+
+
+class StageMetrics(object):
+    '''What is measured of one run of a harvest stage.'''
+    def __init__(self, stage, source, job):
+        self.stage = stage
+        self.source = source
+        self.job = job
+        self.start = time.time()
+        self.seconds = 0.0
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.bytes = 0
+        self.records = 0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.retries = 0
+        self.errors = 0
+
+    def summary(self):
+        '''Return the measurements as a dict, with records per second.'''
+        summary = dict((field, getattr(self, field))
+                       for field in ('stage', 'source', 'job')
+                       + HarvestRegistry.COUNTERS)
+        summary['seconds'] = self.seconds
+        summary['records_per_second'] = self.records / self.seconds \
+            if self.seconds else 0.0
+        return summary
+
+
+class HarvestRegistry(object):
+    '''The metrics of harvest stages, by (source, stage) and by job.'''
+    COUNTERS = ('requests', 'request_seconds', 'bytes', 'records',
+                'queries', 'db_seconds', 'retries', 'errors')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._request_seconds = {}
+        self._sources = set()
+        self._jobs = OrderedDict()
+        self._written = 0
+
+    def _source(self, source):
+        source = source or ''
+        if source in self._sources or len(self._sources) < MAX_SOURCES:
+            self._sources.add(source)
+            return source
+        return 'other'
+
+    def observe(self, stage):
+        with self._lock:
+            key = (self._source(stage.source), stage.stage)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = dict.fromkeys(self.COUNTERS, 0)
+                series['seconds'] = Histogram(HARVEST_SECONDS_BUCKETS)
+            series['seconds'].observe(stage.seconds)
+            for field in self.COUNTERS:
+                series[field] += getattr(stage, field)
+            if stage.job:
+                job = self._jobs.pop(stage.job, None) or {}
+                self._jobs[stage.job] = job
+                while len(self._jobs) > MAX_JOBS:
+                    self._jobs.popitem(last=False)
+                totals = job.get(stage.stage)
+                if totals is None:
+                    totals = job[stage.stage] = dict.fromkeys(
+                        self.COUNTERS + ('runs', 'seconds'), 0)
+                    totals['source'] = stage.source
+                totals['runs'] += 1
+                totals['seconds'] += stage.seconds
+                for field in self.COUNTERS:
+                    totals[field] += getattr(stage, field)
+
+    def observe_request(self, source, seconds):
+        '''Add the latency of an HTTP request to a source.'''
+        with self._lock:
+            source = self._source(source)
+            histogram = self._request_seconds.get(source)
+            if histogram is None:
+                histogram = self._request_seconds[source] = \
+                    Histogram(SECONDS_BUCKETS)
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        '''Return the metrics as a dict by (source, stage).
+
+        :returns: runs, total seconds and the counters of every series
+        :rtype: dict of dicts
+        '''
+        with self._lock:
+            snapshot = {}
+            for key, series in self._series.items():
+                values = dict((field, series[field])
+                              for field in self.COUNTERS)
+                values['runs'] = sum(series['seconds'].counts)
+                values['seconds'] = series['seconds'].sum
+                snapshot[key] = values
+            return snapshot
+
+    def job(self, job):
+        '''Return the totals of a recent job by stage, or None.
+
+        :returns: runs, seconds, records per second and the counters of
+            every stage run in the job
+        :rtype: dict of dicts
+        '''
+        with self._lock:
+            stages = self._jobs.get(job)
+            if stages is None:
+                return None
+            result = {}
+            for stage, totals in stages.items():
+                totals = dict(totals)
+                totals['records_per_second'] = \
+                    totals['records'] / totals['seconds'] \
+                    if totals['seconds'] else 0.0
+                result[stage] = totals
+            return result
+
+    def render(self, labels=''):
+        '''Return the metrics in the Prometheus text format.
+
+        :param labels: labels added to every sample, like 'pid="1",'
+        :type labels: string
+        '''
+        names = [('requests', 'oaipmh_harvest_requests_total',
+                  'HTTP requests made to the source.'),
+                 ('request_seconds', 'oaipmh_harvest_request_seconds_total',
+                  'Time spent in HTTP requests to the source.'),
+                 ('bytes', 'oaipmh_harvest_bytes_total',
+                  'Bytes downloaded from the source.'),
+                 ('records', 'oaipmh_harvest_records_total',
+                  'Records gathered or imported.'),
+                 ('queries', 'oaipmh_harvest_db_queries_total',
+                  'Database queries made.'),
+                 ('db_seconds', 'oaipmh_harvest_db_seconds_total',
+                  'Time spent in database queries.'),
+                 ('retries', 'oaipmh_harvest_retries_total',
+                  'Harvest objects marked for retry.'),
+                 ('errors', 'oaipmh_harvest_errors_total',
+                  'Errors saved or raised in stages.')]
+        lines = ['# HELP oaipmh_harvest_stage_seconds Wall time of '
+                 'harvest stages.',
+                 '# TYPE oaipmh_harvest_stage_seconds histogram']
+        with self._lock:
+            series = sorted(self._series.items())
+            for key, values in series:
+                lines.extend(values['seconds'].render(
+                    'oaipmh_harvest_stage_seconds',
+                    labels + _stage_labels(key)))
+            for field, name, help in names:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s counter' % name)
+                for key, values in series:
+                    lines.append('%s{%s} %s' % (
+                        name, (labels + _stage_labels(key)).rstrip(','),
+                        repr(values[field])))
+            lines.append('# HELP oaipmh_harvest_http_seconds Latency of '
+                         'HTTP requests to sources.')
+            lines.append('# TYPE oaipmh_harvest_http_seconds histogram')
+            for source, histogram in sorted(self._request_seconds.items()):
+                lines.extend(histogram.render(
+                    'oaipmh_harvest_http_seconds',
+                    labels + 'source="%s",' % _escape(source)))
+            for field, name, help in names:
+                name = name.replace('oaipmh_harvest_', 'oaipmh_harvest_job_')
+                lines.append('# HELP %s %s' % (name, help + ' By job.'))
+                lines.append('# TYPE %s counter' % name)
+                for job, stages in self._jobs.items():
+                    for stage, totals in sorted(stages.items()):
+                        lines.append('%s{%s} %s' % (
+                            name, (labels + _stage_labels(
+                                (totals['source'] or '', stage)) +
+                                'job="%s",' % _escape(job)).rstrip(','),
+                            repr(totals[field])))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory, force=False):
+        '''Write the metrics of this process for the textfile collector.
+
+        The file is replaced atomically, at most once in WRITE_INTERVAL
+        seconds unless forced. Samples are labelled with the process id,
+        since every harvester process writes a file of its own.
+        '''
+        now = time.time()
+        if not force and now - self._written < WRITE_INTERVAL:
+            return
+        self._written = now
+        pid = os.getpid()
+        path = os.path.join(directory, 'oaipmh_harvest_%d.prom' % pid)
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write(self.render('pid="%d",' % pid))
+        os.rename(path + '.tmp', path)
+
+
+def _stage_labels(key):
+    source, stage = key
+    return 'source="%s",stage="%s",' % (_escape(source), _escape(stage))
+
+
+harvest_registry = HarvestRegistry()
+
+
+def _stages():
+    stages = getattr(_current, 'stages', None)
+    if stages is None:
+        stages = _current.stages = []
+    return stages
+
+
+@contextmanager
+def harvest_stage(stage, source=None, job=None):
+    '''Measure a harvest stage run in this thread.
+
+    Stages may be nested; what is counted in an inner stage is counted
+    in the outer ones too. The source and job default to those of the
+    enclosing stage. An exception out of the stage counts as an error.
+
+    :param stage: one of HARVEST_STAGES
+    :param source: URL of the harvest source
+    :param job: id of the harvest job
+    :returns: the metrics of the stage run
+    :rtype: StageMetrics
+    '''
+    stages = _stages()
+    if stages:
+        source = source or stages[-1].source
+        job = job or stages[-1].job
+    metrics = StageMetrics(stage, source, job)
+    stages.append(metrics)
+    try:
+        yield metrics
+    except Exception:
+        metrics.errors += 1
+        raise
+    finally:
+        stages.remove(metrics)
+        metrics.seconds = time.time() - metrics.start
+        harvest_registry.observe(metrics)
+        log.debug('Harvest stage %s' % json.dumps(metrics.summary()))
+
+
+def measured_stage(stage):
+    '''Decorate a function to run as a harvest stage.
+
+    The source and job are those of the enclosing stage.
+    '''
+    def decorate(function):
+        @functools.wraps(function)
+        def measured(*args, **kw):
+            with harvest_stage(stage):
+                return function(*args, **kw)
+        return measured
+    return decorate
+
+
+def in_current_stages(function):
+    '''Return a function that runs in the harvest stages of this thread.
+
+    What the function counts is counted in these stages, from whatever
+    thread it is called, as long as the stages are running.
+    '''
+    stages = list(_stages())
+
+    @functools.wraps(function)
+    def counted(*args, **kw):
+        previous = getattr(_current, 'stages', None)
+        _current.stages = list(stages)
+        try:
+            return function(*args, **kw)
+        finally:
+            _current.stages = previous
+    return counted
+
+
+def count_harvest(field, amount=1):
+    '''Add to a counter of the harvest stages running in this thread.
+
+    :param field: one of HarvestRegistry.COUNTERS
+    '''
+    with _count_lock:
+        for stage in getattr(_current, 'stages', None) or ():
+            setattr(stage, field, getattr(stage, field) + amount)
+
+
+def count_harvest_request(seconds, size=0):
+    '''Add an HTTP request to the harvest stages running in this thread.
+
+    :param seconds: time until the response, or the whole of it if read
+    :param size: bytes downloaded
+    '''
+    stages = getattr(_current, 'stages', None)
+    if not stages:
+        return
+    with _count_lock:
+        for stage in stages:
+            stage.requests += 1
+            stage.request_seconds += seconds
+            stage.bytes += size
+    harvest_registry.observe_request(stages[0].source, seconds)
+
+
+class _CountedResponse(object):
+    '''A response of which the bytes read are counted as downloaded.'''
+    def __init__(self, response):
+        self._response = response
+
+    def read(self, size=-1):
+        data = self._response.read(size)
+        count_harvest('bytes', len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+def instrument_client(client):
+    '''Count the HTTP requests of an OAI-PMH client in harvest stages.
+
+    :param client: a pyoai client, or a streaming.StreamingClient
+    :returns: the client
+    '''
+    make_request = client.makeRequest
+
+    def timed_request(**kw):
+        start = time.time()
+        text = make_request(**kw)
+        count_harvest_request(time.time() - start, len(text))
+        return text
+    client.makeRequest = timed_request
+    open_response = getattr(client, '_open', None)
+    if open_response is not None:
+        # Streamed pages are timed to the response headers, and their
+        # bytes counted as they are parsed.
+        def timed_open(args):
+            start = time.time()
+            response = open_response(args)
+            count_harvest_request(time.time() - start)
+            return _CountedResponse(response)
+        client._open = timed_open
+    return client
+
+
+def _before_query(*args, **kw):
+    request = getattr(_current, 'request', None)
+    if request is not None:
+        request.queries += 1
+    if getattr(_current, 'stages', None):
+        _current.query_start = time.time()
+
+
+def _after_query(*args, **kw):
+    start = getattr(_current, 'query_start', None)
+    if start is None:
+        return
+    _current.query_start = None
+    seconds = time.time() - start
+    with _count_lock:
+        for stage in getattr(_current, 'stages', None) or ():
+            stage.queries += 1
+            stage.db_seconds += seconds
+
+
+try:
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+except ImportError:
+    # SQLAlchemy before 0.7 has no events; queries are not counted.
+    log.debug('Database queries of OAI-PMH requests and harvest stages '
+              'are not counted')
+else:
+    event.listen(Engine, 'before_cursor_execute', _before_query)
+    event.listen(Engine, 'after_cursor_execute', _after_query)
@@ -0,0 +1,225 @@
+'''Database tables of the OAI-PMH interface.
+'''
+import logging
+from datetime import datetime
+
+from sqlalchemy import Table, Column, Index, types, and_, select
+from sqlalchemy.exc import IntegrityError
+
+from ckan import model
+from ckan.model.meta import metadata, mapper, Session
+from ckan.model.domain_object import DomainObject
+
+log = logging.getLogger(__name__)
+
+__all__ = ['PackageDatestamp', 'package_datestamp_table', 'setup',
+           'touch_package', 'record_cache_table', 'get_record_fragments',
+           'store_record_fragments', 'clear_record_fragments',
+           'PackageTombstone', 'package_tombstone_table', 'bury_package',
+           'tombstone_set_table']
+
+package_datestamp_table = None
+record_cache_table = None
+package_tombstone_table = None
+tombstone_set_table = None
+
+
+class PackageDatestamp(DomainObject):
+    '''Time of the latest modification of a package.
+
+    This is the datestamp of the package in OAI-PMH responses. It is kept
+    in a table of its own, indexed on (datestamp, package_id), so that
+    selective harvesting by date and paging through the records in
+    datestamp order are index range scans.
+    '''
+    pass
+
+
+class PackageTombstone(DomainObject):
+    '''A package that has been purged from the database.
+
+    Deleted packages are shown as deleted records while they are in the
+    database with state deleted. Purged ones are shown from here, with
+    the time of the purge as datestamp, so that harvesters still learn
+    about the deletion. The sets of the package at the time of the purge
+    are kept in tombstone_set_table, so that the deletion is also seen
+    by harvesters of those sets.
+    '''
+    pass
+
+
+def define_tables():
+    global package_datestamp_table, record_cache_table, \
+        package_tombstone_table, tombstone_set_table
+    package_datestamp_table = Table('oaipmh_package_datestamp', metadata,
+        Column('package_id', types.UnicodeText, primary_key=True),
+        Column('datestamp', types.DateTime, nullable=False),
+        Index('idx_oaipmh_package_datestamp', 'datestamp', 'package_id'),
+    )
+    # Serialized <metadata> elements of records, by package and
+    # metadataPrefix, valid while the package has the same datestamp.
+    record_cache_table = Table('oaipmh_record_cache', metadata,
+        Column('package_id', types.UnicodeText, primary_key=True),
+        Column('metadata_prefix', types.UnicodeText, primary_key=True),
+        Column('datestamp', types.DateTime, nullable=False),
+        Column('xml', types.UnicodeText, nullable=False),
+        # The xml in UTF-8, compressed with compression.deflate.
+        Column('deflated', types.LargeBinary),
+    )
+    package_tombstone_table = Table('oaipmh_package_tombstone', metadata,
+        Column('package_id', types.UnicodeText, primary_key=True),
+        Column('package_name', types.UnicodeText, nullable=False),
+        Column('datestamp', types.DateTime, nullable=False),
+        Index('idx_oaipmh_package_tombstone', 'datestamp', 'package_id'),
+    )
+    # setSpecs, that is group ids, of purged packages.
+    tombstone_set_table = Table('oaipmh_tombstone_set', metadata,
+        Column('package_id', types.UnicodeText, primary_key=True),
+        Column('set_spec', types.UnicodeText, primary_key=True),
+        Index('idx_oaipmh_tombstone_set', 'set_spec', 'package_id'),
+    )
+    mapper(PackageDatestamp, package_datestamp_table)
+    mapper(PackageTombstone, package_tombstone_table)
+
+
+def setup():
+    '''Create the tables if needed and fill in missing datestamps.
+    '''
+    if package_datestamp_table is None:
+        define_tables()
+        log.debug('OAI-PMH tables defined in memory')
+    if model.package_table.exists():
+        for table in (package_datestamp_table, record_cache_table,
+                      package_tombstone_table, tombstone_set_table):
+            if not table.exists():
+                table.create()
+                log.debug('OAI-PMH table %s created' % table.name)
+        populate()
+    else:
+        log.debug('OAI-PMH table creation deferred')
+
+
+def populate():
+    '''Add datestamps of packages that have none, from their revisions.
+
+    This covers packages that existed before the table was created or
+    that were written while the plugin was not loaded.
+    '''
+    result = Session.execute(
+        'INSERT INTO oaipmh_package_datestamp (package_id, datestamp) '
+        'SELECT package.id, revision.timestamp FROM package '
+        'JOIN revision ON package.revision_id = revision.id '
+        'WHERE NOT EXISTS (SELECT 1 FROM oaipmh_package_datestamp d '
+        'WHERE d.package_id = package.id)')
+    Session.commit()
+    if result.rowcount:
+        log.info('Added OAI-PMH datestamps of %i packages' % result.rowcount)
+
+
+def touch_package(package, datestamp=None):
+    '''Set the datestamp of a package to the time of its latest revision.
+
+    Called on package writes, in the same transaction.
+    '''
+    if datestamp is None:
+        revision = getattr(package, 'revision', None)
+        datestamp = revision.timestamp if revision and revision.timestamp \
+            else datetime.utcnow()
+    stamp = Session.query(PackageDatestamp).get(package.id)
+    if stamp is None:
+        stamp = PackageDatestamp()
+        stamp.package_id = package.id
+        Session.add(stamp)
+    stamp.datestamp = datestamp
+    tombstone = Session.query(PackageTombstone).get(package.id)
+    if tombstone is not None:
+        Session.delete(tombstone)
+        Session.execute(tombstone_set_table.delete().where(
+            tombstone_set_table.c.package_id == package.id))
+
+
+def bury_package(package, datestamp=None):
+    '''Replace the datestamp of a purged package with a tombstone.
+
+    Called on package purges, in the same transaction. The groups of the
+    package are read from its memberships, which are left in place by
+    the purge.
+    '''
+    tombstone = Session.query(PackageTombstone).get(package.id)
+    if tombstone is None:
+        tombstone = PackageTombstone()
+        tombstone.package_id = package.id
+        Session.add(tombstone)
+    tombstone.package_name = package.name
+    tombstone.datestamp = datestamp or datetime.utcnow()
+    sets = tombstone_set_table
+    Session.execute(sets.delete().where(sets.c.package_id == package.id))
+    group_ids = [row[0] for row in Session.query(model.Member.group_id).
+                 filter(model.Member.table_id == package.id).
+                 filter(model.Member.table_name == 'package').
+                 filter(model.Member.state == 'active').distinct()]
+    if group_ids:
+        Session.execute(sets.insert(), [
+            {'package_id': package.id, 'set_spec': group_id}
+            for group_id in group_ids])
+    stamp = Session.query(PackageDatestamp).get(package.id)
+    if stamp is not None:
+        Session.delete(stamp)
+
+
+def get_record_fragments(package_ids, metadata_prefix):
+    '''Return the cached metadata of packages that are still current.
+
+    :returns: serialized <metadata> elements and their compressed forms
+        by package id
+    :rtype: dict of (unicode, string) pairs
+    '''
+    if not package_ids:
+        return {}
+    cache = record_cache_table
+    stamps = package_datestamp_table
+    rows = Session.execute(select(
+        [cache.c.package_id, cache.c.xml, cache.c.deflated],
+        and_(cache.c.package_id.in_(package_ids),
+             cache.c.metadata_prefix == metadata_prefix,
+             stamps.c.package_id == cache.c.package_id,
+             stamps.c.datestamp == cache.c.datestamp)))
+    return dict((row[0], (row[1], row[2] and str(row[2]))) for row in rows)
+
+
+def store_record_fragments(metadata_prefix, fragments):
+    '''Cache the metadata of records.
+
+    The cache is written on a connection and in a transaction of its
+    own, so that the session of the request, whose response is still
+    being built, is left as it is.
+
+    :param fragments: (package id, datestamp, serialized <metadata>
+        element, the same compressed) tuples
+    :type fragments: list
+    '''
+    if not fragments:
+        return
+    cache = record_cache_table
+    connection = Session.get_bind().connect()
+    transaction = connection.begin()
+    try:
+        connection.execute(cache.delete().where(and_(
+            cache.c.package_id.in_([fragment[0] for fragment in fragments]),
+            cache.c.metadata_prefix == metadata_prefix)))
+        connection.execute(cache.insert(), [
+            {'package_id': id, 'metadata_prefix': metadata_prefix,
+             'datestamp': datestamp, 'xml': xml, 'deflated': deflated}
+            for id, datestamp, xml, deflated in fragments])
+        transaction.commit()
+    except IntegrityError:
+        # Another request cached the same records first.
+        transaction.rollback()
+    finally:
+        connection.close()
+
+
+def clear_record_fragments(package_id):
+    '''Drop the cached metadata of a package, in all formats.'''
+    Session.execute(record_cache_table.delete().where(
+        record_cache_table.c.package_id == package_id))
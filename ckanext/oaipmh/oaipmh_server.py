@@ -1,17 +1,35 @@
 '''OAI-PMH implementation for CKAN datasets and groups.
 '''
 # pylint: disable=E1101,E1103
+from bisect import bisect_right
+from collections import defaultdict
 from datetime import datetime
+from itertools import islice
+import re
+from xml.sax.saxutils import escape
 
-from ckan.model import Package, Session, Group, PackageRevision
+from ckan.model import Package, Session, Group, Revision
+from ckan.model import PackageExtra, PackageRevision, PackageTag, Tag
 from ckan.lib.helpers import url_for
 
 from pylons import config
 
-from sqlalchemy import between
+from lxml import etree
+
+from sqlalchemy import and_, or_, func, literal_column, select, union_all
 
 from oaipmh.common import ResumptionOAIPMH
-from oaipmh import common
+from oaipmh import common, error
+from oaipmh.server import BatchingResumption, ServerBase, XMLTreeServer
+from oaipmh.server import NS_XSI, nsoai
+from oaipmh.server import decodeResumptionToken, encodeResumptionToken
+
+from ckanext.oaipmh.model import PackageDatestamp, PackageTombstone
+from ckanext.oaipmh.model import tombstone_set_table
+from ckanext.oaipmh.model import get_record_fragments, store_record_fragments
+from ckanext.oaipmh.compression import ENCODINGS, PartedText
+from ckanext.oaipmh.compression import PrecompressedText, deflate
+from ckanext.oaipmh.metrics import count_items
 
 import logging
 
@@ -20,7 +38,50 @@ log = logging.getLogger(__name__)
 
 class CKANServer(ResumptionOAIPMH):
     '''A OAI-PMH implementation class for CKAN.
+
+    With record_cache, records whose metadata is in the record cache are
+    returned with a RecordFragment as metadata. Only KeysetServer knows
+    how to output those.
     '''
+    def __init__(self, record_cache=False):
+        self.record_cache = record_cache
+        self._set_cache = None
+        # Responses also depend on the configuration, which may have
+        # changed since the previous process.
+        # UTC, like the revision times it is compared with.
+        self.started = datetime.utcnow().replace(microsecond=0)
+
+    def validators(self, verb, identifier=None):
+        '''Return when the response to a verb last changed, and what it
+        depends on.
+
+        Known for the verbs whose responses depend on few rows: Identify
+        and ListMetadataFormats only on the configuration, ListSets on
+        the groups, and GetRecord on the datestamp of its package. The
+        version changes whenever the response may have, also within
+        the second of the time.
+
+        :returns: the time in UTC and the version, or None if unknown
+        :rtype: (datetime, tuple) pair
+        '''
+        if verb in ('Identify', 'ListMetadataFormats'):
+            return self.started, (self.started,)
+        if verb == 'ListSets':
+            version = tuple(self._groups_version())
+            modified = version[0]
+        elif verb == 'GetRecord' and identifier:
+            modified = Session.query(PackageDatestamp.datestamp).\
+                join(Package, Package.id == PackageDatestamp.package_id).\
+                filter(or_(Package.id == identifier,
+                           Package.name == identifier)).scalar()
+            if modified is None:
+                return None
+            version = (modified,)
+        else:
+            return None
+        return (max(modified, self.started) if modified else self.started,
+                version + (self.started,))
+
     def identify(self):
         '''Return identification information for this server.
         '''
@@ -33,102 +94,219 @@ class CKANServer(ResumptionOAIPMH):
             protocolVersion="2.0",
             adminEmails=[config.get('email_to')],
             earliestDatestamp=datetime(2004, 1, 1),
-            deletedRecord='no',
+            deletedRecord='persistent',
             granularity='YYYY-MM-DD',
-            compression=['identity'])
+            compression=ENCODINGS)
 
-    def _record_for_dataset(self, dataset):
+    def _record_for_dataset(self, dataset, datestamp=None,
+                            metadata_prefix=None):
         '''Show a tuple of a header and metadata for this dataset.
         '''
-        meta = {
-                'title': [dataset.name],
-                'creator': [dataset.author] if dataset.author else None,
-                'contributor': [dataset.maintainer]
-                    if dataset.maintainer else None,
-                'identifier': [
-                    config.get('ckan.site_url') +
-                    url_for(controller="package", action='read', id=dataset.id),
-                    dataset.url if dataset.url else dataset.id],
-                'type': ['dataset'],
-                'description': [dataset.notes] if dataset.notes else None,
-                'subject': [tag.name for tag in dataset.get_tags()]
-                    if len(dataset.get_tags()) >= 1 else None,
-                'date': [dataset.metadata_created.strftime('%Y-%m-%d')]
-                    if dataset.metadata_created else None,
-                'rights': [dataset.license.title if dataset.license else '']
-                    if dataset.license else None,
-        }
-        iters = dataset.extras.items()
-        meta = dict(meta.items() + iters)
-        metadata = {}
-        # Fixes the bug on having a large dataset being scrambled to individual
-        # letters
-        for key, value in meta.items():
-            if not isinstance(value, list):
-                metadata[str(key)] = [value]
-            else:
-                metadata[str(key)] = value
-        return (common.Header(dataset.id,
-                              dataset.metadata_created,
-                              [dataset.name],
-                              False),
-                common.Metadata(metadata),
-                None)
+        return self._records_for_datasets([(dataset, datestamp)],
+                                          metadata_prefix)[0]
+
+    def _prefetch(self, ids):
+        '''Return the tags, extras and creation times of datasets.
+        '''
+        tags = defaultdict(list)
+        extras = defaultdict(list)
+        if not ids:
+            return tags, extras, {}
+        for package_id, name in Session.query(PackageTag.package_id,
+                                              Tag.name).\
+                join(Tag, Tag.id == PackageTag.tag_id).\
+                filter(PackageTag.package_id.in_(ids)).\
+                filter(PackageTag.state == 'active').\
+                filter(Tag.vocabulary_id == None).\
+                order_by(Tag.name):
+            tags[package_id].append(name)
+        for package_id, key, value in Session.query(PackageExtra.package_id,
+                                                    PackageExtra.key,
+                                                    PackageExtra.value).\
+                filter(PackageExtra.package_id.in_(ids)).\
+                filter(PackageExtra.state == 'active'):
+            extras[package_id].append((key, value))
+        first_revision = func.min(PackageRevision.revision_timestamp)
+        created = dict(Session.query(PackageRevision.id, first_revision).\
+                       filter(PackageRevision.id.in_(ids)).\
+                       group_by(PackageRevision.id))
+        return tags, extras, created
+
+    def _header(self, dataset, datestamp=None):
+        '''Return the header of a dataset or of a PackageTombstone.'''
+        if isinstance(dataset, PackageTombstone):
+            return common.Header(dataset.package_id,
+                                 datestamp or dataset.datestamp,
+                                 [dataset.package_name],
+                                 True)
+        return common.Header(dataset.id,
+                             datestamp or dataset.metadata_modified,
+                             [dataset.name],
+                             _is_deleted(dataset))
+
+    def _records_for_datasets(self, datasets, metadata_prefix=None):
+        '''Show records for a list of (dataset, datestamp) pairs.
+
+        The tags, extras and creation times of all the datasets are
+        fetched with one query each, instead of a few queries for every
+        dataset. With the record cache in use, datasets whose metadata
+        in metadata_prefix is cached get a RecordFragment instead of
+        metadata, and nothing is fetched for them. Deleted datasets,
+        and tombstones of purged ones, get a deleted header only.
+        '''
+        if not datasets:
+            return []
+        ids = [dataset.id for dataset, _ in datasets
+               if not _is_deleted(dataset)]
+        cached = {}
+        if metadata_prefix and self.record_cache:
+            cached = get_record_fragments(ids, metadata_prefix)
+        tags, extras, created = self._prefetch(
+            [id for id in ids if id not in cached])
+        licenses = Package.get_license_register()
+        read_url = config.get('ckan.site_url') + \
+            url_for(controller="package", action='read', id='__id__')
+        records = []
+        for dataset, datestamp in datasets:
+            header = self._header(dataset, datestamp)
+            if header.isDeleted():
+                records.append((header, None, None))
+                continue
+            if dataset.id in cached:
+                records.append((header, RecordFragment(*cached[dataset.id]),
+                                None))
+                continue
+            try:
+                license = licenses[dataset.license_id] \
+                    if dataset.license_id else None
+            except KeyError:
+                license = None
+            meta = {
+                    'title': [dataset.name],
+                    'creator': [dataset.author] if dataset.author else None,
+                    'contributor': [dataset.maintainer]
+                        if dataset.maintainer else None,
+                    'identifier': [
+                        read_url.replace('__id__', dataset.id),
+                        dataset.url if dataset.url else dataset.id],
+                    'type': ['dataset'],
+                    'description': [dataset.notes] if dataset.notes else None,
+                    'subject': tags[dataset.id] or None,
+                    'date': [created[dataset.id].strftime('%Y-%m-%d')]
+                        if created.get(dataset.id) else None,
+                    'rights': [license.title] if license else None,
+            }
+            meta = dict(meta.items() + extras[dataset.id])
+            metadata = {}
+            # Fixes the bug on having a large dataset being scrambled to
+            # individual letters
+            for key, value in meta.items():
+                if not isinstance(value, list):
+                    metadata[str(key)] = [value]
+                else:
+                    metadata[str(key)] = value
+            records.append((header, common.Metadata(metadata), None))
+        return records
 
     def getRecord(self, metadataPrefix, identifier):
         '''Simple getRecord for a dataset.
         '''
         package = Package.get(identifier)
-        return self._record_for_dataset(package)
+        if package is None:
+            tombstone = Session.query(PackageTombstone).get(identifier)
+            if tombstone is None:
+                raise error.IdDoesNotExistError(
+                    'No such dataset: %s' % identifier)
+            return self._header(tombstone), None, None
+        stamp = Session.query(PackageDatestamp).get(package.id)
+        return self._record_for_dataset(package,
+                                        stamp.datestamp if stamp else None,
+                                        metadataPrefix)
+
+    def _keyset(self, query, table, from_=None, until=None, after=None):
+        '''Filter a query by the datestamp and package_id of table,
+        PackageDatestamp or PackageTombstone.
+        '''
+        datestamp = table.datestamp
+        if from_:
+            query = query.filter(datestamp >= from_)
+        if until:
+            query = query.filter(datestamp <= until)
+        if after:
+            timestamp, id = after
+            query = query.filter(or_(datestamp > timestamp,
+                                     and_(datestamp == timestamp,
+                                          table.package_id > id)))
+        return query.with_entities(table.package_id.label('package_id'),
+                                   datestamp.label('datestamp'),
+                                   literal_column(
+                                       '1' if table is PackageTombstone
+                                       else '0').label('buried'))
+
+    def _datestamped_packages(self, set=None, cursor=None, from_=None,
+                              until=None, batch_size=None, after=None):
+        '''Return (package, datestamp) pairs in datestamp and id order.
+
+        The datestamp of a package is the time of its latest revision,
+        kept in PackageDatestamp on package writes. With after, a
+        (datestamp, id) pair, only packages after it are returned, so
+        that a page costs the same wherever it is in the list. Without
+        it cursor is used as an offset.
+
+        Purged packages are included as (PackageTombstone, datestamp)
+        pairs, in a set if the package was in its group when purged.
+        Both are listed in one query, so that they are ordered with the
+        same collation of ids as after is compared with.
+        '''
+        offset = cursor if cursor and not after else 0
+        buried = Session.query(PackageTombstone)
+        if set:
+            group = Group.get(set)
+            if not group:
+                return []
+            query = group.packages(return_query=True)
+            sets = tombstone_set_table
+            buried = buried.join(
+                sets, sets.c.package_id == PackageTombstone.package_id).\
+                filter(sets.c.set_spec == group.id)
+        else:
+            query = Session.query(Package)
+        query = query.join(PackageDatestamp,
+                           PackageDatestamp.package_id == Package.id)
+        listed = union_all(
+            self._keyset(query, PackageDatestamp, from_, until,
+                         after).statement,
+            self._keyset(buried, PackageTombstone, from_, until,
+                         after).statement).alias('listed')
+        page = select([listed]).order_by(listed.c.datestamp,
+                                         listed.c.package_id)
+        if offset:
+            page = page.offset(offset)
+        if batch_size:
+            page = page.limit(batch_size)
+        rows = Session.execute(page).fetchall()
+        ids = [row.package_id for row in rows if not row.buried]
+        packages = dict((package.id, package) for package in
+                        Session.query(Package).filter(Package.id.in_(ids))) \
+            if ids else {}
+        ids = [row.package_id for row in rows if row.buried]
+        tombstones = dict(
+            (tombstone.package_id, tombstone) for tombstone in
+            Session.query(PackageTombstone).
+            filter(PackageTombstone.package_id.in_(ids))) if ids else {}
+        datasets = [((tombstones if row.buried else packages).get(
+            row.package_id), row.datestamp) for row in rows]
+        # Unless purged in between.
+        return [(dataset, stamp) for dataset, stamp in datasets if dataset]
 
     def listIdentifiers(self, metadataPrefix, set=None, cursor=None,
-                        from_=None, until=None, batch_size=None):
+                        from_=None, until=None, batch_size=None,
+                        after=None):
         '''List all identifiers for this repository.
         '''
-        data = []
-        packages = []
-        if not set:
-            if not from_ and not until:
-                packages = Session.query(Package).all()
-            else:
-                if from_:
-                    packages = Session.query(Package).\
-                        filter(PackageRevision.revision_timestamp > from_).\
-                        all()
-                if until:
-                    packages = Session.query(Package).\
-                        filter(PackageRevision.revision_timestamp < until).\
-                        all()
-                if from_ and until:
-                    packages = Session.query(Package).\
-                        filter(between(PackageRevision.revision_timestamp,
-                                       from_,
-                                       until)\
-                               ).all()
-        else:
-            group = Group.get(set)
-            if group:
-                packages = group.packages(return_query=True)
-                if from_ and not until:
-                    packages = packages.\
-                        filter(PackageRevision.revision_timestamp > from_)
-                if until and not from_:
-                    packages = packages.\
-                        filter(PackageRevision.revision_timestamp < until)
-                if from_ and until:
-                    packages = packages.filter(
-                        between(PackageRevision.revision_timestamp,
-                                from_,
-                                until))
-                packages = packages.all()
-        if cursor:
-            packages = packages[:cursor]
-        for package in packages:
-            data.append(common.Header(package.id,
-                                      package.metadata_created,
-                                      [package.name],
-                                      False))
-        return data
+        return [self._header(package, datestamp) for package, datestamp in
+                self._datestamped_packages(set, cursor, from_, until,
+                                           batch_size, after)]
 
     def listMetadataFormats(self):
         '''List available metadata formats.
@@ -141,56 +319,385 @@ class CKANServer(ResumptionOAIPMH):
                  'http://www.openarchives.org/OAI/2.0/rdf/')]
 
     def listRecords(self, metadataPrefix, set=None, cursor=None, from_=None,
-                    until=None, batch_size=None):
+                    until=None, batch_size=None, after=None):
         '''Show a selection of records, basically lists all datasets.
         '''
-        data = []
-        packages = []
-        if not set:
-            if not from_ and not until:
-                packages = Session.query(Package).all()
-            if from_:
-                packages = Session.query(Package).\
-                    filter(PackageRevision.revision_timestamp > from_).all()
-            if until:
-                packages = Session.query(Package).\
-                    filter(PackageRevision.revision_timestamp < until).all()
-            if from_ and until:
-                packages = Session.query(Package).filter(
-                    between(PackageRevision.revision_timestamp,from_,until)).\
-                    all()
-        else:
-            group = Group.get(set)
-            if group:
-                packages = group.packages(return_query=True)
-                if from_ and not until:
-                    packages = packages.\
-                        filter(PackageRevision.revision_timestamp > from_).\
-                        all()
-                if until and not from_:
-                    packages = packages.\
-                        filter(PackageRevision.revision_timestamp < until).\
-                        all()
-                if from_ and until:
-                    packages = packages.filter(
-                            between(PackageRevision.revision_timestamp,
-                                    from_,
-                                    until))\
-                                    .all()
-        if cursor:
-            packages = packages[:cursor]
-        for res in packages:
-            data.append(self._record_for_dataset(res))
-        return data
-
-    def listSets(self, cursor=None, batch_size=None):
+        return self._records_for_datasets(self._datestamped_packages(
+            set, cursor, from_, until, batch_size, after), metadataPrefix)
+
+    def _groups_version(self):
+        '''Return the latest revision time of groups and their number.'''
+        return Session.query(func.max(Revision.timestamp),
+                             func.count(Group.id)).\
+            filter(Group.revision_id == Revision.id).one()
+
+    def _sets(self):
+        '''Return the sets in setSpec order, and the setSpecs.
+
+        The list is kept until a group changes, which is checked with
+        one aggregate query instead of loading all the groups.
+        '''
+        version = tuple(self._groups_version())
+        cached = self._set_cache
+        if cached is None or cached[0] != version:
+            sets = sorted(tuple(row) for row in Session.query(
+                Group.id, Group.name, Group.description))
+            cached = (version, sets, [spec for spec, _, _ in sets])
+            self._set_cache = cached
+        return cached[1], cached[2]
+
+    def listSets(self, cursor=None, batch_size=None, after=None):
         '''List all sets in this repository, where sets are groups.
+
+        With after, a setSpec, only the sets after it are listed.
+        '''
+        sets, specs = self._sets()
+        start = bisect_right(specs, after) if after else cursor or 0
+        if batch_size:
+            return sets[start:start + batch_size]
+        return sets[start:]
+
+
+def _is_deleted(dataset):
+    '''Return whether a dataset or PackageTombstone is a deleted record.'''
+    return isinstance(dataset, PackageTombstone) or \
+        dataset.state == 'deleted'
+
+
+def encode_after(header):
+    '''Return the resumption key for the records after this header.'''
+    return '%s|%s' % (header.datestamp().isoformat(), header.identifier())
+
+
+def decode_after(value):
+    '''Return the (datestamp, id) pair of a resumption key.'''
+    try:
+        timestamp, id = value.split('|', 1)
+        if '.' in timestamp:
+            return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f'), id
+        return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S'), id
+    except ValueError:
+        raise error.BadResumptionTokenError(
+            'Unable to decode resumption token (bad key): %s' % value)
+
+
+class KeysetResumption(BatchingResumption):
+    '''Resumption of list verbs by the last item of the page.
+
+    The resumption token carries the datestamp and identifier of the
+    last record of the page, or the setSpec of the last set, and the
+    next page is asked from CKANServer as the items after those. Unlike
+    with a numeric cursor, a page near the end of the list costs no
+    more than the first one. Other verbs are handled as in
+    BatchingResumption.
+    '''
+    def _decode(self, verb, kw):
+        '''Return the arguments of a request and its cursor.'''
+        if 'resumptionToken' not in kw:
+            return kw.copy(), 0
+        kw, cursor = decodeResumptionToken(kw['resumptionToken'])
+        if 'after' not in kw:
+            raise error.BadResumptionTokenError(
+                'Unable to decode resumption token (no key)')
+        if verb != 'ListSets':
+            kw['after'] = decode_after(kw['after'])
+        return kw, cursor
+
+    def _token(self, kw, cursor, after):
+        '''Return the resumption token for the items after a key.'''
+        kw = kw.copy()
+        kw['after'] = after
+        return encodeResumptionToken(kw, cursor + self._batch_size)
+
+    def _key(self, verb, last):
+        '''Return the resumption key of the last item of a page.'''
+        if verb == 'ListSets':
+            return last[0]
+        return encode_after(last[0] if isinstance(last, tuple) else last)
+
+    def handleVerb(self, verb, kw):
+        if verb not in ('ListIdentifiers', 'ListRecords', 'ListSets'):
+            result = BatchingResumption.handleVerb(self, verb, kw)
+            if verb == 'GetRecord':
+                count_items(1)
+            return result
+        kw, cursor = self._decode(verb, kw)
+        kw['batch_size'] = self._batch_size + 1
+        method = common.getMethodForVerb(self._server, verb)
+        result = list(method(**kw))
+        token = None
+        if len(result) > self._batch_size:
+            result.pop()
+            token = self._token(kw, cursor, self._key(verb, result[-1]))
+        count_items(len(result))
+        return result, token
+
+    def iterVerb(self, verb, kw, chunk_size):
+        '''Iterate over a page of ListIdentifiers or ListRecords.
+
+        The page is asked from the server chunk_size records at a time,
+        each chunk as the records after the previous one, so no database
+        cursor is kept open while the records are used.
+
+        :returns: the arguments of the request, the records, and a dict
+            whose 'token' is the resumption token once the records have
+            been iterated over
+        :rtype: (dict, iterator, dict) triple
+        '''
+        kw, cursor = self._decode(verb, kw)
+        method = common.getMethodForVerb(self._server, verb)
+        state = {'token': None}
+
+        def fetch(after, size):
+            args = dict(kw, batch_size=size + 1)
+            if after:
+                args['after'] = after
+            return list(method(**args))
+
+        def generate():
+            remaining = self._batch_size
+            records = fetch(kw.get('after'), min(chunk_size, remaining))
+            while True:
+                chunk = records[:min(chunk_size, remaining)]
+                count_items(len(chunk))
+                for record in chunk:
+                    yield record
+                remaining -= len(chunk)
+                if len(records) <= len(chunk):
+                    return
+                if not remaining:
+                    state['token'] = self._token(
+                        kw, cursor, self._key(verb, chunk[-1]))
+                    return
+                last = chunk[-1]
+                header = last[0] if isinstance(last, tuple) else last
+                records = fetch((header.datestamp(), header.identifier()),
+                                min(chunk_size, remaining))
+        return kw, generate(), state
+
+
+FRAGMENT_PI = 'oaipmh-fragment'
+RECORDS_PI = 'oaipmh-records'
+_fragment_pi = re.compile(r'<\?%s (\d+)\?>' % FRAGMENT_PI)
+
+
+class RecordFragment(object):
+    '''Metadata of a record as a serialized <metadata> element, and
+    optionally the same compressed with compression.deflate.
+    '''
+    def __init__(self, xml, deflated=None):
+        self.xml = xml
+        self.deflated = deflated
+
+
+class FragmentTreeServer(XMLTreeServer):
+    '''XMLTreeServer that leaves cached records out of the tree.
+
+    In ListRecords and GetRecord responses the metadata of a record
+    that comes as a RecordFragment is replaced by a processing
+    instruction with the index of the fragment in a list, so that the
+    serialized response can be completed by string concatenation.
+    Metadata in a format that has a serializer, a function from
+    metadata to the serialized element inside <metadata>, is also made
+    into a fragment, without building elements for it. With
+    record_cache, metadata written for the other records is stored in
+    the record cache.
+    '''
+    def __init__(self, server, metadata_registry, nsmap=None,
+                 record_cache=False, serializers=None):
+        XMLTreeServer.__init__(self, server, metadata_registry, nsmap)
+        self.record_cache = record_cache
+        self._serializers = serializers or {}
+        # The <metadata> start tag as lxml writes it on its own, with
+        # the namespaces of the envelope, which include xsi for its
+        # schemaLocation.
+        e_oaipmh = etree.Element(nsoai('OAI-PMH'), nsmap=self._nsmap)
+        e_oaipmh.set('{%s}schemaLocation' % NS_XSI, '')
+        e_metadata = etree.SubElement(e_oaipmh, nsoai('metadata'))
+        self._metadata_start = etree.tostring(e_metadata,
+                                              encoding=unicode)[:-2] + u'>'
+
+    def _outputRecords(self, element, metadata_prefix, records, fragments):
+        new = []
+        serializer = self._serializers.get(metadata_prefix)
+        for header, metadata, about in records:
+            e_record = etree.SubElement(element, nsoai('record'))
+            self._outputHeader(e_record, header)
+            if header.isDeleted():
+                continue
+            if serializer is not None and \
+                    not isinstance(metadata, RecordFragment):
+                xml = self._metadata_start + serializer(metadata) + \
+                    u'</metadata>'
+                metadata = RecordFragment(xml)
+                if self.record_cache:
+                    metadata.deflated = deflate(xml.encode('utf-8'))
+                    new.append((header.identifier(), header.datestamp(),
+                                xml, metadata.deflated))
+            if isinstance(metadata, RecordFragment):
+                e_record.append(etree.ProcessingInstruction(
+                    FRAGMENT_PI, str(len(fragments))))
+                fragments.append(metadata)
+                continue
+            self._outputMetadata(e_record, metadata_prefix, metadata)
+            if self.record_cache:
+                xml = etree.tostring(e_record[-1], encoding=unicode,
+                                     with_tail=False)
+                new.append((header.identifier(), header.datestamp(), xml,
+                            deflate(xml.encode('utf-8'))))
+        store_record_fragments(metadata_prefix, new)
+
+    def getRecordFragments(self, fragments, **kw):
+        envelope, e_getRecord = self._outputEnvelope(verb='GetRecord', **kw)
+        record = self._server.getRecord(**kw)
+        self._outputRecords(e_getRecord, kw['metadataPrefix'], [record],
+                            fragments)
+        return envelope
+
+    def listRecordsFragments(self, fragments, **kw):
+        envelope, e_listRecords = self._outputEnvelope(verb='ListRecords',
+                                                       **kw)
+        def outputFunc(element, records, token_kw):
+            self._outputRecords(element, token_kw['metadataPrefix'],
+                                records, fragments)
+        self._outputResuming(e_listRecords, self._server.listRecords,
+                             outputFunc, kw)
+        return envelope
+
+
+class KeysetServer(ServerBase):
+    '''OAI-PMH server for CKANServer using KeysetResumption.
+
+    If the CKANServer uses the record cache, records are served from it
+    where possible and the others are added to it.
+
+    With stream_chunk_size, ListIdentifiers and ListRecords responses
+    are returned as an iterator of strings instead of one string. The
+    envelope comes first, then the records, stream_chunk_size at a time
+    as they are read from the database, then the resumption token, so
+    the memory used does not grow with the page size.
+
+    serializers maps metadataPrefixes to functions that serialize
+    metadata directly, see FragmentTreeServer.
+    '''
+    def __init__(self, server, metadata_registry=None, nsmap=None,
+                 resumption_batch_size=10, stream_chunk_size=None,
+                 serializers=None):
+        self._resumption = KeysetResumption(server, resumption_batch_size)
+        super(KeysetServer, self).__init__(self._resumption,
+                                           metadata_registry,
+                                           nsmap)
+        self._tree_server = FragmentTreeServer(
+            self._resumption, metadata_registry, nsmap,
+            getattr(server, 'record_cache', False), serializers)
+        self._stream_chunk_size = stream_chunk_size
+        self._client = server
+
+    def validators(self, kw):
+        '''Return when the response to request arguments last changed,
+        and what it depends on.
+
+        :returns: the time in UTC and the version, or None if unknown
+        :rtype: (datetime, tuple) pair
         '''
-        data = []
-        if not cursor:
-            groups = Session.query(Group).all()
+        validators = getattr(self._client, 'validators', None)
+        if validators is None:
+            return None
+        return validators(kw.get('verb'), kw.get('identifier'))
+
+    def handleVerb(self, verb, kw):
+        if verb in ('ListIdentifiers', 'ListRecords') and \
+                self._stream_chunk_size:
+            return self._stream(verb, kw)
+        if verb == 'GetRecord':
+            method = self._tree_server.getRecordFragments
+        elif verb == 'ListRecords':
+            method = self._tree_server.listRecordsFragments
         else:
-            groups = Session.query(Group).all()[:cursor]
-        for dataset in groups:
-            data.append((dataset.id, dataset.name, dataset.description))
-        return data
+            return ServerBase.handleVerb(self, verb, kw)
+        fragments = []
+        parts = self._serialize(method(fragments, **kw).getroot(), fragments,
+                                xml_declaration=True)
+        return PartedText(parts)
+
+    def _serialize(self, element, fragments, **kw):
+        '''Serialize an element, putting the fragments in place.
+
+        :returns: the parts of the serialization; the fragments that
+            have a compressed form are PrecompressedText instances
+        :rtype: list of strings
+        '''
+        text = etree.tostring(element, encoding='UTF-8', pretty_print=True,
+                              **kw)
+        if not fragments:
+            return [text]
+        parts = _fragment_pi.split(text)
+        # Every odd part is the index of a fragment.
+        for i in range(1, len(parts), 2):
+            fragment = fragments[int(parts[i])]
+            parts[i] = fragment.xml.encode('utf-8')
+            if fragment.deflated is not None:
+                parts[i] = PrecompressedText(parts[i], fragment.deflated)
+        return parts
+
+    def _stream(self, verb, kw):
+        tree = self._tree_server
+        size = self._stream_chunk_size
+        token_kw, records, state = self._resumption.iterVerb(verb, kw, size)
+        metadata_prefix = token_kw.get('metadataPrefix')
+
+        def render(chunk):
+            fragments = []
+            element = etree.Element(nsoai(verb), nsmap=tree._nsmap)
+            if verb == 'ListIdentifiers':
+                for header in chunk:
+                    tree._outputHeader(element, header)
+            else:
+                tree._outputRecords(element, metadata_prefix, chunk,
+                                    fragments)
+            if not len(element):
+                return []
+            parts = self._serialize(element, fragments)
+            # Leave out the start and end tags of the element.
+            parts[0] = parts[0][parts[0].index('>') + 1:]
+            parts[-1] = parts[-1][:parts[-1].rindex('</')]
+            return parts
+
+        # The first chunk is read before anything is returned, so that
+        # errors still make an OAI-PMH error response.
+        first = list(islice(records, size))
+        if not first and 'resumptionToken' not in kw:
+            raise error.NoRecordsMatchError('No records match for request.')
+        first = render(first)
+        envelope, element = tree._outputEnvelope(verb=verb, **kw)
+        marker = etree.ProcessingInstruction(RECORDS_PI)
+        element.append(marker)
+        head, tail = self._serialize(envelope.getroot(), [],
+                                     xml_declaration=True)[0].\
+            split(etree.tostring(marker), 1)
+        request_session = Session()
+
+        def generate():
+            try:
+                yield head
+                for part in first:
+                    yield part
+                while True:
+                    chunk = list(islice(records, size))
+                    if not chunk:
+                        break
+                    for part in render(chunk):
+                        yield part
+                if state['token']:
+                    yield '<resumptionToken>%s</resumptionToken>' % \
+                        escape(state['token'])
+                yield tail
+            finally:
+                # The request's session is usually gone by now, so the
+                # chunks after the first one used a session of their own,
+                # which is removed. A response read while the request's
+                # session is still there leaves that session alone.
+                if Session.registry.has() and \
+                        Session() is not request_session:
+                    Session.remove()
+        return generate()
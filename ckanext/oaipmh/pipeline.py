@@ -0,0 +1,285 @@
+'''Pipelined harvesting for sources far away.
+
+The harvester makes one request at a time, so against a source with a
+long round trip it mostly waits. Here list pages are fetched in a
+background thread while the previous page is being consumed, and the
+GetRecord requests and original record downloads of the records ahead
+are made by a pool of threads, a bounded number of them in flight at a
+time. Records are still converted and saved in the calling thread, in
+the order they were listed, with the same data dictionaries as the
+harvester's import stage makes for oai_dc2ckan.
+'''
+import logging
+import sys
+import threading
+import time
+import urllib2
+from Queue import Queue, Full
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+IN_FLIGHT = 16
+# Items listed ahead of the consumer; more than a page so that the next
+# page is requested while the previous one is being consumed.
+LIST_AHEAD = 1000
+
+_done = object()
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def prefetch(iterable, ahead=LIST_AHEAD):
+    '''Iterate over an iterable in a background thread.
+
+    Up to ahead items are taken from the iterable before they are asked
+    for. Exceptions are raised to the consumer when it gets to them.
+    The thread stops soon after the consumer stops iterating.
+    '''
+    queue = Queue(ahead)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception:
+            put(_Failure(sys.exc_info()))
+            return
+        put(_done)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _done:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+            yield item
+    finally:
+        stopped.set()
+
+
+def _call(function, *args, **kw):
+    '''Return the result of a function, or the exception it raised.'''
+    try:
+        return function(*args, **kw)
+    except Exception as e:
+        return e
+
+
+def _download(url):
+    return urllib2.urlopen(url).read()
+
+
+class RecordFetcher(object):
+    '''Fetches records in every metadata format with requests in flight.
+
+    For every record and format, the record is got with GetRecord and
+    its original XML is downloaded from the URL given by original_url.
+
+    :param client: pyoai client of the source, shared by the threads
+    :param prefixes: the metadata formats
+    :type prefixes: list of strings
+    :param original_url: function of (identifier, prefix) that returns
+        the URL of the original XML of a record, or None to not get it
+    :param in_flight: number of requests made at a time
+    :type in_flight: integer
+    '''
+    def __init__(self, client, prefixes, original_url=None,
+                 in_flight=IN_FLIGHT):
+        self.client = client
+        self.prefixes = prefixes
+        self.original_url = original_url
+        self.in_flight = in_flight
+
+    def _submit(self, pool, identifier):
+        tasks = {}
+        for prefix in self.prefixes:
+            record = pool.apply_async(
+                _call, (self.client.getRecord,),
+                {'metadataPrefix': prefix, 'identifier': identifier})
+            original = None
+            if self.original_url:
+                original = pool.apply_async(
+                    _call, (_download,
+                            self.original_url(identifier, prefix)))
+            tasks[prefix] = (record, original)
+        return identifier, tasks
+
+    def fetch(self, identifiers):
+        '''Iterate over fetched records, in the order of identifiers.
+
+        :param identifiers: record identifiers
+        :type identifiers: iterable of strings
+        :returns: (identifier, results) pairs, where results maps every
+            prefix to a pair of the (header, metadata, about) triple of
+            GetRecord and the original XML (None if not downloaded). An
+            exception stands for a result that could not be had.
+        :rtype: iterator of (string, dict) pairs
+        '''
+        requests = len(self.prefixes) * (2 if self.original_url else 1)
+        ahead = max(1, self.in_flight // requests)
+        pool = ThreadPool(self.in_flight)
+        pending = deque()
+        try:
+            identifiers = iter(identifiers)
+            while True:
+                while len(pending) < ahead:
+                    identifier = next(identifiers, _done)
+                    if identifier is _done:
+                        break
+                    pending.append(self._submit(pool, identifier))
+                if not pending:
+                    return
+                identifier, tasks = pending.popleft()
+                yield identifier, dict(
+                    (prefix, (record.get(),
+                              original.get() if original else None))
+                    for prefix, (record, original) in tasks.items())
+        finally:
+            pool.terminate()
+
+
+def harvest(url, config='', in_flight=IN_FLIGHT, from_=None, until=None,
+            progress=None):
+    '''Harvest a source into CKAN with pipelined requests.
+
+    The source configuration is that of harvest sources of the OAI-PMH
+    harvester ("set", "metadata_formats", "stream_pages"). Packages and
+    set groups are made as by the harvester; records that can not be
+    fetched in the default format are skipped and reported, and records
+    without metadata in it (deleted ones) are skipped.
+
+    No harvest job or harvest objects are made, so the packages are not
+    known as harvested from any harvest source: a harvest source of the
+    same URL with "reconcile" does not retire them, and its harvests
+    update them like packages of its own.
+
+    :param url: base URL of the OAI-PMH interface
+    :param config: source configuration, as JSON
+    :param in_flight: number of requests made at a time
+    :param from_: harvest records modified since then
+    :type from_: datetime
+    :param until: harvest records modified until then
+    :type until: datetime
+    :param progress: function called with the number of records read
+        and the records per second, every 100 records
+    :returns: numbers of records imported and the identifiers of the
+        records that failed
+    :rtype: (integer, list of strings) pair
+    '''
+    from ckan import model
+    from ckanext.oaipmh.dataconverter import oai_dc2ckan
+    from ckanext.oaipmh.harvester import OAIPMHHarvester, kata_oai_dc_reader
+    from oaipmh.error import NoRecordsMatchError, NoSetHierarchyError
+
+    harvester = OAIPMHHarvester()
+    harvester._set_config(config)
+    client, identifier = harvester._get_client_identifier(url)
+    if identifier is None:
+        raise ValueError('Could not identify %s' % url)
+    domain = identifier.repositoryName()
+    group = harvester._get_group(domain, in_revision=False)
+    args = {harvester.metadata_prefix_key: harvester.metadata_prefix_value}
+    if from_:
+        args['from_'] = from_
+    if until:
+        args['until'] = until
+
+    def list_identifiers(set_=None):
+        set_args = dict(args, set=set_) if set_ else args
+        try:
+            for header in prefetch(client.listIdentifiers(**set_args)):
+                if not header.isDeleted():
+                    yield header.identifier()
+        except NoRecordsMatchError:
+            pass
+
+    # Members of the configured sets, listed once for both records and
+    # set groups.
+    members = {}
+
+    def all_identifiers():
+        seen = set()
+        for set_ in harvester.config.get('set', [None]):
+            set_members = members.setdefault(set_, [])
+            for ident in list_identifiers(set_):
+                set_members.append(ident)
+                if ident not in seen:
+                    seen.add(ident)
+                    yield ident
+
+    prefixes = harvester._metadata_prefixes()
+    fetcher = RecordFetcher(
+        client, prefixes,
+        lambda ident, prefix: harvester._original_record_url(url, ident,
+                                                             prefix),
+        in_flight)
+    imported = 0
+    failed = []
+    start = time.time()
+    for count, (ident, results) in enumerate(
+            fetcher.fetch(all_identifiers()), 1):
+        if progress and count % 100 == 0:
+            progress(count, count / (time.time() - start))
+        data = harvester._record_data(url, ident)
+        deleted = False
+        for prefix in prefixes:
+            record, original = results[prefix]
+            if isinstance(record, Exception) or \
+                    isinstance(original, Exception):
+                log.warning('Could not fetch %s in %s: %s' % (
+                    ident, prefix, record if isinstance(record, Exception)
+                    else original))
+                if prefix == harvester.metadata_prefix_value:
+                    data = None
+                    break
+                continue
+            if record[1] is None:
+                # Deleted since it was listed, or no metadata in prefix.
+                log.warning('No metadata: %s in %s' % (ident, prefix))
+                if prefix == harvester.metadata_prefix_value:
+                    deleted = True
+                    break
+                continue
+            data['metadata'][prefix] = record[1].getMap()
+            harvester._add_original_record(data, prefix, original)
+        if deleted:
+            continue
+        if data and oai_dc2ckan(data, kata_oai_dc_reader._namespaces, group):
+            imported += 1
+        else:
+            failed.append(ident)
+            model.Session.remove()
+            group = harvester._get_group(domain, in_revision=False)
+    try:
+        sets = [(spec, name) for spec, name, _ in client.listSets()
+                if 'set' not in harvester.config or
+                spec in harvester.config['set']]
+    except NoSetHierarchyError:
+        sets = []
+    for spec, name in sets:
+        idents = members[spec] if spec in members else \
+            list(list_identifiers(spec))
+        model.repo.new_revision()
+        harvester._add_set_members(group, name, idents)
+        model.repo.commit()
+    return imported, failed
@@ -1,7 +1,14 @@
 import logging
 import os
 from ckan.plugins import implements, SingletonPlugin
-from ckan.plugins import IRoutes, IConfigurer
+from ckan.plugins import IRoutes, IConfigurer, IConfigurable
+from ckan.plugins import IDomainObjectModification
+from ckan.model import Package, Session
+from ckan.model.domain_object import DomainObjectOperation
+
+from ckanext.oaipmh.model import setup as model_setup, touch_package
+from ckanext.oaipmh.model import bury_package, PackageTombstone
+from ckanext.oaipmh.model import clear_record_fragments
 
 log = logging.getLogger(__name__)
 
@@ -13,6 +20,29 @@ class OAIPMHPlugin(SingletonPlugin):
     '''
     implements(IRoutes, inherit=True)
     implements(IConfigurer)
+    implements(IConfigurable)
+    implements(IDomainObjectModification, inherit=True)
+
+    def configure(self, config):
+        '''Set up the tables of the OAI-PMH interface.
+        '''
+        model_setup()
+
+    def notify(self, entity, operation):
+        '''Keep the OAI-PMH datestamps and record cache of packages up to
+        date, and leave a tombstone of purged packages.
+
+        A purge also brings change notifications of the package, through
+        the tags and other objects purged with it. Those leave the
+        tombstone alone.
+        '''
+        if isinstance(entity, Package):
+            if operation == DomainObjectOperation.deleted:
+                bury_package(entity)
+            elif operation == DomainObjectOperation.new or \
+                    not _purged(entity):
+                touch_package(entity)
+            clear_record_fragments(entity.id)
 
     def update_config(self, config):
         """This IConfigurer implementation causes CKAN to look in the
@@ -35,5 +65,15 @@ class OAIPMHPlugin(SingletonPlugin):
         '''Map the controller to be used for OAI-PMH.
         '''
         controller = 'ckanext.oaipmh.controller:OAIPMHController'
+        map.connect('oai_metrics', '/oai/metrics', controller=controller,
+                    action='metrics')
         map.connect('oai', '/oai', controller=controller, action='index')
         return map
+
+
+def _purged(package):
+    '''Return whether a package is purged in the current session or has
+    been buried already.
+    '''
+    return package in Session.deleted or \
+        Session.query(PackageTombstone).get(package.id) is not None
@@ -0,0 +1,126 @@
+'''Profiling of the harvest stages of chosen sources.
+
+Stages are profiled with cProfile, only for sources that ask for it, so
+other sources pay nothing. The import stage runs once per harvest object,
+so its runs in the same process are added up into one profile per job.
+Profiles are written with pstats' dump format, to be read with pstats or
+tools like snakeviz, and their hot spots as text next to them.
+'''
+import atexit
+import cProfile
+import logging
+import os
+import pstats
+import time
+from StringIO import StringIO
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Number of functions in a summary.
+TOP = 15
+# Profiles of this many (job, stage) pairs are kept for adding up.
+MAX_PROFILES = 4
+# Least number of seconds between two writes of a profile that is added
+# up from many runs.
+DUMP_INTERVAL = 60
+
+log = logging.getLogger(__name__)
+
+_profiles = OrderedDict()
+
+
+class _Profile(object):
+    '''A profile added up from runs, with the file it is written to.'''
+    def __init__(self, path):
+        self.profile = cProfile.Profile()
+        self.path = path
+        self.dumped = 0
+        self.changed = False
+
+    def dump(self, final=False):
+        '''Write the profile and its hot spots, and log them if no more
+        runs will be added.
+        '''
+        if self.changed:
+            self.profile.dump_stats(self.path)
+            summary = hot_spots(self.profile)
+            write_summary(self.path, summary)
+            self.dumped = time.time()
+            self.changed = False
+            if final:
+                log.info('Profile written to %s.\n%s' % (self.path,
+                                                          summary))
+
+
+def profile_path(directory, job_id, stage, pid=None):
+    '''Return the file name of the profile of a stage of a job.
+
+    The process id is part of the name, since every process that runs
+    the stage writes a profile of its own. It defaults to this process.
+    '''
+    return os.path.join(directory, 'oaipmh_%s_%s_%s.prof' % (
+        job_id, stage, pid or os.getpid()))
+
+
+@contextmanager
+def profiled(directory, job_id, stage, interval=DUMP_INTERVAL):
+    '''Profile a stage run into the file of the stage of the job.
+
+    The file is written after a run if it was last written interval
+    seconds ago or more, so a stage that runs once per harvest object
+    does not rewrite it every time. Runs not written yet are written
+    when the profile is dropped for newer ones, and when the process
+    exits.
+
+    :returns: the profile, with earlier runs of the stage in this process
+    :rtype: cProfile.Profile
+    '''
+    key = (job_id, stage)
+    profile = _profiles.pop(key, None) or \
+        _Profile(profile_path(directory, job_id, stage))
+    _profiles[key] = profile
+    while len(_profiles) > MAX_PROFILES:
+        _profiles.popitem(last=False)[1].dump(final=True)
+    profile.profile.enable()
+    try:
+        yield profile.profile
+    finally:
+        profile.profile.disable()
+        profile.changed = True
+        if time.time() - profile.dumped >= interval:
+            profile.dump()
+
+
+@atexit.register
+def dump_profiles():
+    '''Write the runs of all profiles that are not written yet.'''
+    for profile in _profiles.values():
+        profile.dump(final=True)
+
+
+def get_profile(job_id, stage):
+    '''Return the profile of a stage of a job in this process, if any.'''
+    profile = _profiles.get((job_id, stage))
+    return profile and profile.profile
+
+
+def summary_path(path):
+    '''Return the file name of the hot spots of a profile file.'''
+    return os.path.splitext(path)[0] + '.txt'
+
+
+def write_summary(path, summary):
+    '''Write the hot spots of the profile in the file path next to it.'''
+    try:
+        with open(summary_path(path), 'w') as out:
+            out.write(summary + '\n')
+    except (IOError, OSError) as e:
+        log.warning('Could not write profile summary: %s' % e)
+
+
+def hot_spots(profile, limit=TOP):
+    '''Return the functions with most cumulative time as text.'''
+    out = StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(limit)
+    return out.getvalue().strip()
@@ -0,0 +1,82 @@
+'''Finding harvested packages that have disappeared from their source.
+
+A source that does not report deleted records can only be compared with
+what was harvested from it. Both identifier lists are sorted in bounded
+memory, spilling sorted runs to temporary files, and walked side by
+side, so neither list is ever held in memory whole.
+'''
+import heapq
+import tempfile
+from itertools import chain, islice
+
+RUN_SIZE = 100000
+
+
+def _spill(run):
+    '''Write a sorted run to a temporary file and rewind it.'''
+    run_file = tempfile.TemporaryFile()
+    for item in run:
+        run_file.write(item.encode('utf-8') + '\n')
+    run_file.seek(0)
+    return run_file
+
+
+def _read(run_file):
+    for line in run_file:
+        yield line[:-1].decode('utf-8')
+
+
+def sorted_unique(items, run_size=RUN_SIZE):
+    '''Iterate over strings in sorted order, without duplicates.
+
+    At most run_size strings are held in memory at a time; longer
+    inputs are sorted in runs which are merged from temporary files.
+    The strings must not contain newlines.
+
+    :param items: the strings
+    :type items: iterable of unicode
+    :param run_size: number of strings sorted in memory at a time
+    :type run_size: integer
+    :rtype: iterator of unicode
+    '''
+    items = iter(items)
+    run = sorted(set(islice(items, run_size)))
+    if len(run) < run_size:
+        # Fits in memory, unless duplicates made the run short.
+        rest = list(islice(items, 1))
+        if not rest:
+            for item in run:
+                yield item
+            return
+        items = chain(rest, items)
+    runs = []
+    try:
+        while run:
+            runs.append(_spill(run))
+            run = sorted(set(islice(items, run_size)))
+        previous = None
+        for item in heapq.merge(*[_read(run_file) for run_file in runs]):
+            if item != previous:
+                yield item
+                previous = item
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+
+def missing(local, remote):
+    '''Iterate over the strings of local that are not in remote.
+
+    :param local: strings in sorted order
+    :type local: iterable of unicode
+    :param remote: strings in sorted order
+    :type remote: iterable of unicode
+    :rtype: iterator of unicode
+    '''
+    remote = iter(remote)
+    current = next(remote, None)
+    for item in local:
+        while current is not None and current < item:
+            current = next(remote, None)
+        if current != item:
+            yield item
@@ -0,0 +1,374 @@
+# coding: utf-8
+# vi:et:ts=8:
+'''Record/replay stand-in for an OAI-PMH source.
+
+A recording is a directory of response files with a mapping.txt that
+alternates lines of canonical query strings (the request arguments,
+sorted and URL encoded) and names of the files that answer them, as in
+the fake1 directory.  The server answers requests from a recording and,
+given an upstream URL, forwards the requests it has no response for and
+records the responses.  Replayed responses can be slowed down, replaced
+by HTTP errors at random, and list responses can be cut into pages of a
+different size than were recorded, so harvests can be benchmarked
+repeatably without network access.
+
+Run from the command line, e.g.
+
+    python -m ckanext.oaipmh.replay recording --record http://example.org/oai
+    python -m ckanext.oaipmh.replay recording --latency 0.3 --page-size 50
+'''
+
+import BaseHTTPServer
+import SocketServer
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from xml.sax.saxutils import escape, quoteattr
+
+import lxml.etree
+
+from streaming import OAI, open_request
+
+MAPPING = 'mapping.txt'
+DATE_ARGUMENTS = ('from', 'until')
+LIST_VERBS = ('ListIdentifiers', 'ListRecords', 'ListSets')
+
+_items = {'ListIdentifiers': '{%s}header' % OAI,
+        'ListRecords': '{%s}record' % OAI, 'ListSets': '{%s}set' % OAI}
+_token = '{%s}resumptionToken' % OAI
+_token_prefix = 'replay-'
+
+def canonical_query(args, ignore_dates=False):
+        '''return the canonical query string of request arguments
+
+        :param args: request arguments, including verb
+        :type args: hash from string to string
+        :param ignore_dates: leave out from and until
+        :type ignore_dates: boolean
+        :rtype: string
+        '''
+        return urllib.urlencode(sorted((key, value)
+                        for key, value in args.items()
+                        if value is not None and not (ignore_dates and
+                                key in DATE_ARGUMENTS)))
+
+class Recording(object):
+        '''responses by canonical query string, kept in a directory
+
+        :param directory: the directory, created if missing
+        :type directory: string
+        '''
+        def __init__(self, directory):
+                self.directory = directory
+                self.files = {}
+                self._undated = {}
+                self._undated_size = 0
+                self._lock = threading.Lock()
+                if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                path = os.path.join(directory, MAPPING)
+                if os.path.exists(path):
+                        lines = [line.strip() for line in open(path)]
+                        lines = [line for line in lines if line]
+                        self.files = dict(zip(lines[::2], lines[1::2]))
+
+        def get(self, query, ignore_dates=False):
+                '''return the recorded response to a query, or None
+
+                With ignore_dates, the query has no from and until, and
+                matches a recorded one with any dates.
+                '''
+                name = self.files.get(query)
+                if name is None and ignore_dates:
+                        with self._lock:
+                                if self._undated_size != len(self.files):
+                                        self._undated_size = len(self.files)
+                                        self._undated = dict((canonical_query(
+                                                dict(urlparse.parse_qsl(
+                                                        recorded)), True),
+                                                name) for recorded, name
+                                                in self.files.items())
+                                name = self._undated.get(query)
+                if name is None:
+                        return None
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                        return f.read()
+
+        def add(self, query, body):
+                '''record the response to a query'''
+                with self._lock:
+                        name = self.files.get(query) or \
+                                        '%05d.xml' % len(self.files)
+                        with open(os.path.join(self.directory, name),
+                                        'wb') as f:
+                                f.write(body)
+                        if query not in self.files:
+                                self.files[query] = name
+                                with open(os.path.join(self.directory,
+                                                MAPPING), 'a') as f:
+                                        f.write('%s\n%s\n' % (query, name))
+
+def _envelope(verb, base_url, items, token=None, size=None, cursor=None):
+        '''build a list response around serialized items'''
+        parts = ['<?xml version="1.0" encoding="UTF-8"?><OAI-PMH '
+                'xmlns="%s" xmlns:xsi="http://www.w3.org/2001/XMLSchema-'
+                'instance" xsi:schemaLocation="%s %sOAI-PMH.xsd">'
+                '<responseDate>%s</responseDate><request verb="%s">%s'
+                '</request><%s>' % (OAI, OAI, OAI,
+                        time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                        verb, escape(base_url), verb)]
+        parts.extend(items)
+        if size is not None:
+                parts.append('<resumptionToken completeListSize="%d" '
+                        'cursor="%d">%s</resumptionToken>' % (size, cursor,
+                                escape(token or '')))
+        parts.append('</%s></OAI-PMH>' % verb)
+        return ''.join(parts)
+
+def _error(code, message):
+        return ('<?xml version="1.0" encoding="UTF-8"?><OAI-PMH xmlns="%s">'
+                '<responseDate>%s</responseDate><request/><error code=%s>%s'
+                '</error></OAI-PMH>' % (OAI, time.strftime(
+                        '%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                        quoteattr(code), escape(message)))
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        '''HTTP server answering OAI-PMH requests from a recording
+
+        :param address: (host, port) to listen on; port 0 picks a free one
+        :type address: pair
+        :param recording: the responses
+        :type recording: Recording
+        :param upstream: base URL of the source to record from, if any
+        :type upstream: string
+        :param latency: seconds to wait before every response
+        :type latency: float
+        :param jitter: up to this many more seconds, at random
+        :type jitter: float
+        :param error_rate: share of requests answered with an HTTP error
+        :type error_rate: float
+        :param error_code: the HTTP status of those errors
+        :type error_code: integer
+        :param page_size: records, headers or sets per list response, or
+                None to replay list responses as recorded
+        :type page_size: integer
+        :param ignore_dates: match requests regardless of from and until
+        :type ignore_dates: boolean
+        :param seed: seed of the random latencies and errors
+        '''
+        daemon_threads = True
+        allow_reuse_address = True
+        # Harvesters with many requests in flight must not be refused.
+        request_queue_size = 128
+
+        def __init__(self, address, recording, upstream=None, latency=0.0,
+                        jitter=0.0, error_rate=0.0, error_code=503,
+                        page_size=None, ignore_dates=False, seed=None):
+                BaseHTTPServer.HTTPServer.__init__(self, address,
+                                ReplayHandler)
+                self.recording = recording
+                self.upstream = upstream
+                self.latency = latency
+                self.jitter = jitter
+                self.error_rate = error_rate
+                self.error_code = error_code
+                self.page_size = page_size
+                self.ignore_dates = ignore_dates
+                self.random = random.Random(seed)
+                self.requests = 0
+                self.misses = 0
+                self._lists = {}
+                self._lock = threading.Lock()
+
+        @property
+        def url(self):
+                '''base URL of the OAI-PMH interface of the server'''
+                host, port = self.server_address[:2]
+                return 'http://%s:%d/oai' % (host, port)
+
+        def start(self):
+                '''serve in a daemon thread
+
+                :returns: the thread
+                :rtype: threading.Thread
+                '''
+                thread = threading.Thread(target=self.serve_forever)
+                thread.daemon = True
+                thread.start()
+                return thread
+
+        def respond(self, args):
+                '''answer a request
+
+                :param args: request arguments
+                :type args: hash from string to string
+                :returns: HTTP status and response body
+                :rtype: (integer, string) pair
+                '''
+                with self._lock:
+                        self.requests += 1
+                        delay = self.latency + self.random.random() * \
+                                        self.jitter
+                        fail = self.random.random() < self.error_rate
+                if delay:
+                        time.sleep(delay)
+                if fail:
+                        return self.error_code, 'Injected error'
+                verb = args.get('verb')
+                try:
+                        if self.page_size and verb in LIST_VERBS:
+                                return 200, self._page(verb, args)
+                        body = self._recorded(args)
+                except urllib2.HTTPError, e:
+                        return e.code, e.read() # not recorded
+                except urllib2.URLError, e:
+                        return 502, 'Upstream failed: %s' % e.reason
+                if body is None:
+                        return 404, 'Not recorded: %s' % canonical_query(
+                                        args, self.ignore_dates)
+                return 200, body
+
+        def _recorded(self, args):
+                query = canonical_query(args, self.ignore_dates)
+                body = self.recording.get(query, self.ignore_dates)
+                if body is None and self.upstream:
+                        with self._lock:
+                                self.misses += 1
+                        response = open_request(self.upstream, args,
+                                        post=True)
+                        try:
+                                body = response.read()
+                        finally:
+                                response.close()
+                        self.recording.add(query, body)
+                return body
+
+        def _list(self, verb, args):
+                '''return all recorded items of a list request
+
+                The recorded chain of resumption tokens is followed, so
+                a list recorded a page at a time is returned whole.
+                '''
+                query = canonical_query(args, self.ignore_dates)
+                with self._lock:
+                        items = self._lists.get(query)
+                if items is not None:
+                        return query, items
+                items = []
+                while args is not None:
+                        body = self._recorded(args)
+                        if body is None:
+                                return query, None
+                        root = lxml.etree.fromstring(body)
+                        items.extend(lxml.etree.tostring(element)
+                                        for element in root.iter(_items[verb]))
+                        token = root.find('.//' + _token)
+                        args = None
+                        if token is not None and (token.text or '').strip():
+                                args = {'verb': verb,
+                                        'resumptionToken': token.text.strip()}
+                with self._lock:
+                        self._lists[query] = items
+                return query, items
+
+        def _page(self, verb, args):
+                offset = 0
+                token = args.get('resumptionToken')
+                if token:
+                        try:
+                                offset, query = token[len(_token_prefix):]\
+                                                .split('-', 1)
+                                offset = int(offset)
+                                list_args = dict(urlparse.parse_qsl(query))
+                        except ValueError:
+                                return _error('badResumptionToken', token)
+                else:
+                        list_args = args
+                query, items = self._list(verb, list_args)
+                if items is None:
+                        return _error('badArgument', 'Not recorded: %s' %
+                                        query)
+                if not items:
+                        return _error('noRecordsMatch', 'No items')
+                page = items[offset:offset + self.page_size]
+                following = offset + self.page_size
+                if offset == 0 and following >= len(items):
+                        return _envelope(verb, self.url, page)
+                next_token = None
+                if following < len(items):
+                        next_token = '%s%d-%s' % (_token_prefix, following,
+                                        query)
+                return _envelope(verb, self.url, page, next_token,
+                                len(items), offset)
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        '''answers GET and POST requests with ReplayServer.respond'''
+
+        def do_GET(self):
+                self._answer(urlparse.urlparse(self.path).query)
+
+        def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self._answer(self.rfile.read(length))
+
+        def _answer(self, query):
+                args = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+                status, body = self.server.respond(args)
+                self.send_response(status)
+                if status == 503:
+                        self.send_header('Retry-After', '0')
+                self.send_header('Content-Type', 'text/xml; charset=utf-8'
+                                if status == 200 else 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+                pass # would slow benchmarks down
+
+def main(argv=None):
+        parser = optparse.OptionParser(
+                        usage='%prog [options] recording-directory')
+        parser.add_option('--host', default='localhost',
+                        help='address to listen on [%default]')
+        parser.add_option('-p', '--port', type='int', default=8099,
+                        help='port to listen on [%default]')
+        parser.add_option('-r', '--record', metavar='URL',
+                        help='record what is missing from this source')
+        parser.add_option('-l', '--latency', type='float', default=0.0,
+                        help='seconds to wait before every response')
+        parser.add_option('-j', '--jitter', type='float', default=0.0,
+                        help='up to this many more seconds, at random')
+        parser.add_option('-e', '--error-rate', type='float', default=0.0,
+                        help='share of requests to fail [%default]')
+        parser.add_option('--error-code', type='int', default=503,
+                        help='HTTP status of failed requests [%default]')
+        parser.add_option('-s', '--page-size', type='int',
+                        help='serve list responses in pages of this size')
+        parser.add_option('--ignore-dates', action='store_true',
+                        help='match requests regardless of from and until')
+        parser.add_option('--seed', type='int',
+                        help='seed of random latencies and errors')
+        options, args = parser.parse_args(argv)
+        if len(args) != 1:
+                parser.error('give the recording directory')
+        server = ReplayServer((options.host, options.port),
+                        Recording(args[0]), options.record, options.latency,
+                        options.jitter, options.error_rate,
+                        options.error_code, options.page_size,
+                        options.ignore_dates, options.seed)
+        sys.stderr.write('Serving %s at %s\n' % (args[0], server.url))
+        try:
+                server.serve_forever()
+        except KeyboardInterrupt:
+                pass
+        return 0
+
+if __name__ == '__main__':
+        sys.exit(main())
@@ -0,0 +1,243 @@
+# coding: utf-8
+# vi:et:ts=8:
+'''Bounded-memory reading of OAI-PMH list responses.
+
+pyoai reads a whole response page into a string and parses it into one
+tree before any record is looked at, so a harvester needs memory for
+the largest page a source returns.  Here a response is parsed from the
+socket with lxml.etree.iterparse, one <record> (or <header> of
+ListIdentifiers) at a time, and every element is cleared once the next
+one is asked for.  Memory use is then bounded by the largest record.
+'''
+
+import time
+import urllib
+import urllib2
+from StringIO import StringIO
+
+import lxml.etree
+import oaipmh.client
+import oaipmh.error
+from oaipmh import validation
+from oaipmh.datestamp import datetime_to_datestamp
+
+OAI = 'http://www.openarchives.org/OAI/2.0/'
+namespaces = {'oai': OAI}
+
+_record = '{%s}record' % OAI
+_header = '{%s}header' % OAI
+_token = '{%s}resumptionToken' % OAI
+_error = '{%s}error' % OAI
+_list_identifiers = '{%s}ListIdentifiers' % OAI
+
+def open_request(url, args, post=False, headers=None,
+                wait_max=oaipmh.client.WAIT_MAX,
+                wait_default=oaipmh.client.WAIT_DEFAULT):
+        '''open an OAI-PMH request, waiting on 503 like pyoai does
+
+        :param url: base URL of the OAI-PMH interface
+        :type url: string
+        :param args: request arguments, including verb
+        :type args: hash from string to string
+        :param post: whether to use HTTP POST instead of GET
+        :type post: boolean
+        :param headers: additional HTTP headers
+        :type headers: hash from string to string
+        :returns: the response, not read yet
+        :rtype: file-like object
+        '''
+        all_headers = {'User-Agent': 'ckanext-oaipmh'}
+        all_headers.update(headers or {})
+        query = urllib.urlencode(args)
+        if post:
+                request = urllib2.Request(url, data=query, headers=all_headers)
+        else:
+                request = urllib2.Request('%s?%s' % (url, query),
+                                headers=all_headers)
+        for _ in range(wait_max):
+                try:
+                        return urllib2.urlopen(request)
+                except urllib2.HTTPError, e:
+                        if e.code != 503:
+                                raise
+                        try:
+                                time.sleep(int(e.hdrs.get('Retry-After')))
+                        except (TypeError, ValueError):
+                                time.sleep(wait_default)
+        raise oaipmh.client.Error(
+                        'Waited too often (more than %s times)' % wait_max)
+
+def raise_error(element):
+        '''raise the pyoai exception for an OAI-PMH <error> element'''
+        code = element.get('code') or 'unknown'
+        name = code[0].upper() + code[1:] + 'Error'
+        raise getattr(oaipmh.error, name, oaipmh.error.UnknownError)(
+                        element.text)
+
+class ResponseParser(object):
+        '''incremental parser of one ListRecords or ListIdentifiers page
+
+        Iterating over the parser yields the <record> elements (or the
+        <header> elements of ListIdentifiers) of the page as they are
+        parsed.  An element, and everything parsed before it, is cleared
+        when the next one is requested, so consumers must take what they
+        need from an element before moving on.  OAI-PMH errors are
+        raised as the pyoai exceptions.  Once the page is exhausted,
+        token holds its resumption token (None on the last page) and
+        complete_list_size the size of the whole list if the source
+        tells it.
+
+        :param source: the response
+        :type source: file-like object or file name
+        '''
+        def __init__(self, source):
+                self.source = source
+                self.token = None
+                self.complete_list_size = None
+                self.cursor = None
+
+        def __iter__(self):
+                context = lxml.etree.iterparse(self.source, events=('end',),
+                                tag=(_record, _header, _token, _error))
+                try:
+                        for _, element in context:
+                                if element.tag == _error:
+                                        raise_error(element)
+                                if element.tag == _token:
+                                        self._read_token(element)
+                                        continue
+                                if element.tag == _header and \
+                                        element.getparent().tag != \
+                                                _list_identifiers:
+                                        continue # header of a record
+                                yield element
+                                element.clear()
+                                while element.getprevious() is not None:
+                                        del element.getparent()[0]
+                except lxml.etree.XMLSyntaxError, e:
+                        raise oaipmh.error.XMLSyntaxError(str(e))
+                finally:
+                        del context
+
+        def _read_token(self, element):
+                self.token = (element.text or '').strip() or None
+                size = element.get('completeListSize')
+                if size and size.isdigit():
+                        self.complete_list_size = int(size)
+                cursor = element.get('cursor')
+                if cursor and cursor.isdigit():
+                        self.cursor = int(cursor)
+
+def iter_pages(open_page, args):
+        '''iterate over the pages of a list request
+
+        :param open_page: function that makes a request and returns the
+                response
+        :type open_page: function of (hash) -> file-like object
+        :param args: arguments of the first request; later pages are
+                requested with the resumption token alone
+        :type args: hash from string to string
+        :returns: a parser for each page; the next page is requested
+                when the previous one has been read through
+        :rtype: iterator of ResponseParser instances
+        '''
+        verb = args['verb']
+        while True:
+                response = open_page(args)
+                try:
+                        page = ResponseParser(response)
+                        yield page
+                finally:
+                        response.close()
+                if page.token is None:
+                        return
+                args = {'verb': verb, 'resumptionToken': page.token}
+
+def page_opener(client):
+        '''return a function that opens list pages with a pyoai client
+
+        The pages are requested like the client's own, with its
+        credentials and instrumentation.  A StreamingClient's pages are
+        read as they are parsed, those of other clients whole.
+
+        :returns: function of request arguments, including verb, that
+                returns the response
+        :rtype: function of (hash) -> file-like object
+        '''
+        open_page = getattr(client, '_open', None)
+        if open_page is not None:
+                return open_page
+        def read_page(args):
+                text = client.makeRequest(**args)
+                if isinstance(text, unicode):
+                        text = text.encode('utf-8')
+                return StringIO(text)
+        return read_page
+
+class StreamingClient(oaipmh.client.Client):
+        '''pyoai client that reads list responses incrementally
+
+        listIdentifiers and listRecords are read with ResponseParser;
+        other verbs behave as in oaipmh.client.Client.  Metadata readers
+        get the <metadata> element of one record at a time and the
+        record is cleared afterwards, so readers that keep references to
+        elements (like the 'node' fields of KataMetadataReader) must not
+        expect them to outlive the next record.
+
+        Both can be resumed with resumptionToken.  The records of a
+        resumed listRecords are read with the reader of their format, so
+        it takes metadataPrefix along with the token; only the token is
+        sent to the source.
+        '''
+        def handleVerb(self, verb, kw):
+                if verb not in ('ListIdentifiers', 'ListRecords'):
+                        return super(StreamingClient, self).handleVerb(verb,
+                                        kw)
+                prefix = kw.get('metadataPrefix')
+                if kw.get('resumptionToken') is not None:
+                        if verb == 'ListRecords' and prefix is None:
+                                raise oaipmh.error.BadArgumentError(
+                                        'listRecords with resumptionToken '
+                                        'needs the metadataPrefix of the '
+                                        'records to read them')
+                        kw = dict(kw)
+                        kw.pop('metadataPrefix', None)
+                        validation.validateResumptionArguments(verb, kw)
+                else:
+                        validation.validateArguments(verb, kw)
+                args = dict((k, v) for k, v in kw.items() if v is not None)
+                for key, name in (('from_', 'from'), ('until', 'until')):
+                        if key in args:
+                                args[name] = datetime_to_datestamp(
+                                        args.pop(key), self._day_granularity)
+                args['verb'] = verb
+                if verb == 'ListIdentifiers':
+                        return self._iter_identifiers(args)
+                return self._iter_records(args, prefix)
+
+        def _open(self, args):
+                headers = {}
+                if self._credentials is not None:
+                        headers['Authorization'] = 'Basic ' + \
+                                        self._credentials.strip()
+                return open_request(self._base_url, args,
+                                post=True, headers=headers)
+
+        def _iter_identifiers(self, args):
+                for page in iter_pages(self._open, args):
+                        for element in page:
+                                yield oaipmh.client.buildHeader(element,
+                                                namespaces)
+
+        def _iter_records(self, args, prefix):
+                registry = self._metadata_registry
+                for page in iter_pages(self._open, args):
+                        for element in page:
+                                header = oaipmh.client.buildHeader(
+                                        element.find(_header), namespaces)
+                                e_metadata = element.find('{%s}metadata' % OAI)
+                                metadata = None
+                                if e_metadata is not None:
+                                        metadata = registry.readMetadata(
+                                                prefix, e_metadata)
+                                yield header, metadata, None
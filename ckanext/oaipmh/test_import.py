@@ -1,20 +1,25 @@
 # coding: utf-8
 # vi:et:ts=8:
+'''Manual checks of an OAI-PMH source with the importformats readers.
+
+These use the same streaming client and readers as bulkimport, which
+does whole ListRecords harvests.
+'''
 
-import oaipmh.client
 import importformats
+import streaming
+
+def _client(url):
+        return streaming.StreamingClient(url,
+                        importformats.create_metadata_registry())
 
 def test_fetch(url, record_id, fmt):
-        registry = importformats.create_metadata_registry()
-        client = oaipmh.client.Client(url, registry)
-        record = client.getRecord(identifier=record_id, metadataPrefix=fmt)
-        return record
+        return _client(url).getRecord(identifier=record_id,
+                        metadataPrefix=fmt)
 
 def test_list(url):
-        registry = importformats.create_metadata_registry()
-        client = oaipmh.client.Client(url, registry)
         return (header.identifier() for header in
-                        client.listIdentifiers(metadataPrefix='oai_dc'))
+                        _client(url).listIdentifiers(metadataPrefix='oai_dc'))
 
 if __name__ == '__main__':
         import sys
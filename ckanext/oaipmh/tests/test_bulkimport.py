@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from ckanext.oaipmh import bulkimport, streaming
+
+OAI = 'http://www.openarchives.org/OAI/2.0/'
+
+
+def _page(identifiers, token):
+    records = ''.join(
+        '<record><header><identifier>%s</identifier>'
+        '<datestamp>2013-01-01T00:00:00Z</datestamp></header>'
+        '<metadata><oai_dc:dc '
+        'xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+        'xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        '<dc:title>%s</dc:title></oai_dc:dc></metadata></record>'
+        % (ident, ident) for ident in identifiers)
+    token = '<resumptionToken>%s</resumptionToken>' % token if token \
+        else '<resumptionToken/>'
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<OAI-PMH xmlns="%s"><responseDate>2013-01-01T00:00:00Z'
+            '</responseDate><request>http://example.org/oai</request>'
+            '<ListRecords>%s%s</ListRecords></OAI-PMH>'
+            % (OAI, records, token))
+
+
+class Interrupted(Exception):
+    pass
+
+
+class TestResume(unittest.TestCase):
+
+    pages = {None: (['a', 'b', 'c'], 'page2'),
+             'page2': (['d', 'e', 'f'], 'page3'),
+             'page3': (['g'], None)}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'out.ndjson')
+        self.state = os.path.join(self.directory, 'out.state')
+        self.saved = streaming.open_request
+        streaming.open_request = lambda url, args: StringIO(
+            _page(*self.pages[args.get('resumptionToken')]))
+
+    def tearDown(self):
+        streaming.open_request = self.saved
+        shutil.rmtree(self.directory)
+
+    def _run(self, fail_at=None):
+        out = bulkimport.open_output(self.output, self.state)
+
+        def write(header, metadata):
+            if header.identifier() == fail_at:
+                raise Interrupted()
+            out.write(header.identifier() + '\n')
+        try:
+            bulkimport.import_records(
+                'http://example.org/oai', 'oai_dc', write, state=self.state,
+                checkpoint=lambda: bulkimport._file_checkpoint(out))
+        finally:
+            out.close()
+
+    def test_partial_page_not_repeated(self):
+        self.assertRaises(Interrupted, self._run, fail_at='f')
+        self.assertEqual(bulkimport.read_state(self.state), 'page2')
+        self._run()
+        with open(self.output) as f:
+            self.assertEqual(f.read().split(), list('abcdefg'))
+        self.assertFalse(os.path.exists(self.state))
+
+    def test_old_state(self):
+        # A state file with only a token leaves the output as it is.
+        bulkimport.write_state(self.state, 'page3')
+        with open(self.output, 'w') as f:
+            f.write('x\n')
+        self._run()
+        with open(self.output) as f:
+            self.assertEqual(f.read().split(), ['x', 'g'])
@@ -0,0 +1,60 @@
+import gzip
+import unittest
+import zlib
+from StringIO import StringIO
+
+from ckanext.oaipmh.compression import PrecompressedText, \
+    ResponseCompressor, deflate, negotiate
+
+
+def decompress(encoding, body):
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=StringIO(body)).read()
+    return zlib.decompress(body)
+
+
+class TestNegotiate(unittest.TestCase):
+
+    def test_negotiate(self):
+        self.assertEqual(negotiate(None), None)
+        self.assertEqual(negotiate('gzip'), 'gzip')
+        self.assertEqual(negotiate('deflate'), 'deflate')
+        self.assertEqual(negotiate('deflate, gzip'), 'gzip')
+        self.assertEqual(negotiate('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(negotiate('*'), 'gzip')
+        self.assertEqual(negotiate('gzip;q=0, *;q=0.1'), 'deflate')
+        self.assertEqual(negotiate('br'), None)
+        # Nothing acceptable but identity, which is not acceptable
+        # either: the response is sent without content coding.
+        self.assertEqual(negotiate('identity;q=0'), None)
+        self.assertEqual(negotiate('identity;q=0, gzip'), 'gzip')
+        self.assertEqual(negotiate('gzip;q=x'), None)
+
+
+class TestResponseCompressor(unittest.TestCase):
+
+    parts = ['<OAI-PMH>', '<record>one</record>' * 50,
+             PrecompressedText('<record>two</record>',
+                               deflate('<record>two</record>')),
+             PrecompressedText('<record>three</record>',
+                               deflate('<record>three</record>')),
+             '', '<record>one</record>' * 50, '</OAI-PMH>']
+
+    def test_spliced(self):
+        for encoding in ('gzip', 'deflate'):
+            body = ''.join(ResponseCompressor(encoding).iterate(self.parts))
+            self.assertEqual(decompress(encoding, body), ''.join(self.parts))
+
+    def test_empty(self):
+        for encoding in ('gzip', 'deflate'):
+            body = ''.join(ResponseCompressor(encoding).iterate([]))
+            self.assertEqual(decompress(encoding, body), '')
+
+    def test_flushed_per_part(self):
+        compressor = ResponseCompressor('deflate')
+        decompressor = zlib.decompressobj()
+        out = decompressor.decompress(compressor.header())
+        for part in self.parts:
+            out += decompressor.decompress(compressor.compress(part))
+            # Every part can be decompressed as soon as it is sent.
+            self.assertTrue(out.endswith(part))
@@ -0,0 +1,88 @@
+# coding: utf-8
+import unittest
+
+from lxml import etree
+
+from ckanext.oaipmh import importformats, importpool
+
+oai_dc_metadata = '''<metadata xmlns="http://www.openarchives.org/OAI/2.0/">
+<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+           xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <dc:title xml:lang="fi">Perunan typpilannoitus</dc:title>
+  <dc:title>Nitrogen fertilization of potato</dc:title>
+  <dc:creator>Tall, Anna</dc:creator>
+  <dc:subject>peruna</dc:subject>
+  <dc:identifier>http://hdl.handle.net/1975/7634</dc:identifier>
+  <dc:language>fi</dc:language>
+</oai_dc:dc>
+</metadata>'''
+
+
+class TestLazyMetadata(unittest.TestCase):
+
+    def _read(self):
+        return importformats.dc_metadata_reader(
+                etree.XML(oai_dc_metadata)).getMap()
+
+    def test_alias_on_access(self):
+        md = self._read()
+        self.assert_(md['title.0'] == u'Perunan typpilannoitus')
+        self.assert_(md['title.count'] == 2)
+        self.assert_(md['creator.0/name.0'] == u'Tall, Anna')
+        self.assert_(md.get('publisher.0') is None)
+        self.assert_(md['distributor.count'] == 0)
+
+    def test_unused_fields_not_materialized(self):
+        md = self._read()
+        md['title.0']
+        self.assert_('creator' in md._pending)
+        self.assert_('title' not in md._pending)
+        self.assert_('creator.0/name.0' not in md._map)
+
+    def test_materialize_all(self):
+        md = self._read()
+        full = md.copy()
+        self.assert_(type(full) is dict)
+        self.assert_(full['subject.0'] == u'peruna')
+        self.assert_(full['versionidentifier.0'] ==
+                     u'http://hdl.handle.net/1975/7634')
+        self.assert_(full['metadata/oai_dc:dc.0/dc:title.count'] == 2)
+        self.assert_(len(md) == len(full))
+        self.assert_(dict(md.items()) == full)
+
+
+class TestParsePool(unittest.TestCase):
+
+    def _records(self, count):
+        metadata = oai_dc_metadata.replace(
+                '<metadata xmlns="http://www.openarchives.org/OAI/2.0/">',
+                '<metadata>')
+        for i in range(count):
+            yield ('<record xmlns="http://www.openarchives.org/OAI/2.0/">'
+                   '<header><identifier>oai:test:%d</identifier>'
+                   '<datestamp>2011-06-09T14:38:35Z</datestamp></header>'
+                   '%s</record>' % (i, metadata))
+        yield ('<record xmlns="http://www.openarchives.org/OAI/2.0/">'
+               '<header status="deleted"><identifier>oai:test:gone'
+               '</identifier><datestamp>2012-01-01</datestamp></header>'
+               '</record>')
+
+    def _check(self, processes):
+        keys = ['title.0', 'creator.0/name.0', 'publisher.0']
+        with importpool.ParsePool('oai_dc', processes=processes, keys=keys,
+                                  chunksize=3) as pool:
+            results = list(pool.imap(self._records(10)))
+        self.assert_(len(results) == 11)
+        self.assert_([header.identifier() for header, _ in results[:10]] ==
+                     ['oai:test:%d' % i for i in range(10)])
+        header, md = results[0]
+        self.assert_(md == {'title.0': u'Perunan typpilannoitus',
+                            'creator.0/name.0': u'Tall, Anna'})
+        header, md = results[-1]
+        self.assert_(header.isDeleted() and md is None)
+
+    def test_inline(self):
+        self._check(0)
+
+    def test_processes(self):
+        self._check(2)
@@ -0,0 +1,81 @@
+import threading
+import unittest
+from StringIO import StringIO
+
+from ckanext.oaipmh import metrics
+
+
+class FakeClient(object):
+
+    def makeRequest(self, **kw):
+        return '<OAI-PMH/>'
+
+    def _open(self, args):
+        return StringIO('<OAI-PMH></OAI-PMH>')
+
+
+class TestHarvestStages(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = metrics.harvest_registry
+        self.registry = metrics.harvest_registry = metrics.HarvestRegistry()
+
+    def tearDown(self):
+        metrics.harvest_registry = self.saved
+
+    def test_nested_stages(self):
+        client = metrics.instrument_client(FakeClient())
+
+        @metrics.measured_stage('oai_dc2ckan')
+        def convert():
+            metrics.count_harvest('records')
+            return client._open({}).read()
+
+        with metrics.harvest_stage('import', 'http://a', 'job') as stage:
+            client.makeRequest(verb='GetRecord')
+            convert()
+            metrics.count_harvest('retries')
+        self.assertEqual(stage.requests, 2)
+        self.assertEqual(stage.bytes, 10 + 19)
+        self.assertEqual(stage.records, 1)
+        self.assertEqual(stage.retries, 1)
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot[('http://a', 'oai_dc2ckan')]['requests'], 1)
+        self.assertEqual(snapshot[('http://a', 'oai_dc2ckan')]['retries'], 0)
+        job = self.registry.job('job')
+        self.assertEqual(sorted(job), ['import', 'oai_dc2ckan'])
+        self.assertEqual(job['import']['runs'], 1)
+
+    def test_error(self):
+        def fail():
+            with metrics.harvest_stage('gather', 'http://a', 'job'):
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(
+            self.registry.snapshot()[('http://a', 'gather')]['errors'], 1)
+        # Nothing is counted outside of stages.
+        metrics.count_harvest('records')
+        metrics.count_harvest_request(1.0, 100)
+
+    def test_other_threads(self):
+        client = metrics.instrument_client(FakeClient())
+        with metrics.harvest_stage('gather', 'http://a', 'job') as stage:
+            request = metrics.in_current_stages(client.makeRequest)
+            threads = [threading.Thread(target=request,
+                                        kwargs={'verb': 'ListIdentifiers'})
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(getattr(metrics._current, 'stages'), [stage])
+        self.assertEqual(stage.requests, 4)
+        self.assertEqual(stage.bytes, 4 * 10)
+
+    def test_jobs_bounded(self):
+        for job in range(metrics.MAX_JOBS + 1):
+            with metrics.harvest_stage('gather', 'http://a', str(job)):
+                pass
+        self.assertEqual(self.registry.job('0'), None)
+        self.assertNotEqual(self.registry.job(str(metrics.MAX_JOBS)), None)
+        self.assertTrue('job="1"' in self.registry.render())
@@ -1,11 +1,14 @@
 # coding: utf-8
+import gzip
 import logging
 import os
 import unittest
 import mock
+import urllib
 import urllib2
 from StringIO import StringIO
 import json
+import zlib
 # import contextlib
 from datetime import datetime, timedelta
 
@@ -24,6 +27,8 @@ from oaipmh.client import Client, ServerClient
 from oaipmh.server import BatchingServer, oai_dc_writer
 from oaipmh.metadata import MetadataRegistry, oai_dc_reader
 from oaipmh import metadata
+from oaipmh import common
+from oaipmh.error import NoSetHierarchyError
 import oaipmh.client
 from pylons import config
 
@@ -31,7 +36,8 @@ from ckanext.oaipmh.harvester import OAIPMHHarvester, GatherFailure
 from ckanext.harvest.model import HarvestJob, HarvestSource, HarvestObject, HarvestGatherError,\
     HarvestObjectError, setup
 
-from ckanext.oaipmh.oaipmh_server import CKANServer
+from ckanext.oaipmh.oaipmh_server import CKANServer, KeysetServer
+from ckanext.oaipmh import model as oaipmh_model
 from ckanext.oaipmh.rdftools import rdf_reader, rdf_writer
 
 
@@ -45,6 +51,40 @@ oaischema = etree.XMLSchema(etree.parse(fileInTestDir('OAI-PMH.xsd')))
 oairdfschema = etree.XMLSchema(etree.parse(fileInTestDir('rdf.xsd')))
 
 realopen = urllib2.urlopen
+OAI = 'http://www.openarchives.org/OAI/2.0/'
+
+
+class ReturningSource(object):
+    '''Client of a source with one record, which can be deleted and come
+    back.'''
+
+    identifier = 'oai:reborn.example.org:1'
+
+    def __init__(self):
+        self.deleted = False
+
+    def identify(self):
+        identify = mock.Mock()
+        identify.repositoryName.return_value = 'reborn.example.org'
+        identify.deletedRecord.return_value = 'transient'
+        return identify
+
+    def updateGranularity(self):
+        pass
+
+    def _header(self):
+        return common.Header(self.identifier, datetime.now(), [],
+                             self.deleted)
+
+    def listIdentifiers(self, **kw):
+        return [self._header()]
+
+    def listSets(self, **kw):
+        raise NoSetHierarchyError()
+
+    def getRecord(self, **kw):
+        return self._header(), common.Metadata({
+            'title': ['Reborn'], 'identifier': [self.identifier]}), None
 
 
 class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
@@ -119,6 +159,7 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
                        {'name':'roger14', 'title':'roger', 'description':''}]
         CreateTestData.create_groups(group_dicts)
         setup()
+        oaipmh_model.setup()
         cls._first = True
         cls._second = False
 
@@ -272,12 +313,338 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
         for rec in recs:
             self.assert_(rec)
 
+    def test_keyset_resumption(self):
+        metadata_reg = MetadataRegistry()
+        metadata_reg.registerReader('oai_dc', oai_dc_reader)
+        metadata_reg.registerWriter('oai_dc', oai_dc_writer)
+        serv = KeysetServer(CKANServer(), metadata_registry=metadata_reg,
+                            resumption_batch_size=2)
+        client = ServerClient(serv, metadata_reg)
+        idents = [header.identifier() for header in
+                  client.listIdentifiers(metadataPrefix='oai_dc')]
+        self.assertEqual(len(idents), len(set(idents)))
+        self.assertEqual(len(idents), Session.query(Package).count() +
+                         Session.query(oaipmh_model.PackageTombstone).count())
+        records = list(client.listRecords(metadataPrefix='oai_dc'))
+        self.assertEqual([header.identifier() for header, _, _ in records],
+                         idents)
+
+    def _canonical(self, body):
+        '''Return a response without whitespace and responseDate.'''
+        root = etree.fromstring(body, etree.XMLParser(remove_blank_text=True))
+        root.find('{%s}responseDate' % OAI).text = ''
+        return etree.tostring(root)
+
+    def test_streamed_responses(self):
+        metadata_reg = MetadataRegistry()
+        metadata_reg.registerReader('oai_dc', oai_dc_reader)
+        metadata_reg.registerWriter('oai_dc', oai_dc_writer)
+        plain = KeysetServer(CKANServer(), metadata_registry=metadata_reg,
+                             resumption_batch_size=5)
+        # Chunks that do not divide the pages.
+        streamed = KeysetServer(CKANServer(), metadata_registry=metadata_reg,
+                                resumption_batch_size=5, stream_chunk_size=2)
+        pkg = Package.by_name(u'lisa')
+        for verb in ('ListIdentifiers', 'ListRecords'):
+            kw = {'verb': verb, 'metadataPrefix': 'oai_dc'}
+            pages = 0
+            while True:
+                expected = plain.handleRequest(dict(kw))
+                body = streamed.handleRequest(dict(kw))
+                self.assert_(not isinstance(body, basestring))
+                body = ''.join(body)
+                self.assertEqual(self._canonical(body),
+                                 self._canonical(expected))
+                pages += 1
+                token = etree.fromstring(expected).find(
+                    './/{%s}resumptionToken' % OAI)
+                if token is None or not token.text:
+                    break
+                kw = {'verb': verb, 'resumptionToken': token.text}
+            self.assert_(pages > 1)
+        # Reading the responses kept the session and its objects.
+        self.assert_(pkg in Session)
+        self.assert_(pkg.name == u'lisa')
+
+    def _list_pages(self, query):
+        '''Return the pages of a list request through the controller.'''
+        pages = []
+        while True:
+            root = etree.fromstring(self.app.get(self.base_url + query).body)
+            pages.append(root)
+            token = root.find('.//{%s}resumptionToken' % OAI)
+            if token is None or not token.text:
+                return pages
+            query = '?verb=%s&resumptionToken=%s' % (
+                root.find('{%s}request' % OAI).get('verb'),
+                urllib.quote(token.text))
+
+    def _header_identifiers(self, root):
+        return [e.text for e in root.iter('{%s}identifier' % OAI)]
+
+    def test_shared_server(self):
+        # Interleaved requests with different arguments on the server of
+        # the process get what they would get alone.
+        metadata_reg = MetadataRegistry()
+        metadata_reg.registerReader('oai_dc', oai_dc_reader)
+        metadata_reg.registerWriter('oai_dc', oai_dc_writer)
+        alone = ServerClient(KeysetServer(CKANServer(),
+                                          metadata_registry=metadata_reg),
+                             metadata_reg)
+        roger = [header.identifier() for header in alone.listIdentifiers(
+            metadataPrefix='oai_dc', set='roger')]
+        everything = [header.identifier() for header in
+                      alone.listIdentifiers(metadataPrefix='oai_dc')]
+        first = etree.fromstring(self.app.get(
+            self.base_url +
+            '?verb=ListIdentifiers&metadataPrefix=oai_dc&set=roger').body)
+        token = first.find('.//{%s}resumptionToken' % OAI).text
+        self.assert_(token)
+        listed = [self._header_identifiers(page) for page in
+                  self._list_pages('?verb=ListRecords&metadataPrefix=oai_dc')]
+        self.assertEqual(sum(listed, []), everything)
+        rest = self._list_pages('?verb=ListIdentifiers&resumptionToken=%s'
+                                % urllib.quote(token))
+        self.assertEqual(sum([self._header_identifiers(page)
+                              for page in [first] + rest], []), roger)
+        # The set list kept by the server follows changes of the groups.
+        sets = lambda: sum([[e.text for e in page.iter('{%s}setName' % OAI)]
+                            for page in self._list_pages('?verb=ListSets')],
+                           [])
+        self.assert_(u'shared_set' not in sets())
+        model.repo.new_revision()
+        Group(name=u'shared_set', description=u'').save()
+        model.repo.commit_and_remove()
+        self.assert_(u'shared_set' in sets())
+
+    def test_tombstone_datestamp(self):
+        model.repo.new_revision()
+        Session.add(Package(name=u'purged_now'))
+        model.repo.commit_and_remove()
+        purged = Package.by_name(u'purged_now')
+        purged_id = purged.id
+        rev = model.repo.new_revision()
+        purged.purge()
+        model.repo.commit()
+        revised = rev.timestamp
+        Session.remove()
+        tombstone = Session.query(oaipmh_model.PackageTombstone).get(
+            purged_id)
+        # Both are UTC, so they differ by far less than any UTC offset.
+        self.assert_(abs(tombstone.datestamp - revised) < timedelta(
+            minutes=5), (tombstone.datestamp, revised))
+
+    def test_deleted_records(self):
+        model.repo.new_revision()
+        Session.add(Package(name=u'deleted_later'))
+        Session.add(Package(name=u'purged_later'))
+        model.repo.commit_and_remove()
+        model.repo.new_revision()
+        Package.by_name(u'deleted_later').delete()
+        model.repo.commit_and_remove()
+        purged = Package.by_name(u'purged_later')
+        purged_id = purged.id
+        model.repo.new_revision()
+        purged.purge()
+        model.repo.commit_and_remove()
+        body = self._oai_get_method_and_validate(
+            '?verb=Identify')
+        self.assert_('<deletedRecord>persistent</deletedRecord>' in body)
+        body = self._oai_get_method_and_validate(
+            '?verb=GetRecord&identifier=%s&metadataPrefix=oai_dc' % purged_id)
+        self.assert_('status="deleted"' in body)
+        metadata_reg = MetadataRegistry()
+        metadata_reg.registerReader('oai_dc', oai_dc_reader)
+        metadata_reg.registerWriter('oai_dc', oai_dc_writer)
+        serv = KeysetServer(CKANServer(), metadata_registry=metadata_reg)
+        client = ServerClient(serv, metadata_reg)
+        deleted = [header.identifier() for header, _, _ in
+                   client.listRecords(metadataPrefix='oai_dc')
+                   if header.isDeleted()]
+        self.assert_(purged_id in deleted)
+        self.assert_(Package.by_name(u'deleted_later').id in deleted)
+
+    def test_keyset_same_datestamp(self):
+        # Ids made from OAI identifiers, which collations may order
+        # differently from Python, all with the datestamp of one revision.
+        ids = [u'oai-B', u'oai-a', u'oai_c', u'oai.D', u'OAI-e']
+        rev = model.repo.new_revision()
+        for id in ids:
+            Session.add(Package(id=id, name=id.lower().replace('.', '-')))
+        model.repo.commit()
+        stamp = rev.timestamp
+        tombstone = oaipmh_model.PackageTombstone()
+        tombstone.package_id = u'oai-b'
+        tombstone.package_name = u'oai-b'
+        tombstone.datestamp = stamp
+        Session.add(tombstone)
+        model.repo.commit_and_remove()
+        metadata_reg = MetadataRegistry()
+        metadata_reg.registerReader('oai_dc', oai_dc_reader)
+        metadata_reg.registerWriter('oai_dc', oai_dc_writer)
+        serv = KeysetServer(CKANServer(), metadata_registry=metadata_reg,
+                            resumption_batch_size=1)
+        client = ServerClient(serv, metadata_reg)
+        listed = [header.identifier() for header in
+                  client.listIdentifiers(metadataPrefix='oai_dc')]
+        self.assertEqual(len(listed), len(set(listed)))
+        ids.append(u'oai-b')
+        self.assertEqual(sorted(id for id in listed if id in ids),
+                         sorted(ids))
+
+    def test_purged_in_set(self):
+        model.repo.new_revision()
+        pkg = Package(name=u'purged_tagged')
+        Session.add(pkg)
+        pkg.add_tag_by_name(u'purged_tag')
+        roger = Group.get('roger')
+        roger.add_package_by_name(u'purged_tagged')
+        model.repo.commit_and_remove()
+        purged = Package.by_name(u'purged_tagged')
+        purged_id = purged.id
+        model.repo.new_revision()
+        purged.purge()
+        model.repo.commit_and_remove()
+        # The tag purged with the package does not bring it back.
+        self.assert_(Session.query(oaipmh_model.PackageTombstone).
+                     get(purged_id))
+        self.assertFalse(Session.query(oaipmh_model.PackageDatestamp).
+                         get(purged_id))
+        metadata_reg = MetadataRegistry()
+        metadata_reg.registerReader('oai_dc', oai_dc_reader)
+        metadata_reg.registerWriter('oai_dc', oai_dc_writer)
+        serv = KeysetServer(CKANServer(), metadata_registry=metadata_reg,
+                            resumption_batch_size=2)
+        client = ServerClient(serv, metadata_reg)
+        roger_id = Group.get('roger').id
+        deleted = [header.identifier() for header in
+                   client.listIdentifiers(metadataPrefix='oai_dc',
+                                          set=roger_id)
+                   if header.isDeleted()]
+        self.assert_(purged_id in deleted)
+
+    def _record_cache_server(self):
+        metadata_reg = MetadataRegistry()
+        metadata_reg.registerReader('oai_dc', oai_dc_reader)
+        metadata_reg.registerWriter('oai_dc', oai_dc_writer)
+        return KeysetServer(CKANServer(record_cache=True),
+                            metadata_registry=metadata_reg)
+
+    def test_record_cache(self):
+        pkg = Package.by_name(u'lisa')
+        pkg_id = pkg.id
+        oaipmh_model.clear_record_fragments(pkg_id)
+        Session.commit()
+        serv = self._record_cache_server()
+        kw = {'verb': 'GetRecord', 'metadataPrefix': 'oai_dc',
+              'identifier': pkg_id}
+        cached = lambda: oaipmh_model.get_record_fragments([pkg_id],
+                                                           'oai_dc')
+        # A miss is written to the cache, leaving the session usable.
+        self.assert_(cached() == {})
+        self.assert_('Lisa' in serv.handleRequest(kw))
+        self.assert_(pkg.name == u'lisa')
+        xml, deflated = cached()[pkg_id]
+        self.assert_('Lisa' in xml and deflated)
+        # A hit is served from the cache.
+        cache = oaipmh_model.record_cache_table
+        Session.execute(cache.update().where(
+            cache.c.package_id == pkg_id).values(
+            xml=xml.replace('Lisa', 'Cached Lisa'), deflated=None))
+        Session.commit()
+        self.assert_('Cached Lisa' in serv.handleRequest(kw))
+        # A new datestamp of the package makes the cached record stale.
+        oaipmh_model.touch_package(pkg, datetime.now())
+        Session.commit()
+        self.assert_(cached() == {})
+        body = serv.handleRequest(kw)
+        self.assert_('Lisa' in body and 'Cached Lisa' not in body)
+        self.assert_(pkg_id in cached())
+        oaipmh_model.clear_record_fragments(pkg_id)
+        Session.commit()
+        self.assert_(cached() == {})
+
+    def test_list_sets_resumption(self):
+        metadata_reg = MetadataRegistry()
+        metadata_reg.registerWriter('oai_dc', oai_dc_writer)
+        serv = KeysetServer(CKANServer(), metadata_registry=metadata_reg,
+                            resumption_batch_size=1)
+        client = ServerClient(serv, metadata_reg)
+        specs = [spec for spec, _, _ in client.listSets()]
+        self.assertEqual(sorted(specs), specs)
+        self.assertEqual(len(specs), Session.query(Group).count())
+
     def test_list_metadata(self):
         self._oai_get_method_and_validate('?verb=ListMetadataFormats')
 
     def test_identify(self):
         self._oai_get_method_and_validate('?verb=Identify')
 
+    def test_conditional_get(self):
+        offset = self.base_url + '?verb=GetRecord&identifier=homer&metadataPrefix=oai_dc'
+        res = self.app.get(offset)
+        etag = res.header('ETag')
+        self.app.get(offset, headers={'If-None-Match': etag}, status=304)
+        self.app.get(offset, status=304, headers={
+            'If-Modified-Since': res.header('Last-Modified')})
+        res = self.app.get(offset, headers={'If-None-Match': 'W/"other"'})
+        self.assertEqual(res.status, 200)
+        # Updates within one second still change the ETag.
+        tags = set([etag])
+        for notes in (u'First', u'Second'):
+            model.repo.new_revision()
+            Package.by_name(u'homer').notes = notes
+            model.repo.commit_and_remove()
+            tags.add(self.app.get(offset).header('ETag'))
+        self.assertEqual(len(tags), 3)
+
+    def test_conditional_list_sets(self):
+        offset = self.base_url + '?verb=ListSets'
+        etag = lambda: self.app.get(offset).header('ETag')
+        before = etag()
+        model.repo.new_revision()
+        Group(name=u'etag_set', description=u'').save()
+        model.repo.commit_and_remove()
+        added = etag()
+        self.assertNotEqual(added, before)
+        model.repo.new_revision()
+        Group.get(u'etag_set').purge()
+        model.repo.commit_and_remove()
+        self.assertNotEqual(etag(), added)
+
+    def test_started_in_utc(self):
+        self.assert_(abs(CKANServer().started - datetime.utcnow()) <
+                     timedelta(minutes=1))
+
+    def test_compressed_responses(self):
+        body = self._oai_get_method_and_validate('?verb=Identify')
+        self.assert_('<compression>gzip</compression>' in body)
+        self.assert_('<compression>deflate</compression>' in body)
+        for query in ('?verb=Identify',
+                      '?verb=GetRecord&identifier=%s&metadataPrefix=oai_dc'
+                      % Package.by_name(u'lisa').id,
+                      '?verb=ListRecords&metadataPrefix=oai_dc'):
+            offset = self.base_url + query
+            plain = self._canonical(self.app.get(offset).body)
+            # The records are in the record cache now, so they are
+            # spliced into the compressed responses precompressed.
+            for accept, encoding in (('gzip', 'gzip'),
+                                     ('deflate', 'deflate'),
+                                     ('identity;q=0', None)):
+                res = self.app.get(offset,
+                                   headers={'Accept-Encoding': accept})
+                self.assertEqual(res.header('Content-Encoding', None),
+                                 encoding)
+                self.assert_('Accept-Encoding' in res.header('Vary'))
+                body = res.body
+                if encoding == 'gzip':
+                    body = gzip.GzipFile(fileobj=StringIO(body)).read()
+                elif encoding == 'deflate':
+                    body = zlib.decompress(body)
+                self.assertEqual(self._canonical(body), plain)
+        self.assert_(oaipmh_model.get_record_fragments(
+            [Package.by_name(u'lisa').id], 'oai_dc'))
+
     def test_get_record(self):
         metadata_reg = MetadataRegistry()
         metadata_reg.registerReader('oai_dc', oai_dc_reader)
@@ -347,6 +714,60 @@ class TestOAIPMH(FunctionalTestCase, unittest.TestCase):
         errs = Session.query(HarvestGatherError).all()
         self.assert_(errs[0].message == 'Could not gather from http://foo!')
 
+    def test_gather_several_sets(self):
+        metadata_registry = metadata.MetadataRegistry()
+        metadata_registry.registerReader('oai_dc', oai_dc_reader)
+        metadata_registry.registerWriter('oai_dc', oai_dc_writer)
+        serv = BatchingServer(CKANServer(), metadata_registry=metadata_registry)
+        oaipmh.client.Client = mock.Mock(return_value=ServerClient(serv, metadata_registry))
+        job, harv = self._create_harvester_info(config=False)
+        # roger1 has no records; roger twice lists every record twice.
+        job.source.config = '{"set": ["roger", "roger1", "roger"], "set_threads": 2}'
+        gathered = [json.loads(HarvestObject.get(ident).content)
+                    for ident in harv.gather_stage(job)]
+        records = [info['record'] for info in gathered
+                   if info['fetch_type'] == 'record']
+        self.assert_(records)
+        self.assert_(sorted(records) == sorted(set(records)))
+        sets = [info['set'] for info in gathered if info['fetch_type'] == 'set']
+        self.assert_(sorted(sets) == ['roger', 'roger1'])
+
+    def test_retired_record_returns(self):
+        source = HarvestSource(url='http://reborn.example.org/oai',
+                               type='OAI-PMH', config='')
+        Session.add(source)
+        client = ReturningSource()
+        harv = OAIPMHHarvester()
+        harv._create_client = mock.Mock(return_value=client)
+        urllib2.urlopen = mock.Mock(
+            side_effect=lambda url: StringIO('<record/>'))
+
+        def harvest():
+            job = HarvestJob(source=source)
+            Session.add(job)
+            gathered = [HarvestObject.get(ident)
+                        for ident in harv.gather_stage(job)]
+            for harvest_object in gathered:
+                harv.import_stage(harvest_object)
+            return gathered
+
+        try:
+            first, = harvest()
+            pkg_id = first.package_id
+            self.assert_(Package.get(pkg_id).state == 'active')
+            client.deleted = True
+            self.assert_(harvest() == [])
+            self.assert_(Package.get(pkg_id).state == 'deleted')
+            self.assert_(not HarvestObject.get(first.id).current)
+            client.deleted = False
+            second, = harvest()
+            self.assert_(second.package_id == pkg_id)
+            self.assert_(Package.get(pkg_id).state == 'active')
+            self.assert_(HarvestObject.get(second.id).current)
+            self.assert_(not HarvestObject.get(first.id).current)
+        finally:
+            urllib2.urlopen = realopen
+
     def test_zharvester_import(self, mocked=True):
         harvest_object, harv = self._create_harvester()
         self.assert_(harv.info()['name'] == 'OAI-PMH')
@@ -0,0 +1,70 @@
+import os
+import time
+import unittest
+
+from oaipmh.client import Client
+from oaipmh.metadata import MetadataRegistry, oai_dc_reader
+
+from ckanext.oaipmh.pipeline import RecordFetcher, prefetch
+from ckanext.oaipmh.replay import Recording, ReplayServer
+
+FAKE1 = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'fake1')
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def test_items(self):
+        self.assertEqual(list(prefetch(iter(range(100)), 10)), range(100))
+
+    def test_error(self):
+        def failing():
+            yield 1
+            raise ValueError()
+        items = prefetch(failing())
+        self.assertEqual(items.next(), 1)
+        self.assertRaises(ValueError, items.next)
+
+
+class TestRecordFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ReplayServer(('localhost', 0), Recording(FAKE1),
+                                   latency=0.1, ignore_dates=True)
+        self.server.start()
+        self.addCleanup(self.server.shutdown)
+        registry = MetadataRegistry()
+        registry.registerReader('oai_dc', oai_dc_reader)
+        self.client = Client(self.server.url, registry)
+
+    def _original_url(self, identifier, prefix):
+        return '%s?verb=GetRecord&identifier=%s&metadataPrefix=%s' % (
+            self.server.url, identifier, prefix)
+
+    def test_in_flight(self):
+        identifiers = ['hdl:1765/315'] * 20 + ['missing']
+        fetcher = RecordFetcher(self.client, ['oai_dc'], self._original_url,
+                                in_flight=42)
+        start = time.time()
+        results = list(fetcher.fetch(identifiers))
+        # 42 requests of 0.1 s each, all at a time.
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual([ident for ident, _ in results], identifiers)
+        (header, metadata, _), original = results[0][1]['oai_dc']
+        self.assertEqual(header.identifier(), 'hdl:1765/315')
+        self.assertTrue(metadata.getMap()['title'])
+        self.assertTrue(original.startswith('<?xml'))
+        record, original = results[-1][1]['oai_dc']
+        self.assertTrue(isinstance(record, Exception))
+
+    def test_none_identifier(self):
+        # A None from the listing does not end it.
+        fetcher = RecordFetcher(self.client, ['oai_dc'])
+        results = list(fetcher.fetch(['hdl:1765/315', None,
+                                      'hdl:1765/315']))
+        self.assertEqual([ident for ident, _ in results],
+                         ['hdl:1765/315', None, 'hdl:1765/315'])
+
+    def test_listing(self):
+        headers = prefetch(self.client.listIdentifiers(
+            metadataPrefix='oai_dc'))
+        self.assertEqual(len(list(headers)), 16)
@@ -0,0 +1,46 @@
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from ckanext.oaipmh import profiling
+
+
+class TestProfiled(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = profiling._profiles
+        profiling._profiles = profiling.OrderedDict()
+
+    def tearDown(self):
+        profiling._profiles = self.saved
+        shutil.rmtree(self.directory)
+
+    def _run(self, job, stage, interval):
+        with profiling.profiled(self.directory, job, stage, interval):
+            sum(range(1000))
+
+    def test_dumped_once_per_interval(self):
+        path = profiling.profile_path(self.directory, 'job', 'import')
+        self._run('job', 'import', 3600)
+        # The first run is written at once.
+        self.assertTrue(os.path.exists(path))
+        os.remove(path)
+        self._run('job', 'import', 3600)
+        self.assertFalse(os.path.exists(path))
+        profiling.dump_profiles()
+        self.assertTrue(pstats.Stats(path).stats)
+        with open(profiling.summary_path(path)) as summary:
+            self.assertTrue('range' in summary.read())
+
+    def test_dumped_when_dropped(self):
+        path = profiling.profile_path(self.directory, 'old', 'import')
+        self._run('old', 'import', 3600)
+        os.remove(path)
+        self._run('old', 'import', 3600)
+        for job in range(profiling.MAX_PROFILES):
+            self._run(str(job), 'import', 3600)
+        self.assertEqual(profiling.get_profile('old', 'import'), None)
+        self.assertTrue(os.path.exists(path))
@@ -0,0 +1,42 @@
+# coding: utf-8
+import unittest
+
+from lxml import etree
+
+from oaipmh import common
+from oaipmh.server import NS_XSI, NSMAP, nsoai
+
+from ckanext.oaipmh.rdftools import rdf_serializer, rdf_writer
+
+
+class TestRdfSerializer(unittest.TestCase):
+
+    def _metadata_element(self):
+        root = etree.Element(nsoai('OAI-PMH'), nsmap=NSMAP)
+        root.set('{%s}schemaLocation' % NS_XSI, '')
+        return etree.SubElement(root, nsoai('metadata'))
+
+    def _compare(self, map):
+        metadata = common.Metadata(map)
+        e_metadata = self._metadata_element()
+        rdf_writer(e_metadata, metadata)
+        expected = etree.tostring(e_metadata, encoding=unicode)
+        start = etree.tostring(self._metadata_element(),
+                               encoding=unicode)[:-2] + u'>'
+        self.assertEqual(start + rdf_serializer(metadata) + u'</metadata>',
+                         expected)
+
+    def test_same_as_writer(self):
+        self._compare({'title': [u'Perunan typpilannoitus', u'Ä & <b>\r\n'],
+                       'creator': [None],
+                       'subject': [''],
+                       'identifier': ['urn:nbn:fi:1',
+                                      'http://example.org/a?b=1&c="2"']})
+
+    def test_empty(self):
+        self._compare({})
+        self._compare({'title': [None]})
+
+    def test_invalid_text(self):
+        metadata = common.Metadata({'title': [u'a', u'\x01b']})
+        self.assertRaises(ValueError, rdf_serializer, metadata)
@@ -0,0 +1,20 @@
+import unittest
+
+from ckanext.oaipmh.reconcile import missing, sorted_unique
+
+
+class TestReconcile(unittest.TestCase):
+
+    def test_sorted_unique_in_runs(self):
+        items = [u'id%i' % (i * 7 % 50) for i in range(120)]
+        self.assertEqual(list(sorted_unique(items, run_size=8)),
+                         sorted(set(items)))
+        self.assertEqual(list(sorted_unique(items)), sorted(set(items)))
+        self.assertEqual(list(sorted_unique([])), [])
+
+    def test_missing(self):
+        local = sorted_unique([u'a', u'c', u'b', u'e', u'g'], run_size=2)
+        remote = sorted_unique([u'b', u'x', u'e', u'a', u'a'], run_size=2)
+        self.assertEqual(list(missing(local, remote)), [u'c', u'g'])
+        self.assertEqual(list(missing([u'a'], [])), [u'a'])
+        self.assertEqual(list(missing([], [u'a'])), [])
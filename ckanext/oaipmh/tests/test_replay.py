@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+from datetime import datetime
+
+from oaipmh.client import Client
+from oaipmh.metadata import MetadataRegistry, oai_dc_reader
+
+from ckanext.oaipmh.replay import Recording, ReplayServer
+
+FAKE1 = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'fake1')
+
+
+class TestReplay(unittest.TestCase):
+
+    def _client(self, **kw):
+        server = ReplayServer(('localhost', 0), Recording(FAKE1), **kw)
+        server.start()
+        self.addCleanup(server.shutdown)
+        registry = MetadataRegistry()
+        registry.registerReader('oai_dc', oai_dc_reader)
+        return server, Client(server.url, registry)
+
+    def _identifiers(self, client):
+        return [header.identifier() for header in client.listIdentifiers(
+            metadataPrefix='oai_dc', from_=datetime(2003, 4, 10))]
+
+    def test_replay(self):
+        server, client = self._client()
+        self.assertEqual(client.identify().repositoryName(),
+                         'Erasmus University : Research Online')
+        self.assertEqual(len(self._identifiers(client)), 16)
+        header, _, _ = client.getRecord(metadataPrefix='oai_dc',
+                                        identifier='hdl:1765/315')
+        self.assertEqual(header.identifier(), 'hdl:1765/315')
+
+    def test_page_size(self):
+        _, recorded = self._client()
+        server, client = self._client(page_size=3)
+        self.assertEqual(self._identifiers(client),
+                         self._identifiers(recorded))
+        self.assertEqual(server.requests, 6)
+        self.assertEqual(len(list(client.listSets())), 10)
+
+    def test_record(self):
+        upstream, _ = self._client()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        server, client = self._client()
+        server.recording = Recording(directory)
+        server.upstream = upstream.url
+        client.identify()
+        self.assertEqual(server.misses, 1)
+        client.identify()
+        self.assertEqual(server.misses, 1)
+        self.assertEqual(Recording(directory).files,
+                         {'verb=Identify': '00000.xml'})
+        self.assertRaises(urllib2.HTTPError, client.getRecord,
+                          metadataPrefix='oai_dc', identifier='missing')
+
+    def test_errors(self):
+        _, client = self._client(error_rate=1.0, error_code=500)
+        self.assertRaises(urllib2.HTTPError, client.identify)
@@ -0,0 +1,118 @@
+'''Latency, memory and query counts of the verbs as the repository grows.
+
+Skipped unless ckanext.oaipmh.test.scale_sizes lists repository sizes in
+the test configuration, e.g.
+
+    ckanext.oaipmh.test.scale_sizes = 1000 10000 100000
+
+The repository is grown to every size in turn with synthetic packages,
+and every verb is run at every size. Paged verbs should cost the same
+at any size; a verb whose latency or query count grows with the
+repository fails the test.
+'''
+import logging
+import resource
+import time
+import unittest
+from itertools import islice
+
+from nose.plugins.skip import SkipTest
+from pylons import config
+
+from ckan.model import Session, Package
+from oaipmh.client import ServerClient
+from oaipmh.metadata import MetadataRegistry, oai_dc_reader
+from oaipmh.server import oai_dc_writer
+
+from ckanext.oaipmh import metrics
+from ckanext.oaipmh.generate import generate_repository
+from ckanext.oaipmh.oaipmh_server import CKANServer, KeysetServer
+
+log = logging.getLogger(__name__)
+
+PREFIX = u'scale'
+# Latency may grow this many times from the smallest size to the largest
+# before it counts as growing with the repository.
+LATENCY_GROWTH = 5
+
+
+class TestScale(unittest.TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        sizes = config.get('ckanext.oaipmh.test.scale_sizes')
+        if not sizes:
+            raise SkipTest('ckanext.oaipmh.test.scale_sizes not set')
+        cls.sizes = sorted(int(size) for size in sizes.split())
+
+    def _client(self):
+        registry = MetadataRegistry()
+        registry.registerReader('oai_dc', oai_dc_reader)
+        registry.registerWriter('oai_dc', oai_dc_writer)
+        server = KeysetServer(CKANServer(), metadata_registry=registry,
+                              resumption_batch_size=100)
+        return ServerClient(server, registry)
+
+    def _verbs(self):
+        name = Session.query(Package.name).filter(
+            Package.name.like(PREFIX + u'-%')).first()[0]
+        first_page = lambda items: list(islice(items, 100))
+        return [
+            ('Identify', lambda client: client.identify()),
+            ('ListMetadataFormats',
+             lambda client: client.listMetadataFormats()),
+            ('ListSets', lambda client: list(client.listSets())),
+            ('GetRecord', lambda client: client.getRecord(
+                metadataPrefix='oai_dc', identifier=name)),
+            ('ListIdentifiers', lambda client: first_page(
+                client.listIdentifiers(metadataPrefix='oai_dc'))),
+            ('ListRecords', lambda client: first_page(
+                client.listRecords(metadataPrefix='oai_dc'))),
+            ('ListRecords set', lambda client: first_page(
+                client.listRecords(metadataPrefix='oai_dc',
+                                   set=PREFIX + u'-group-0'))),
+        ]
+
+    def _measure(self, verb, call):
+        client = self._client()
+        Session.remove()
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        request = metrics.start_request(verb)
+        start = time.time()
+        call(client)
+        seconds = time.time() - start
+        metrics.finish_request(request)
+        return (seconds, request.queries,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory)
+
+    def test_scaling(self):
+        results = {}
+        for size in self.sizes:
+            existing = Session.query(Package).filter(
+                Package.name.like(PREFIX + u'-%')).count()
+            if size > existing:
+                generate_repository(size - existing, prefix=PREFIX)
+            for verb, call in self._verbs():
+                results[verb, size] = self._measure(verb, call)
+        lines = ['%-20s %10s %10s %10s %12s' % ('verb', 'size', 'seconds',
+                                                'queries', 'peak KiB')]
+        for verb, _ in self._verbs():
+            for size in self.sizes:
+                seconds, queries, memory = results[verb, size]
+                lines.append('%-20s %10i %10.3f %10i %12i' % (
+                    verb, size, seconds, queries, memory))
+        table = '\n'.join(lines)
+        log.info('OAI-PMH verbs by repository size:\n%s' % table)
+        smallest, largest = self.sizes[0], self.sizes[-1]
+        for verb, _ in self._verbs():
+            seconds, queries, _ = results[verb, largest]
+            base_seconds, base_queries, _ = results[verb, smallest]
+            self.assertTrue(queries <= base_queries, '%s makes %i queries '
+                            'at %i packages, %i at %i\n%s' % (
+                                verb, queries, largest, base_queries,
+                                smallest, table))
+            self.assertTrue(seconds <= max(base_seconds, 0.01) *
+                            LATENCY_GROWTH, '%s takes %.3f s at %i '
+                            'packages, %.3f s at %i\n%s' % (
+                                verb, seconds, largest, base_seconds,
+                                smallest, table))
@@ -0,0 +1,43 @@
+import unittest
+from StringIO import StringIO
+
+from oaipmh.error import BadArgumentError
+from oaipmh.metadata import MetadataRegistry, oai_dc_reader
+
+from ckanext.oaipmh import streaming
+from ckanext.oaipmh.streaming import StreamingClient
+from ckanext.oaipmh.tests.test_bulkimport import _page
+
+
+class TestStreamingClient(unittest.TestCase):
+
+    pages = {None: (['a', 'b'], 'page2'),
+             'page2': (['c'], None)}
+
+    def setUp(self):
+        self.requests = []
+        self.saved = streaming.open_request
+
+        def open_request(url, args, **kw):
+            self.requests.append(dict(args))
+            return StringIO(_page(*self.pages[args.get('resumptionToken')]))
+        streaming.open_request = open_request
+        registry = MetadataRegistry()
+        registry.registerReader('oai_dc', oai_dc_reader)
+        self.client = StreamingClient('http://example.org/oai', registry)
+
+    def tearDown(self):
+        streaming.open_request = self.saved
+
+    def test_resumed_records(self):
+        records = list(self.client.listRecords(resumptionToken='page2',
+                                               metadataPrefix='oai_dc'))
+        self.assertEqual([header.identifier() for header, _, _ in records],
+                         ['c'])
+        self.assertEqual(records[0][1].getField('title'), ['c'])
+        self.assertEqual(self.requests, [{'verb': 'ListRecords',
+                                          'resumptionToken': 'page2'}])
+
+    def test_resumed_without_prefix(self):
+        self.assertRaises(BadArgumentError, self.client.listRecords,
+                          resumptionToken='page2')
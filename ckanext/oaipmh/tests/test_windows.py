@@ -0,0 +1,163 @@
+import threading
+import unittest
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+from oaipmh.datestamp import datestamp_to_datetime
+
+from ckanext.oaipmh import metrics, windows
+from ckanext.oaipmh.streaming import page_opener
+from ckanext.oaipmh.windows import Window, list_windows, split
+
+OAI = 'http://www.openarchives.org/OAI/2.0/'
+
+
+class FakeSource(object):
+    '''Answers ListIdentifiers from a list of datestamps, in pages.'''
+
+    def __init__(self, datestamps, page_size=10, fail_token=None,
+                 expired=()):
+        self.datestamps = sorted(datestamps)
+        self.page_size = page_size
+        self.fail_token = fail_token
+        self.expired = expired
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def __call__(self, args):
+        with self._lock:
+            self.requests.append(dict(args))
+        if 'resumptionToken' in args:
+            if args['resumptionToken'] == self.fail_token:
+                raise IOError('connection reset')
+            if args['resumptionToken'] in self.expired:
+                return StringIO('<OAI-PMH xmlns="%s"><error '
+                                'code="badResumptionToken"/></OAI-PMH>' % OAI)
+            from_, until, offset = args['resumptionToken'].split('|')
+            offset = int(offset)
+        else:
+            from_, until, offset = args['from'], args['until'], 0
+        matching = [(i, stamp) for i, stamp in enumerate(self.datestamps)
+                    if datestamp_to_datetime(from_) <= stamp <=
+                    datestamp_to_datetime(until)]
+        if not matching:
+            return StringIO('<OAI-PMH xmlns="%s"><error code="noRecordsMatch"'
+                            '/></OAI-PMH>' % OAI)
+        page = matching[offset:offset + self.page_size]
+        parts = ['<OAI-PMH xmlns="%s"><ListIdentifiers>' % OAI]
+        for i, stamp in page:
+            parts.append('<header><identifier>id%d</identifier><datestamp>%s'
+                         '</datestamp></header>' % (
+                             i, stamp.strftime('%Y-%m-%dT%H:%M:%SZ')))
+        following = offset + self.page_size
+        token = '%s|%s|%d' % (from_, until, following) \
+            if following < len(matching) else ''
+        parts.append('<resumptionToken completeListSize="%d">%s'
+                     '</resumptionToken>' % (len(matching), token))
+        parts.append('</ListIdentifiers></OAI-PMH>')
+        return StringIO(''.join(parts))
+
+
+class FakeClient(object):
+    '''pyoai client of a FakeSource, which reads pages whole.'''
+
+    def __init__(self, source):
+        self.source = source
+
+    def makeRequest(self, **kw):
+        return self.source(kw).read()
+
+
+class TestWindows(unittest.TestCase):
+
+    start = datetime(2013, 1, 1)
+
+    def _stamps(self, count, spacing=timedelta(hours=1)):
+        return [self.start + spacing * i for i in range(count)]
+
+    def _list(self, source, max_size, windows=None):
+        windows = windows or [Window(self.start,
+                                     self.start + timedelta(days=30))]
+        return list(list_windows(source, {'verb': 'ListIdentifiers',
+                                          'metadataPrefix': 'oai_dc'},
+                                 windows, max_size=max_size))
+
+    def test_split(self):
+        first, second = split(Window(self.start,
+                                     self.start + timedelta(seconds=3)))
+        self.assertEqual((first.from_, first.until),
+                         (self.start, self.start + timedelta(seconds=1)))
+        self.assertEqual(second.from_, self.start + timedelta(seconds=2))
+        self.assertEqual(split(Window(self.start, self.start)), None)
+        first, second = split(Window(self.start,
+                                     self.start + timedelta(days=1)), True)
+        self.assertEqual(first.until, self.start)
+
+    def test_adaptive(self):
+        source = FakeSource(self._stamps(200))
+        results = self._list(source, max_size=25)
+        identifiers = [header.identifier()
+                       for _, headers in results for header in headers]
+        self.assertEqual(sorted(identifiers),
+                         sorted('id%d' % i for i in range(200)))
+        self.assertTrue(len(results) >= 8)
+        for window, headers in results:
+            self.assertEqual(window.error, None)
+            self.assertTrue(len(headers) <= 25)
+
+    def test_dense_instant(self):
+        # Records with the same datestamp can not be split further.
+        source = FakeSource([self.start] * 30)
+        results = self._list(source, max_size=10)
+        self.assertEqual(sum(len(headers) for _, headers in results), 30)
+
+    def test_resume(self):
+        source = FakeSource(self._stamps(50), page_size=10,
+                            fail_token='2013-01-01T00:00:00Z|'
+                            '2013-01-31T00:00:00Z|20')
+        (window, headers), = self._list(source, max_size=100)
+        self.assertEqual(len(headers), 20)
+        self.assertTrue(isinstance(window.error, IOError))
+        self.assertEqual(window.token, source.fail_token)
+        source.fail_token = None
+        window.error = None
+        (window, headers), = self._list(source, max_size=100, windows=[window])
+        self.assertEqual(len(headers), 30)
+        self.assertEqual(window.token, None)
+
+    def test_expired_token(self):
+        # A token of an earlier listing, not handed out again.
+        old = '2013-01-01T00:00:00Z|2013-01-31T00:00:00Z|25'
+        source = FakeSource(self._stamps(50), page_size=10, expired=[old])
+        window = Window(self.start, self.start + timedelta(days=30), old)
+        (window, headers), = self._list(source, max_size=100,
+                                        windows=[window])
+        self.assertEqual(window.error, None)
+        self.assertEqual(window.token, None)
+        self.assertEqual(sorted(header.identifier() for header in headers),
+                         sorted('id%d' % i for i in range(50)))
+
+    def test_task_error(self):
+        def fail(*args):
+            raise ValueError('bug')
+        saved, windows.list_window = windows.list_window, fail
+        try:
+            self.assertRaises(ValueError, self._list,
+                              FakeSource(self._stamps(10)), 100)
+        finally:
+            windows.list_window = saved
+
+    def test_client_counted(self):
+        source = FakeSource(self._stamps(50), page_size=10)
+        client = metrics.instrument_client(FakeClient(source))
+        saved = metrics.harvest_registry
+        metrics.harvest_registry = metrics.HarvestRegistry()
+        try:
+            with metrics.harvest_stage('gather', 'http://a', 'job') as stage:
+                results = self._list(metrics.in_current_stages(
+                    page_opener(client)), max_size=25)
+        finally:
+            metrics.harvest_registry = saved
+        self.assertEqual(sum(len(headers) for _, headers in results), 50)
+        self.assertEqual(stage.requests, len(source.requests))
+        self.assertTrue(stage.bytes > 0)
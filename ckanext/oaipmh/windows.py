@@ -0,0 +1,181 @@
+# coding: utf-8
+# vi:et:ts=8:
+'''Listing a large selective harvest in date windows, in parallel.
+
+One chain of resumption tokens can only be followed a page at a time.
+Here the from-until interval is cut into windows that are listed with
+chains of their own, a few at a time.  The first page of a window tells
+the size of the whole window (completeListSize); a window holding more
+records than wanted is split in two and its halves are listed instead,
+down to the granularity of the source's datestamps.  Every window keeps
+the resumption token of its next page, so a window that fails can be
+resumed where it stopped.  Tokens expire, so a window whose token is
+not taken any more is listed again from the start.
+'''
+
+import datetime
+import sys
+from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
+
+import oaipmh.client
+import oaipmh.error
+from oaipmh.datestamp import datetime_to_datestamp
+
+from streaming import iter_pages, namespaces
+
+MAX_SIZE = 10000
+THREADS = 4
+
+class Window(object):
+        '''a from-until interval of datestamps, both ends included
+
+        :param from_: start of the interval
+        :type from_: datetime
+        :param until: end of the interval
+        :type until: datetime
+        :param token: resumption token of the next page, if the window
+                was partly listed
+        :type token: string
+        '''
+        def __init__(self, from_, until, token=None):
+                self.from_ = from_
+                self.until = until
+                self.token = token
+                self.complete_list_size = None
+                self.error = None
+
+        def __repr__(self):
+                return 'Window(%r, %r, %r)' % (self.from_, self.until,
+                                self.token)
+
+def split(window, day_granularity=False):
+        '''split a window in two halves that do not overlap
+
+        :returns: the halves, or None if the window is as short as the
+                granularity allows
+        :rtype: pair of Window instances
+        '''
+        step = datetime.timedelta(days=1) if day_granularity \
+                        else datetime.timedelta(seconds=1)
+        from_, until = window.from_, window.until
+        if day_granularity:
+                from_ = datetime.datetime(from_.year, from_.month, from_.day)
+                until = datetime.datetime(until.year, until.month, until.day)
+        else:
+                from_ = from_.replace(microsecond=0)
+                until = until.replace(microsecond=0)
+        steps = int(_seconds(until - from_) // _seconds(step))
+        if steps < 1:
+                return None
+        middle = from_ + step * ((steps - 1) // 2)
+        return Window(from_, middle), Window(middle + step, until)
+
+def _seconds(delta):
+        return delta.days * 86400 + delta.seconds
+
+def list_window(open_page, args, window, max_size=MAX_SIZE,
+                day_granularity=False):
+        '''list the headers of a window
+
+        Never raises; an error is kept in window.error, with the headers
+        listed before it.  A window resumed with a token that fails on
+        its first page, e.g. with badResumptionToken since the token has
+        expired, is listed again from its from and until.
+
+        :param open_page: function that makes a request and returns the
+                response
+        :param args: arguments of ListIdentifiers, without from and until
+        :returns: the window, its headers, and its halves if it is too
+                dense to be listed whole (then without headers)
+        :rtype: (Window, list, pair of Windows or None) triple
+        '''
+        headers = []
+        resumed = window.token
+        if window.token:
+                page_args = {'verb': args['verb'],
+                        'resumptionToken': window.token}
+        else:
+                page_args = dict(args)
+                page_args['from'] = datetime_to_datestamp(window.from_,
+                                day_granularity)
+                page_args['until'] = datetime_to_datestamp(window.until,
+                                day_granularity)
+        try:
+                for number, page in enumerate(iter_pages(open_page,
+                                page_args)):
+                        page_headers = [oaipmh.client.buildHeader(element,
+                                        namespaces) for element in page]
+                        if number == 0 and not window.token:
+                                window.complete_list_size = \
+                                                page.complete_list_size
+                                if (page.complete_list_size or 0) > max_size:
+                                        halves = split(window,
+                                                        day_granularity)
+                                        if halves:
+                                                return window, [], halves
+                        headers.extend(page_headers)
+                        window.token = page.token
+        except oaipmh.error.NoRecordsMatchError:
+                window.token = None
+        except Exception:
+                if resumed and window.token == resumed and not headers:
+                        window.token = None
+                        return list_window(open_page, args, window,
+                                        max_size, day_granularity)
+                window.error = sys.exc_info()[1]
+        return window, headers, None
+
+def list_windows(open_page, args, windows, max_size=MAX_SIZE,
+                threads=THREADS, day_granularity=False):
+        '''list windows in parallel, splitting the dense ones
+
+        :param open_page: function that makes a request and returns the
+                response; called from several threads at a time
+        :param args: arguments of ListIdentifiers, without from and until
+        :type args: hash from string to string
+        :param windows: the windows to list
+        :type windows: list of Window instances
+        :param max_size: most records a window may have to be listed
+                whole
+        :param threads: number of windows listed at a time
+        :returns: the windows as they are listed, with their headers;
+                failed windows have an error and the token to resume
+                with
+        :rtype: iterator of (Window, list of headers) pairs
+        '''
+        results = Queue()
+        pool = ThreadPool(threads)
+        outstanding = [0]
+        submitted = []
+
+        def submit(window):
+                outstanding[0] += 1
+                submitted.append(pool.apply_async(list_window, (open_page,
+                                args, window, max_size, day_granularity),
+                                callback=results.put))
+        try:
+                for window in windows:
+                        submit(window)
+                while outstanding[0]:
+                        try:
+                                window, headers, halves = results.get(
+                                                timeout=1)
+                        except Empty:
+                                # A task that raised never calls back;
+                                # its error is raised here instead.
+                                for result in submitted:
+                                        if result.ready() and \
+                                                not result.successful():
+                                                result.get()
+                                submitted[:] = [result for result in
+                                                submitted if not result.ready()]
+                                continue
+                        outstanding[0] -= 1
+                        if halves:
+                                for half in halves:
+                                        submit(half)
+                                continue
+                        yield window, headers
+        finally:
+                pool.terminate()
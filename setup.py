@@ -38,5 +38,8 @@ setup(
 	# Add plugins here, eg
 	oaipmh=ckanext.oaipmh.plugin:OAIPMHPlugin
 	oaipmh_harvester=ckanext.oaipmh.harvester:OAIPMHHarvester
+
+	[paste.paster_command]
+	oaipmh=ckanext.oaipmh.commands:OAIPMHCommand
 	""",
 )